@@ -32,6 +32,11 @@ else:
     text_type = str
     from abc import ABC
 
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
 __all__ = [
-    'PY2', 'text_type', 'httplib', 'ABC'
+    'PY2', 'text_type', 'httplib', 'ABC', 'selectors'
 ]
@@ -0,0 +1,151 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.config
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+    RESTful service runtime configuration
+'''
+
+import os
+
+import yaml
+
+from . import exceptions
+
+# Path to an (optional) YAML service configuration file
+ENV_CONFIG_PATH = 'HOSTPOOL_CONFIG'
+# Every setting can be overridden by a HOSTPOOL_<SETTING> variable
+ENV_PREFIX = 'HOSTPOOL_'
+
+DEFAULTS = {
+    # Storage implementation to use (see cloudify_hostpool.storage)
+    'storage_backend': 'tinydb',
+    # Storage file path, None uses the backend's default file name
+    'storage_path': None,
+    # When changes are fsynced: "strict" (before every operation returns,
+    # the TinyDB file is replaced atomically), "interval" (at most every
+    # tinydb_sync_interval / journal_sync_interval seconds or, for
+    # SQLite, at WAL checkpoints) or "none" (never, tests / CI only)
+    'storage_durability': 'strict',
+    # When the TinyDB file is written, "always" (after every operation)
+    # or "deferred" (every tinydb_flush_every operations, single worker)
+    'tinydb_flush': 'always',
+    'tinydb_flush_every': 100,
+    # Seconds the first of concurrent TinyDB writes waits for more writes
+    # to join its group commit (one file write for all of them)
+    'tinydb_commit_delay': 0.0,
+    'tinydb_sync_interval': 0.05,
+    # Format of the TinyDB file (and journal snapshot): "json",
+    # "fastjson" (orjson / ujson when installed) or "marshal", optionally
+    # zlib compressed. Existing files are read in whatever format they are.
+    'tinydb_serializer': 'json',
+    'tinydb_compress': False,
+    'journal_serializer': 'json',
+    'journal_compress': False,
+    # Journal only: fsync the journal every journal_sync_every records or
+    # journal_sync_interval seconds, compact it into the snapshot once it
+    # grows past journal_compact_size bytes (checked every
+    # journal_compact_interval seconds)
+    'journal_sync_every': 32,
+    'journal_sync_interval': 0.05,
+    'journal_compact_size': 1024 * 1024,
+    'journal_compact_interval': 60.0,
+    # Seconds a host endpoint has to accept a connection when allocating,
+    # and the most free hosts scanned at once
+    'scan_timeout': 1.0,
+    'scan_wave_size': 64,
+    # Probe results shared by the workers: seconds a reachable endpoint
+    # isn't probed again, and seconds an unreachable one is skipped,
+    # doubling with every consecutive failure up to probe_max_backoff
+    'probe_success_ttl': 5.0,
+    'probe_backoff': 1.0,
+    'probe_max_backoff': 60.0,
+    # Probe timeouts: "fixed" (scan_timeout) or "adaptive", the
+    # probe_timeout_percentile of the connect times of an endpoint (or of
+    # its /24 subnet) times probe_timeout_factor, between
+    # probe_timeout_floor and probe_timeout_ceiling seconds. Endpoints
+    # with unknown connect times get scan_timeout.
+    'probe_timeout_policy': 'adaptive',
+    'probe_timeout_percentile': 99.0,
+    'probe_timeout_factor': 3.0,
+    'probe_timeout_floor': 0.05,
+    'probe_timeout_ceiling': 5.0,
+    # Seconds between health check sweeps of every host (0 disables health
+    # checking). When enabled, allocations pick from the hosts the health
+    # checker found alive instead of probing them. One (elected) worker
+    # sweeps, unless health_worker is off and the checker runs as its own
+    # process (python -m cloudify_hostpool.health).
+    'health_interval': 0.0,
+    'health_worker': True,
+    # Most hosts updated per storage write by the health checker
+    'health_batch_size': 100,
+    # Log lock acquisitions that waited at least this many seconds
+    # (0 disables it), see GET /stats for lock contention metrics
+    'lock_slow_threshold': 0.0,
+    # Seconds an operation may wait for locks in total, before failing
+    # with 503 SERVICE UNAVAILABLE and a Retry-After header (0 waits
+    # forever). Keep them below the gunicorn worker timeout.
+    'lock_budget_read': 5.0,
+    'lock_budget_write': 20.0,
+    'lock_budget_acquire': 10.0,
+    'lock_budget_release': 10.0,
+}
+
+
+def _coerce(value, default):
+    '''Converts an environment string to the type of a default'''
+    if isinstance(default, bool):
+        return value.lower() in ['1', 'true', 'yes', 'on']
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    return value
+
+
+def get_config(path=None):
+    '''Loads the service configuration
+
+    Settings are resolved from (in order of priority) environment
+    variables, the YAML configuration file and built-in defaults.
+
+    :param str path: Path to a YAML configuration file
+    :returns: Service configuration
+    :rtype: dict
+    '''
+    config = dict(DEFAULTS)
+    path = path or os.environ.get(ENV_CONFIG_PATH)
+    if path:
+        with open(path, 'r') as f_cfg:
+            data = yaml.safe_load(f_cfg) or dict()
+        if not isinstance(data, dict):
+            raise exceptions.ConfigurationError(
+                'Service configuration must be a valid YAML mapping')
+        unknown = set(data) - set(DEFAULTS)
+        if unknown:
+            raise exceptions.ConfigurationError(
+                'Unknown service configuration keys: {0}'.format(
+                    ', '.join(sorted(unknown))))
+        config.update(data)
+    for key, default in DEFAULTS.items():
+        value = os.environ.get(ENV_PREFIX + key.upper())
+        if value is not None:
+            try:
+                config[key] = _coerce(value, default)
+            except ValueError:
+                raise exceptions.ConfigurationError(
+                    'Invalid value "{0}" for setting "{1}"'.format(
+                        value, key))
+    return config
@@ -19,3 +19,29 @@
 '''
 
 HOST_ID_KEY = 'id'
+# Pool revision of the last change of a host, set by the storage
+HOST_VERSION_KEY = 'version'
+# Time (seconds since the epoch) the health checker last reached a host
+HOST_LAST_SEEN_KEY = 'last_seen'
+# Stored host credentials are {CREDENTIALS_REF_KEY: <content hash>}
+CREDENTIALS_REF_KEY = '$ref'
+
+# What to do with added hosts whose (ip, port) endpoint already exists
+DUPLICATE_SKIP = 'skip'
+DUPLICATE_MERGE = 'merge'
+DUPLICATE_REJECT = 'reject'
+DUPLICATE_POLICIES = [DUPLICATE_SKIP, DUPLICATE_MERGE, DUPLICATE_REJECT]
+
+# What happened to an added host entry
+HOST_ADDED = 'added'
+HOST_SKIPPED = 'skipped'
+HOST_MERGED = 'merged'
+
+# Kinds of entries of the storage change log
+CHANGE_ADD = 'add'
+CHANGE_UPDATE = 'update'
+CHANGE_REMOVE = 'remove'
+# All hosts were removed (the entry has no host ID)
+CHANGE_PURGE = 'purge'
+# Number of most recent change log entries storages keep
+CHANGE_LOG_SIZE = 1024
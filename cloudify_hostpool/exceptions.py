@@ -34,6 +34,10 @@ class HostPoolHTTPException(Exception):
         '''Get the HTTP response object'''
         return {'error': self.__str__()}
 
+    def get_headers(self):
+        '''Get additional HTTP response headers'''
+        return dict()
+
 
 class NoHostAvailableException(HostPoolHTTPException):
 
@@ -81,6 +85,104 @@ class UnexpectedData(HostPoolHTTPException):
         return 'Unexpected data received: {0}'.format(self.message)
 
 
+class DuplicateHostException(HostPoolHTTPException):
+
+    """
+    Raised when added hosts duplicate existing (ip, port) endpoints
+
+    """
+
+    def __init__(self, duplicates):
+        self.duplicates = duplicates
+        super(DuplicateHostException, self).__init__(httplib.CONFLICT)
+
+    def __str__(self):
+        return 'Hosts with the same endpoints already exist: {0}'.format(
+            ', '.join('{ip}:{port}'.format(**x) for x in self.duplicates))
+
+    def to_dict(self):
+        '''Get the HTTP response object'''
+        return {'error': self.__str__(), 'duplicates': self.duplicates}
+
+
+class RevisionGoneException(HostPoolHTTPException):
+
+    """
+    Raised when the changes after a pool revision are no longer known
+    and clients must read the whole pool again
+
+    """
+
+    def __init__(self, since, revision):
+        self.since = since
+        self.revision = revision
+        super(RevisionGoneException, self).__init__(httplib.GONE)
+
+    def __str__(self):
+        return 'Changes since revision {0} are no longer available, ' \
+               'read all hosts again'.format(self.since)
+
+    def to_dict(self):
+        '''Get the HTTP response object'''
+        return {'error': self.__str__(), 'revision': self.revision}
+
+
+class LockTimeoutException(HostPoolHTTPException):
+
+    """
+    Raised when an operation waited for locks longer than its budget
+
+    """
+
+    def __init__(self, lock, waited, retry_after=None):
+        self.lock = lock
+        self.waited = waited
+        self.retry_after = retry_after
+        super(LockTimeoutException, self).__init__(
+            httplib.SERVICE_UNAVAILABLE)
+
+    def __str__(self):
+        return 'Service busy, gave up waiting for the "{0}" lock ' \
+               'after {1:.2f}s'.format(self.lock, self.waited)
+
+    def to_dict(self):
+        '''Get the HTTP response object'''
+        return {'error': self.__str__(), 'lock': self.lock,
+                'retry_after': self.retry_after}
+
+    def get_headers(self):
+        '''Get additional HTTP response headers'''
+        if self.retry_after is None:
+            return dict()
+        return {'Retry-After': str(self.retry_after)}
+
+
+class HostVersionMismatchException(HostPoolHTTPException):
+
+    """
+    Raised when a conditional update finds the host at another version
+
+    """
+
+    def __init__(self, host_id, version):
+        self.host_id = host_id
+        self.version = version
+        super(HostVersionMismatchException, self).__init__(
+            httplib.PRECONDITION_FAILED)
+
+    def __str__(self):
+        return 'Host {0} was changed (now at version {1})'.format(
+            self.host_id, self.version)
+
+    def to_dict(self):
+        '''Get the HTTP response object'''
+        return {'error': self.__str__(), 'version': self.version}
+
+    def get_headers(self):
+        '''Get additional HTTP response headers'''
+        return {'ETag': 'W/"{0}"'.format(self.version)}
+
+
 class ConfigurationError(Exception):
 
     """
@@ -0,0 +1,201 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.health
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+    Background health checking of the host endpoints
+
+    A health checker sweeps the endpoints of every host every
+    `health_interval` seconds (see `cloudify_hostpool.scanner`) and
+    writes which hosts are alive, and when they were last seen, back to
+    the storage in batches, outside of the change log and host versions.
+    Allocations then pick from the known-alive hosts without touching
+    the network.
+
+    Every gunicorn worker runs a checker thread, but only the worker
+    holding the health lock (a flock() of a file next to the database)
+    sweeps; another worker takes over if it dies. The checker can also
+    run as a dedicated process:
+
+        python -m cloudify_hostpool.health
+'''
+
+import os
+import sys
+import time
+import fcntl
+import logging
+import argparse
+import threading
+
+from . import config as service_config
+from . import constants
+from .scanner import get_scanner
+from .storage import get_storage
+
+LOCK_SUFFIX = '.health.lck'
+# Most hosts updated per storage write
+BATCH_SIZE = 100
+# Sweeps between refreshes of the last_seen time of hosts that stay alive,
+# so that sweeping a steady pool doesn't rewrite it
+LAST_SEEN_SWEEPS = 10
+
+# Health checkers of this process, by lock file path
+_CHECKERS = dict()
+_CHECKERS_LOCK = threading.Lock()
+
+
+def batches(items, size):
+    '''Splits a list into lists of at most size items'''
+    return [items[idx:idx + size] for idx in range(0, len(items), size)]
+
+
+class HealthChecker(object):
+    '''Sweeps the endpoints of every host, recording which are alive'''
+    def __init__(self, storage, scanner, interval,
+                 batch_size=BATCH_SIZE, logger=None):
+        self.storage = storage
+        self.scanner = scanner
+        self.interval = interval
+        self.batch_size = max(1, batch_size or BATCH_SIZE)
+        self.logger = logger or logging.getLogger('hostpool.health')
+        self.lock_path = storage.db_filename + LOCK_SUFFIX
+        self.fd = None
+        self.thread = None
+
+    @property
+    def leader(self):
+        '''If this checker holds the health lock'''
+        return self.fd is not None
+
+    def elect(self):
+        '''Takes the health lock if no other checker holds it
+
+        :returns: If this checker is the one sweeping
+        :rtype: bool
+        '''
+        if self.fd is None:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                return False
+            self.fd = fd
+            self.logger.info('Health checking the hosts of "{0}"'.format(
+                self.storage.db_filename))
+        return True
+
+    def resign(self):
+        '''Releases the health lock'''
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def sweep(self):
+        '''Probes every host once, writing the changes to the storage
+
+        :returns: Host IDs seen alive and host IDs lost
+        :rtype: tuple
+        '''
+        hosts = self.storage.get_hosts(
+            fields=['endpoint', 'alive', constants.HOST_LAST_SEEN_KEY])
+        scan = self.scanner.scan([x.get('endpoint') for x in hosts])
+        try:
+            reachable = set(scan)
+        finally:
+            scan.close()
+        now = int(time.time())
+        seen, lost = list(), list()
+        for idx, host in enumerate(hosts):
+            host_id = host[constants.HOST_ID_KEY]
+            if idx in reachable:
+                last_seen = host.get(constants.HOST_LAST_SEEN_KEY) or 0
+                if not host.get('alive') or \
+                   now - last_seen >= self.interval * LAST_SEEN_SWEEPS:
+                    seen.append(host_id)
+            elif host.get('alive'):
+                lost.append(host_id)
+        for batch in batches(seen, self.batch_size):
+            self.storage.set_alive(batch, True, now)
+        for batch in batches(lost, self.batch_size):
+            self.storage.set_alive(batch, False)
+        if lost:
+            self.logger.warning('Hosts no longer alive: {0}'.format(lost))
+        return seen, lost
+
+    def run(self, once=False):
+        '''Sweeps every interval while elected (or once)'''
+        while True:
+            start = time.time()
+            try:
+                if self.elect():
+                    self.sweep()
+            except Exception as ex:  # pylint: disable=W0703
+                self.logger.error('Health check sweep failed: {0}'.format(
+                    ex))
+            if once:
+                return
+            time.sleep(max(0.0, self.interval - (time.time() - start)))
+
+    def start(self):
+        '''Runs the checker in a background thread'''
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run,
+                                           name='hostpool-health')
+            self.thread.daemon = True
+            self.thread.start()
+
+
+def start_checker(storage, scanner, interval, batch_size=BATCH_SIZE,
+                  logger=None):
+    '''Starts the (single) health checker thread of a process
+
+    :returns: The health checker of the storage file
+    :rtype: HealthChecker
+    '''
+    checker = HealthChecker(storage, scanner, interval, batch_size, logger)
+    with _CHECKERS_LOCK:
+        checker = _CHECKERS.setdefault(checker.lock_path, checker)
+    checker.start()
+    return checker
+
+
+def main(argv=None):
+    '''Runs the health checker as a dedicated process'''
+    parser = argparse.ArgumentParser(
+        description='Health check the hosts of the host-pool service')
+    parser.add_argument('--config', default=None,
+                        help='Service configuration file (default: '
+                             '$HOSTPOOL_CONFIG)')
+    parser.add_argument('--once', action='store_true',
+                        help='Sweep once and exit')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    config = service_config.get_config(args.config)
+    if not config['health_interval']:
+        parser.error('health_interval is not set')
+    storage = get_storage(config['storage_backend'], config['storage_path'],
+                          config)
+    checker = HealthChecker(storage, get_scanner(config, storage),
+                            config['health_interval'],
+                            config['health_batch_size'])
+    checker.run(once=args.once)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+    Lock contention metrics of a service process
+
+    Every lock acquisition made through `timed` records how long it
+    waited for the lock and how long it held it, by lock name. Metrics
+    are kept per process (gunicorn worker).
+'''
+
+import os
+import math
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+from . import exceptions
+
+# Upper bounds (seconds) of the histogram buckets, plus a last,
+# unbounded bucket
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0]
+# Number of recent hold times Retry-After estimates are based on
+RECENT_HOLDS = 64
+# Bounds (seconds) of Retry-After estimates
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+_LOCKS = dict()
+_LOCKS_LOCK = threading.Lock()
+# Acquisitions waiting longer than this many seconds are logged (if set)
+_SLOW = {'threshold': None}
+logger = logging.getLogger('hostpool.metrics')
+
+
+class Histogram(object):
+    '''Distribution of durations, in seconds'''
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        '''Records a duration'''
+        idx = 0
+        while idx < len(BUCKETS) and value > BUCKETS[idx]:
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def to_dict(self):
+        '''Converts the histogram to a (JSON friendly) dict'''
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'buckets': [{'le': le, 'count': count} for le, count in
+                        zip(BUCKETS + [None], self.counts)]
+        }
+
+
+class LockMetrics(object):
+    '''Wait and hold times, current waiters and timeouts of a lock'''
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.waiters = 0
+        self.holders = 0
+        self.timeouts = 0
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.recent_holds = deque(maxlen=RECENT_HOLDS)
+
+    def retry_after(self):
+        '''Estimates when (seconds) the current waiters will be done'''
+        with self.lock:
+            holds = list(self.recent_holds)
+            waiters = self.waiters
+        hold = sum(holds) / len(holds) if holds else 0.0
+        return int(min(MAX_RETRY_AFTER, max(
+            MIN_RETRY_AFTER, math.ceil(hold * (waiters + 1)))))
+
+    def to_dict(self):
+        '''Converts the metrics to a (JSON friendly) dict'''
+        with self.lock:
+            return {
+                'waiters': self.waiters,
+                'holders': self.holders,
+                'timeouts': self.timeouts,
+                'wait': self.wait.to_dict(),
+                'hold': self.hold.to_dict()
+            }
+
+
+def configure(slow_threshold=None):
+    '''Sets the wait (seconds) above which acquisitions are logged'''
+    _SLOW['threshold'] = slow_threshold or None
+
+
+def get_lock_metrics(name):
+    '''Returns the metrics of a lock, by name'''
+    with _LOCKS_LOCK:
+        if name not in _LOCKS:
+            _LOCKS[name] = LockMetrics(name)
+        return _LOCKS[name]
+
+
+def reset():
+    '''Drops all metrics'''
+    with _LOCKS_LOCK:
+        _LOCKS.clear()
+
+
+def snapshot():
+    '''Returns the metrics of every lock of this process
+
+    :returns: Process ID and lock metrics, by lock name
+    :rtype: dict
+    '''
+    with _LOCKS_LOCK:
+        locks = list(_LOCKS.values())
+    return {
+        'pid': os.getpid(),
+        'locks': dict((x.name, x.to_dict()) for x in locks)
+    }
+
+
+@contextmanager
+def timed(name, lock):
+    '''Holds a lock (context manager), recording its metrics
+
+    :param str name: Lock name the metrics are recorded under
+    :param lock: Context manager acquiring the lock on enter and
+                 releasing it on exit
+    :raises LockTimeoutException: If the lock wasn't acquired in time,
+                                  with a Retry-After estimate
+    '''
+    metrics = get_lock_metrics(name)
+    with metrics.lock:
+        metrics.waiters += 1
+    start = time.time()
+    try:
+        lock.__enter__()
+    except exceptions.LockTimeoutException as ex:
+        with metrics.lock:
+            metrics.timeouts += 1
+        ex.lock = name
+        if ex.retry_after is None:
+            ex.retry_after = metrics.retry_after()
+        raise
+    finally:
+        waited = time.time() - start
+        with metrics.lock:
+            metrics.waiters -= 1
+    with metrics.lock:
+        metrics.holders += 1
+        metrics.wait.observe(waited)
+    threshold = _SLOW['threshold']
+    if threshold is not None and waited >= threshold:
+        logger.warning('Waited {0:.3f}s for the "{1}" lock'.format(
+            waited, name))
+    acquired = time.time()
+    try:
+        yield
+    finally:
+        try:
+            lock.__exit__(None, None, None)
+        finally:
+            held = time.time() - acquired
+            with metrics.lock:
+                metrics.holders -= 1
+                metrics.hold.observe(held)
+                metrics.recent_holds.append(held)
@@ -0,0 +1,237 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.probes
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+    Probe results of host endpoints, shared by the processes (gunicorn
+    workers) using a database file
+
+    A successful probe of an endpoint is trusted for `success_ttl`
+    seconds. A failed probe skips the endpoint for `backoff` seconds,
+    doubling with every consecutive failure up to `max_backoff`, so that
+    dead hosts stop costing a probe timeout on every allocation.
+
+    The results are kept in a memory mapped hash table file next to the
+    database, of fixed size records keyed by (ip, port):
+
+    - magic (4 bytes), capacity (uint32): number of records
+    - records: address (16 bytes, IPv4 addresses IPv6 mapped), port
+      (uint16), result (uint8), failures (uint32), checked (double):
+      time of the last probe, until (double): time the result is
+      trusted / the endpoint is skipped until
+
+    Records are written under a flock() of the file and read without
+    it; this is a cache, a torn read only costs a probe.
+'''
+
+import os
+import mmap
+import time
+import zlib
+import fcntl
+import socket
+import struct
+import threading
+
+PROBES_SUFFIX = '.probes'
+MAGIC = b'HPP\x01'
+HEADER = struct.Struct('<4sI')
+RECORD = struct.Struct('<16sHBxIdd')
+# Number of records, a full table replaces its least recently checked
+CAPACITY = 16384
+# Records looked at for an endpoint (linear probing)
+MAX_PROBE = 16
+V4_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+RESULT_EMPTY = 0
+RESULT_REACHABLE = 1
+RESULT_UNREACHABLE = 2
+
+# Seconds a successful probe is trusted
+SUCCESS_TTL = 5.0
+# Seconds a failed endpoint is skipped, doubling with every consecutive
+# failure up to MAX_BACKOFF
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+def pack_address(ip):
+    '''Packs an IP address into 16 bytes (None if it isn't one)'''
+    try:
+        if ':' in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)
+        return V4_PREFIX + socket.inet_pton(socket.AF_INET, ip)
+    except (socket.error, ValueError, TypeError):
+        return None
+
+
+def unpack_address(data):
+    '''Unpacks an IP address packed by `pack_address`'''
+    if data[:12] == V4_PREFIX:
+        return socket.inet_ntop(socket.AF_INET, data[12:])
+    return socket.inet_ntop(socket.AF_INET6, data)
+
+
+class ProbeCache(object):
+    '''
+    Memory mapped probe results of the endpoints of a database file
+    '''
+    def __init__(self, path, success_ttl=SUCCESS_TTL, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, capacity=CAPACITY):
+        self.path = path
+        self.success_ttl = success_ttl
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.capacity = capacity
+        self.mmap = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        '''Unmaps the probes file'''
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+
+    def _map(self):
+        '''Maps the probes file, creating it if it isn't valid'''
+        if self.mmap is not None:
+            return
+        size = HEADER.size + self.capacity * RECORD.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size >= HEADER.size:
+                with os.fdopen(os.dup(fd), 'rb') as f_probes:
+                    magic, capacity = HEADER.unpack(
+                        f_probes.read(HEADER.size))
+                if magic == MAGIC:
+                    self.capacity = capacity
+                    size = HEADER.size + capacity * RECORD.size
+            if os.fstat(fd).st_size != size:
+                # New (or foreign) file, start with no results
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self.mmap = mmap.mmap(fd, size)
+            HEADER.pack_into(self.mmap, 0, MAGIC, self.capacity)
+        finally:
+            # The mapping keeps (a duplicate of) the descriptor open
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _offset(self, slot):
+        '''Offset of a record in the file'''
+        return HEADER.size + slot * RECORD.size
+
+    def _find(self, address, port):
+        '''Finds the record of an endpoint
+
+        :returns: Slot and record of the endpoint (None if there's none),
+                  or the slot to record it in and None
+        :rtype: tuple
+        '''
+        start = zlib.crc32(address + struct.pack('<H', port)) & 0xffffffff
+        free, oldest = None, None
+        for idx in range(MAX_PROBE):
+            slot = (start + idx) % self.capacity
+            record = RECORD.unpack_from(self.mmap, self._offset(slot))
+            if record[2] == RESULT_EMPTY:
+                if free is None:
+                    free = slot
+                continue
+            if record[0] == address and record[1] == port:
+                return slot, record
+            if oldest is None or record[4] < oldest[1]:
+                oldest = (slot, record[4])
+        return (free if free is not None else oldest[0]), None
+
+    def _key(self, endpoint):
+        '''Packed (address, port) of an endpoint (None if invalid)'''
+        if not endpoint or not isinstance(endpoint.get('port'), int):
+            return None
+        address = pack_address(endpoint.get('ip'))
+        if address is None or not 0 < endpoint['port'] < 65536:
+            return None
+        return address, endpoint['port']
+
+    def get(self, endpoint):
+        '''Returns the last probe result of an endpoint (or None)'''
+        key = self._key(endpoint)
+        if key is None:
+            return None
+        self._map()
+        record = self._find(*key)[1]
+        return self.to_dict(record) if record else None
+
+    def verdict(self, endpoint, now=None):
+        '''Tells if an endpoint needs to be probed
+
+        :returns: True if the endpoint is known to be reachable, False if
+                  it's skipped after failures, None to probe it
+        '''
+        probe = self.get(endpoint)
+        if probe is None or (now or time.time()) >= probe['until']:
+            return None
+        return probe['reachable']
+
+    def record(self, endpoint, reachable, now=None):
+        '''Records the result of a probe of an endpoint'''
+        key = self._key(endpoint)
+        if key is None:
+            return
+        now = now or time.time()
+        self._map()
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                slot, record = self._find(*key)
+                if reachable:
+                    failures, until = 0, now + self.success_ttl
+                else:
+                    failures = 1
+                    if record and record[2] == RESULT_UNREACHABLE:
+                        failures = record[3] + 1
+                    until = now + min(
+                        self.max_backoff,
+                        self.backoff * 2 ** min(failures - 1, 32))
+                RECORD.pack_into(
+                    self.mmap, self._offset(slot), key[0], key[1],
+                    RESULT_REACHABLE if reachable else RESULT_UNREACHABLE,
+                    failures, now, until)
+            finally:
+                os.close(fd)
+
+    def entries(self):
+        '''Returns every recorded probe result, by endpoint'''
+        self._map()
+        entries = list()
+        for slot in range(self.capacity):
+            record = RECORD.unpack_from(self.mmap, self._offset(slot))
+            if record[2] != RESULT_EMPTY:
+                entries.append(self.to_dict(record))
+        return sorted(entries, key=lambda x: (x['ip'], x['port']))
+
+    @staticmethod
+    def to_dict(record):
+        '''Converts a record to a (JSON friendly) dict'''
+        return {
+            'ip': unpack_address(record[0]),
+            'port': record[1],
+            'reachable': record[2] == RESULT_REACHABLE,
+            'failures': record[3],
+            'checked': record[4],
+            'until': record[5]
+        }
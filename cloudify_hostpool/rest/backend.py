@@ -20,30 +20,91 @@
 
 # pylint: disable=R0911
 
-import socket
+import json
+import random
+import hashlib
+import time
 import logging
 import filelock
 from copy import deepcopy
-from collections import Mapping
+from contextlib import contextmanager
 
 # Used for IP / CIDR routines
 from netaddr import IPNetwork
 from netaddr.core import AddrFormatError
 
+from .. import config as service_config
 from .. import constants
 from .. import exceptions
+from .. import metrics
+from .. import health
 from .._compat import text_type
-from ..storage.tinydb_nosql import Database
+from ..scanner import get_scanner
+from ..storage import get_storage
+from ..storage import locking
+from ..storage.index import endpoint_key
+from ..utils import dict_update
 
 # we currently don't expose these in the configuration because its somewhat
 # internal. perhaps at a later time we can have this configurable, at which
 # point we need to define the semantics of how to initialize the components.
 FLOCK = filelock.FileLock('host-pool-backend.lock')
+# Lock file serializing host additions, next to the database file
+ADD_LOCK_SUFFIX = '.add.lck'
+# Attempts of an unconditional host update that keeps losing races,
+# with a random backoff of up to UPDATE_BACKOFF seconds, doubling with
+# every attempt
+UPDATE_ATTEMPTS = 10
+UPDATE_BACKOFF = 0.005
+
+
+@contextmanager
+def file_lock(lock, timeout=None):
+    '''Holds a file lock, waiting at most timeout seconds for it
+
+    Without a timeout, the wait is bounded by the lock wait budget of the
+    calling thread (see `cloudify_hostpool.storage.locking.wait_budget`).
+    '''
+    if timeout is None:
+        timeout = locking.remaining_budget()
+    start = time.time()
+    try:
+        lock.acquire(timeout=timeout)
+    except filelock.Timeout:
+        raise exceptions.LockTimeoutException(
+            lock._lock_file, time.time() - start)
+    finally:
+        locking.spend_budget(time.time() - start)
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def lock_budget(operation):
+    '''Decorate to bound the lock waits of a backend operation by the
+    lock_budget_<operation> setting (seconds, 0 waits forever)'''
+    def decorator(func):
+        '''Decorator'''
+        def wrapper(self, *args, **kwargs):
+            '''Runs the operation within its lock wait budget'''
+            budget = self.config['lock_budget_' + operation] or None
+            with locking.wait_budget(budget):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 
 # HostAlchemist
 # - Converts user-provided host entries into a consumable structure
 # HostReconciler
 # - Handles any host entry duplication cases
+# CredentialStore
+# - Keeps each distinct set of host credentials once
+
+# Host keys set by the service, never merged from a duplicate host entry
+SERVICE_KEYS = [constants.HOST_ID_KEY, constants.HOST_VERSION_KEY,
+                'allocated', 'alive', constants.HOST_LAST_SEEN_KEY]
 
 
 class HostAlchemist(object):
@@ -244,43 +305,263 @@ class HostAlchemist(object):
                 host['endpoint'] = [defaults.get('endpoint')]
 
 
-def dict_update(orig, updates):
-    '''Recursively merges two objects'''
-    for key, val in updates.items():
-        if isinstance(val, Mapping):
-            orig[key] = dict_update(orig.get(key, {}), val)
-        else:
-            orig[key] = updates[key]
-    return orig
+class CredentialStore(object):
+    '''
+    Keeps each distinct set of host credentials once
+
+    Expanded IP ranges and host defaults make many hosts share the same
+    credentials (including multi-KB private keys). Hosts are stored with
+    a reference to the content hash of their credentials instead, and
+    only resolved when a single host is returned.
+    '''
+    def __init__(self, storage):
+        self.storage = storage
+
+    @staticmethod
+    def reference(credentials):
+        '''Returns the content hash of a credentials object'''
+        return hashlib.sha256(json.dumps(
+            credentials, sort_keys=True,
+            separators=(',', ':')).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def is_reference(credentials):
+        '''Checks if stored host credentials are a reference'''
+        return isinstance(credentials, dict) and \
+            constants.CREDENTIALS_REF_KEY in credentials
+
+    def detach(self, hosts):
+        '''Replaces the credentials of hosts with references
+
+        All distinct credentials are stored with a single storage call.
+        '''
+        credentials = dict()
+        for host in hosts:
+            creds = host.get('credentials')
+            if not isinstance(creds, dict) or self.is_reference(creds):
+                continue
+            ref = self.reference(creds)
+            credentials[ref] = creds
+            host['credentials'] = {constants.CREDENTIALS_REF_KEY: ref}
+        if credentials:
+            self.storage.add_credentials(credentials)
+        return hosts
+
+    def resolve(self, host):
+        '''Replaces the credentials reference of a host with credentials'''
+        if host and self.is_reference(host.get('credentials')):
+            host['credentials'] = self.storage.get_credentials(
+                host['credentials'][constants.CREDENTIALS_REF_KEY])
+        return host
+
+    def update_hosts(self, eids, patch):
+        '''Merges a patch into hosts, re-referencing merged credentials
+
+        Hosts are updated in one storage call per distinct set of
+        credentials they end up with.
+        '''
+        if not isinstance(patch.get('credentials'), dict):
+            return self.storage.update_hosts(eids, patch)
+        groups = dict()
+        for eid in eids:
+            host = self.storage.get_host(eid, fields=['credentials'])
+            if host:
+                key = json.dumps(host.get('credentials'), sort_keys=True)
+                groups.setdefault(key, list()).append(eid)
+        host_ids = list()
+        for key, group in groups.items():
+            host = self.resolve({'credentials': json.loads(key)})
+            creds = host['credentials'] \
+                if isinstance(host['credentials'], dict) else dict()
+            host = self.detach([{'credentials': dict_update(
+                creds, deepcopy(patch['credentials']))}])[0]
+            host_ids.extend(self.storage.update_hosts(
+                group, dict(patch, credentials=host['credentials'])))
+        return host_ids
+
+
+class HostReconciler(object):
+    '''
+    Handles any host entry duplication cases
+
+    Hosts are identified by their (ip, port) endpoint. An entry that
+    duplicates an existing host, or an earlier entry of the same request,
+    is skipped, merged into that host or fails the whole request,
+    depending on the duplicate policy.
+    '''
+    def __init__(self, storage, policy=None, credentials=None):
+        self.storage = storage
+        self.credentials = credentials or CredentialStore(storage)
+        self.policy = policy or constants.DUPLICATE_SKIP
+        if self.policy not in constants.DUPLICATE_POLICIES:
+            raise exceptions.UnexpectedData(
+                'Unknown duplicate host policy "{0}"'.format(policy))
+
+    @staticmethod
+    def merge_patch(host):
+        '''Returns the part of a duplicate entry to merge into a host'''
+        return dict((k, v) for k, v in host.items()
+                    if k not in SERVICE_KEYS)
+
+    def reconcile(self, hosts):
+        '''Adds hosts to storage according to the duplicate policy
+
+        :param list hosts: List of parsed host objects
+        :returns: What happened to each entry, in order
+        :rtype: list
+        '''
+        keys = [endpoint_key(x.get('endpoint')) for x in hosts]
+        existing = self.storage.get_host_ids_by_endpoint(
+            set(x for x in keys if x is not None))
+        merge = self.policy == constants.DUPLICATE_MERGE
+        result = constants.HOST_MERGED if merge else constants.HOST_SKIPPED
+        # (existing host ID or None, position in new_hosts, result)
+        outcomes = list()
+        new_hosts, pending, merges = list(), dict(), dict()
+        for host, key in zip(hosts, keys):
+            if key in existing:
+                if merge:
+                    dict_update(merges.setdefault(existing[key], dict()),
+                                self.merge_patch(host))
+                outcomes.append((existing[key], None, result))
+            elif key in pending:
+                if merge:
+                    dict_update(new_hosts[pending[key]],
+                                self.merge_patch(host))
+                outcomes.append((None, pending[key], result))
+            else:
+                if key is not None:
+                    pending[key] = len(new_hosts)
+                outcomes.append((None, len(new_hosts),
+                                 constants.HOST_ADDED))
+                new_hosts.append(host)
+        if self.policy == constants.DUPLICATE_REJECT:
+            duplicates = [
+                {'ip': key[0], 'port': key[1], 'id': outcome[0]}
+                for key, outcome in zip(keys, outcomes)
+                if outcome[2] != constants.HOST_ADDED]
+            if duplicates:
+                raise exceptions.DuplicateHostException(duplicates)
+        host_ids = self.storage.add_hosts(
+            self.credentials.detach(new_hosts)) if new_hosts else []
+        for host_id, patch in merges.items():
+            self.credentials.update_hosts([host_id], patch)
+        return [{
+            constants.HOST_ID_KEY:
+                host_id if position is None else host_ids[position],
+            'ip': host['endpoint'].get('ip'),
+            'port': host['endpoint'].get('port'),
+            'result': outcome
+        } for host, (host_id, position, outcome) in zip(hosts, outcomes)]
 
 
 class RestBackend(object):
     '''RESTful service backend class'''
-    def __init__(self, logger=None, reset_storage=False, storage=None):
+    def __init__(self, logger=None, reset_storage=False, storage=None,
+                 storage_backend=None, config=None):
         if not logger:
             logger = logging.getLogger('hostpool.rest.backend')
         self.logger = logger.getChild('backend')
         self.logger.setLevel(logging.DEBUG)
-        self.storage = Database(storage)
+        self.config = dict(service_config.DEFAULTS)
+        self.config.update(config or dict())
+        self.storage = get_storage(
+            storage_backend or self.config['storage_backend'],
+            storage or self.config['storage_path'],
+            self.config)
+        self.credentials = CredentialStore(self.storage)
+        self.scanner = get_scanner(self.config, self.storage, self.logger)
+        self.probes = self.scanner.cache
+        if self.config['health_interval'] and self.config['health_worker']:
+            health.start_checker(self.storage, self.scanner,
+                                 self.config['health_interval'],
+                                 self.config['health_batch_size'],
+                                 self.logger)
+        metrics.configure(self.config['lock_slow_threshold'])
         if reset_storage:
-            with FLOCK.acquire(timeout=10):
+            with metrics.timed('backend', file_lock(FLOCK, timeout=10)):
                 self.storage.init_data()
 
-    def list_hosts(self, filters=None):
+    @lock_budget('read')
+    def list_hosts(self, filters=None, fields=None):
         '''Get an iterable of all hosts'''
         self.logger.debug('backend.list_hosts()')
-        return [x for x in self.storage.get_hosts()
-                if self.check_host_by_filters(x, filters)]
+        fields = self.validate_fields(fields)
+        filters = self.storage_filters(filters)
+        if filters is None:
+            return list()
+        return self.storage.get_hosts(filters=filters, fields=fields)
+
+    @lock_budget('read')
+    def get_revision(self):
+        '''Get the current pool revision'''
+        return self.storage.get_revision()
+
+    @lock_budget('read')
+    def list_changes(self, since, filters=None, fields=None):
+        '''Get the hosts changed after a pool revision
+
+        :param int since: Pool revision the caller is up to date with
+        :returns: The revision the changes go up to, the changed hosts
+                  (matching the filters) and the IDs of the changed hosts
+                  that were removed (or no longer match the filters)
+        :rtype: dict
+        '''
+        self.logger.debug('backend.list_changes({0})'.format(since))
+        if isinstance(since, bool) or not isinstance(since, int) or \
+           since < 0:
+            raise exceptions.UnexpectedData(
+                'Revision must be a non-negative integer')
+        fields = self.validate_fields(fields)
+        changes = self.storage.get_changes(since)
+        if changes is None or \
+           any(x['op'] == constants.CHANGE_PURGE for x in changes):
+            raise exceptions.RevisionGoneException(
+                since, self.storage.get_revision())
+        result = {
+            'revision': changes[-1]['revision'] if changes else since,
+            'hosts': list(),
+            'removed': list()
+        }
+        host_ids = set(x['id'] for x in changes)
+        if not host_ids:
+            return result
+        filters = self.storage_filters(filters)
+        if filters is not None:
+            filters['ids'] = sorted(host_ids)
+            result['hosts'] = self.storage.get_hosts(
+                filters=filters, fields=fields)
+        result['removed'] = sorted(host_ids - set(
+            x[constants.HOST_ID_KEY] for x in result['hosts']))
+        return result
 
-    def add_hosts(self, config):
+    @staticmethod
+    def validate_fields(fields):
+        '''Validates a field projection (a list of top level host keys)'''
+        if fields is None:
+            return None
+        if not isinstance(fields, list) or \
+           not all(isinstance(x, text_type) for x in fields):
+            raise exceptions.UnexpectedData(
+                'Fields must be a list of host keys')
+        return fields
+
+    @lock_budget('write')
+    def add_hosts(self, config, on_duplicate=None):
         '''Adds hosts to the host pool'''
         self.logger.debug('backend.add_hosts({0})'.format(config))
         if not isinstance(config, dict) or \
            not config.get('hosts'):
             raise exceptions.UnexpectedData('Empty hosts object')
+        reconciler = HostReconciler(self.storage, on_duplicate,
+                                    self.credentials)
         hosts = HostAlchemist(config).parse()
-        return self.storage.add_hosts(hosts)
+        # Concurrent requests must not add the same new endpoints
+        with metrics.timed('host_add', file_lock(filelock.FileLock(
+                self.storage.db_filename + ADD_LOCK_SUFFIX))):
+            return reconciler.reconcile(hosts)
 
+    @lock_budget('write')
     def remove_host(self, host_id):
         '''Remove a host from the host pool'''
         self.logger.debug('backend.remove_host({0})'.format(host_id))
@@ -291,122 +572,260 @@ class RestBackend(object):
             raise exceptions.HostNotFoundException(host_id)
         return h_id
 
-    def update_host(self, host_id, updates):
-        '''Updates a host in the host pool'''
+    @lock_budget('write')
+    def update_host(self, host_id, updates, versions=None):
+        '''Updates a host in the host pool
+
+        The host is read, merged with the updates and written back only
+        if it wasn't changed in between (compare-and-set on its
+        version), so concurrent updates are never lost and updates of
+        different hosts never wait for each other. A host changed in
+        between is read again (after a random backoff), unless the
+        update is conditional.
+
+        :param list versions: Versions the host must be at for the
+                              update to apply (If-Match), any if None
+        '''
         self.logger.debug('backend.update_host({0})'.format(host_id))
         if not host_id or not isinstance(host_id, int):
             raise exceptions.HostNotFoundException(host_id)
         if not isinstance(updates, dict):
             raise exceptions.UnexpectedData('Updates must be a JSON object')
-        orig = self.storage.get_host(host_id)
-        if not orig:
-            raise exceptions.HostNotFoundException(host_id)
-        updated = dict_update(orig, updates)
-        h_id = self.storage.update_host(host_id, updated)
-        if not h_id:
-            raise exceptions.HostNotFoundException(host_id)
-        return h_id
-
-    def check_host_by_filters(self, host, filters):
-        '''Check if a host matches a set of filters'''
+        for attempt in range(UPDATE_ATTEMPTS):
+            if attempt:
+                time.sleep(random.uniform(
+                    0, UPDATE_BACKOFF * 2 ** (attempt - 1)))
+            orig = self.credentials.resolve(self.storage.get_host(host_id))
+            if not orig:
+                raise exceptions.HostNotFoundException(host_id)
+            version = orig.get(constants.HOST_VERSION_KEY, 0)
+            if versions is not None and version not in versions:
+                raise exceptions.HostVersionMismatchException(
+                    host_id, version)
+            updated = self.credentials.detach(
+                [dict_update(orig, deepcopy(updates))])[0]
+            if self.storage.update_host(host_id, updated, version=version):
+                return host_id
+            version = self.storage.get_host_version(host_id)
+            if version is None:
+                raise exceptions.HostNotFoundException(host_id)
+            if versions is not None:
+                raise exceptions.HostVersionMismatchException(
+                    host_id, version)
+        raise exceptions.HostVersionMismatchException(host_id, version)
+
+    def select_host_ids(self, data):
+        '''Resolves the hosts targeted by a bulk request
+
+        Hosts are selected either by an explicit list of host IDs
+        ("ids") or by a set of filters ("filters"), never both.
+        '''
+        if not isinstance(data, dict):
+            raise exceptions.UnexpectedData('Request must be a JSON object')
+        host_ids, filters = data.get('ids'), data.get('filters')
+        if (host_ids is None) == (filters is None):
+            raise exceptions.UnexpectedData(
+                'Request must contain either "ids" or "filters"')
+        if host_ids is not None:
+            if not isinstance(host_ids, list) or not all(
+                    isinstance(x, int) and not isinstance(x, bool)
+                    for x in host_ids):
+                raise exceptions.UnexpectedData(
+                    '"ids" must be a list of host IDs')
+            return host_ids
+        # Empty filters would silently target the entire pool
+        if not filters or not isinstance(filters, dict):
+            raise exceptions.UnexpectedData(
+                '"filters" must be a non-empty JSON object')
+        return [x[constants.HOST_ID_KEY] for x in self.list_hosts(filters)]
+
+    @lock_budget('write')
+    def update_hosts(self, data):
+        '''Applies the same partial update to many hosts at once'''
+        self.logger.debug('backend.update_hosts({0})'.format(data))
+        host_ids = self.select_host_ids(data)
+        updates = data.get('updates')
+        if not updates or not isinstance(updates, dict):
+            raise exceptions.UnexpectedData(
+                '"updates" must be a non-empty JSON object')
+        updates = dict((k, v) for k, v in updates.items()
+                       if k != constants.HOST_ID_KEY)
+        if not host_ids:
+            return list()
+        return sorted(self.credentials.update_hosts(host_ids, updates))
+
+    @lock_budget('write')
+    def remove_hosts(self, data):
+        '''Removes many hosts from the host pool at once'''
+        self.logger.debug('backend.remove_hosts({0})'.format(data))
+        host_ids = self.select_host_ids(data)
+        if not host_ids:
+            return list()
+        return sorted(self.storage.remove_hosts(host_ids))
+
+    def storage_filters(self, filters):
+        '''Validates request filters and converts them to storage filters
+
+        Returns None if the filters are invalid, since such filters
+        cannot match any host.
+        '''
         # Basic validation
         if not filters or not isinstance(filters, dict):
             self.logger.warn('No filters specified')
-            return True
-        if not host:
-            self.logger.warn('No host specified')
-            return False
-        # Check filters using a True fall-through
+            return dict()
+        result = dict()
         # Check OS
         if filters.get('os'):
             if not isinstance(filters.get('os'), text_type):
                 self.logger.warn('Invalid, non-string requested OS provided')
-                return False
-            if filters.get('os').lower() != host.get('os', '').lower():
-                self.logger.warn('Host does not match all filters '
-                                 '(os={0})'.format(filters.get('os').lower()))
-                return False
+                return None
+            result['os'] = filters.get('os').lower()
         # Check tags (AND method)
         if filters.get('tags'):
-            if not isinstance(filters.get('tags'), list):
+            if not isinstance(filters.get('tags'), list) or \
+               not all(isinstance(x, text_type) for x in filters['tags']):
                 self.logger.warn('Invalid, non-list requested tags provided')
-                return False
-            for tag in filters.get('tags'):
-                if tag not in host.get('tags', list()):
-                    self.logger.warn('Host does not match all filters '
-                                     '(tags={0})'.format(filters.get('tags')))
-                    return False
-        return True
-
-    def acquire_host(self, filters=None):
-        '''Acquire a host, mark it taken'''
-        self.logger.debug('backend.acquire_host({0})'.format(filters))
-        # Configure a file lock
-        lock = filelock.FileLock('host_acquire.lck')
-        for host in self.get_unallocated_hosts():
-            # Get host ID
-            host_id = host[constants.HOST_ID_KEY]
-            # Enforce any user-defined requests
-            if self.check_host_by_filters(host, filters) and \
-               self.host_port_scan(host['endpoint']):
-                # Ensure the host is still free
-                with lock.acquire():
-                    _host = self.storage.get_host(host_id)
-                    if not _host['allocated']:
-                        self.storage.update_host(host_id,
-                                                 {'allocated': True})
-                        return self.storage.get_host(host_id)
-        # We didn't manage to acquire any host
-        raise exceptions.NoHostAvailableException()
+                return None
+            result['tags'] = filters.get('tags')
+        return result
+
+    @lock_budget('acquire')
+    def acquire_host(self, filters=None, count=None, min_count=None):
+        '''Acquire a host, mark it taken
+
+        The free hosts are scanned concurrently, the first one to be
+        reachable and still free when allocated wins. With health
+        checking, the first free host known to be alive wins instead.
+
+        With a count, up to count hosts are acquired in one pass and
+        returned as a list: the first reachable ones are allocated
+        together, in a single storage transaction. Unless at least
+        min_count (count by default, all or nothing) hosts could be
+        acquired, none are.
+        '''
+        self.logger.debug('backend.acquire_host({0}, count={1}, '
+                          'min_count={2})'.format(filters, count, min_count))
+        if count is None and min_count is None:
+            return self.acquire_hosts(filters, 1, 1)[0]
+        return self.acquire_hosts(filters, count, min_count)
 
+    @staticmethod
+    def validate_count(count, min_count=None):
+        '''Validates the number of hosts to acquire (and the least)'''
+        if count is None:
+            raise exceptions.UnexpectedData('min_count requires a count')
+        for name, value in [('count', count), ('min_count', min_count)]:
+            if value is not None and \
+               (isinstance(value, bool) or not isinstance(value, int) or
+                    value < 1):
+                raise exceptions.UnexpectedData(
+                    '{0} must be a positive integer'.format(name))
+        if min_count is not None and min_count > count:
+            raise exceptions.UnexpectedData(
+                'min_count must not be greater than count')
+        return count, min_count or count
+
+    def acquire_hosts(self, filters, count, min_count=None):
+        '''Acquires between min_count and count hosts (see acquire_host)
+
+        :returns: Acquired hosts
+        :rtype: list
+        '''
+        count, min_count = self.validate_count(count, min_count)
+        filters = self.storage_filters(filters)
+        if filters is None:
+            raise exceptions.NoHostAvailableException()
+        hosts = self.storage.get_free_hosts(filters=filters)
+        if self.config['health_interval']:
+            # The health checker keeps the alive flags up to date
+            scan = (idx for idx, x in enumerate(hosts) if x.get('alive'))
+        else:
+            scan = self.scan_endpoints([x['endpoint'] for x in hosts])
+        acquired, candidates = list(), list()
+        try:
+            for idx in scan:
+                candidates.append(hosts[idx][constants.HOST_ID_KEY])
+                if len(candidates) < count - len(acquired):
+                    continue
+                # The storage makes sure the hosts are still free
+                acquired.extend(self.storage.allocate_hosts(candidates))
+                candidates = list()
+                if len(acquired) >= count:
+                    break
+            # Leftovers are only worth allocating if they are enough
+            if candidates and \
+               len(acquired) + len(candidates) >= min_count:
+                acquired.extend(self.storage.allocate_hosts(candidates))
+        finally:
+            # Abort the probes still in flight
+            scan.close()
+        if len(acquired) < min_count:
+            if acquired:
+                # Whatever budget is left, the hosts must not stay
+                # allocated without an owner
+                with locking.without_budget():
+                    self.storage.release_hosts(
+                        [x[constants.HOST_ID_KEY] for x in acquired])
+            # We didn't manage to acquire enough hosts
+            raise exceptions.NoHostAvailableException()
+        return [self.credentials.resolve(x) for x in acquired]
+
+    @lock_budget('release')
     def release_host(self, host_id):
         '''Release a host, free it'''
         if not host_id or not isinstance(host_id, int):
             raise exceptions.HostNotFoundException(host_id)
-        # Get a file lock
-        lock = filelock.FileLock('host_acquire.lck')
-        with lock.acquire():
-            self.storage.update_host(host_id, {'allocated': False})
-            return self.storage.get_host(host_id)
+        host = self.storage.release(host_id)
+        if not host:
+            raise exceptions.HostNotFoundException(host_id)
+        return host
 
-    def get_host(self, host_id):
+    @lock_budget('read')
+    def get_host(self, host_id, fields=None):
         '''Gets a host + key data'''
         self.logger.debug('backend.get_host({0})'.format(host_id))
         if not host_id or not isinstance(host_id, int):
             raise exceptions.HostNotFoundException(host_id)
-        # Get a file lock
-        lock = filelock.FileLock('host_acquire.lck')
-        with lock.acquire():
-            host = self.storage.get_host(host_id)
-            if not host:
-                raise exceptions.HostNotFoundException(host_id)
-            return host
+        fields = self.validate_fields(fields)
+        host = self.storage.get_host(host_id, fields=fields)
+        if not host:
+            raise exceptions.HostNotFoundException(host_id)
+        return self.credentials.resolve(host)
+
+    @lock_budget('read')
+    def get_host_version(self, host_id):
+        '''Gets the version of a host, without reading the host'''
+        if not host_id or not isinstance(host_id, int):
+            raise exceptions.HostNotFoundException(host_id)
+        version = self.storage.get_host_version(host_id)
+        if version is None:
+            raise exceptions.HostNotFoundException(host_id)
+        return version
+
+    def list_probes(self):
+        '''Lists the recorded probe results of the host endpoints, with
+        their current probe timeout'''
+        probes = self.probes.entries()
+        for probe in probes:
+            probe['timeout'] = self.scanner.timeouts.timeout(probe)
+        return probes
 
     def get_unallocated_hosts(self):
         '''Get free hosts'''
-        return [x for x in self.list_hosts() if not x['allocated']]
+        return self.storage.get_free_hosts()
+
+    def scan_endpoints(self, endpoints):
+        '''Scans the TCP ports of endpoints concurrently
+
+        :returns: Generator of the positions of the reachable endpoints,
+                  in the order they connected
+        '''
+        return self.scanner.scan(endpoints)
 
     def host_port_scan(self, endpoint):
         '''Scans a TCP port'''
-        # Basic validation
-        if not endpoint or not endpoint.get('ip') or not endpoint.get('port'):
-            self.logger.error('Invalid endpoint specified')
-            return False
-
-        # Creates a TCP socket
-        sock = socket.socket()
-        sock.settimeout(1)
-        self.logger.info('Testing endpoint tcp://{0}:{1}'.format(
-            endpoint['ip'], endpoint['port']))
+        scan = self.scan_endpoints([endpoint])
         try:
-            sock.connect((endpoint['ip'], endpoint['port']))
-            sock.close()
-            self.logger.info('Successfully connected to '
-                             'endpoint tcp://{0}:{1}'.format(
-                                 endpoint['ip'], endpoint['port']))
-            return True
-        except socket.error as exc:
-            self.logger.warn('Error connecting to endpoint tcp://{0}:{1}. '
-                             'Exception: {2}'.format(
-                                 endpoint['ip'], endpoint['port'], exc))
-            return False
+            return any(True for _ in scan)
+        finally:
+            scan.close()
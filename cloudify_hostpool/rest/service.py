@@ -26,18 +26,33 @@ import logging
 
 from flask import Flask, request
 from flask_restful import Api, Resource
+from werkzeug.http import unquote_etag
 
+from .. import config as service_config
 from .. import exceptions
+from .. import metrics
 from .._compat import text_type, httplib
 from ..rest import backend as rest_backend
 
 # Globals
-app, api, backend = None, None, None
+app, api, backend, config = None, None, None, None
+# Response header with the pool revision a host list is up to date with
+REVISION_HEADER = 'X-Hostpool-Revision'
+ETAG_HEADER = 'ETag'
+
+
+def get_backend(reset_storage=False):
+    '''Creates the application backend from the service configuration'''
+    return rest_backend.RestBackend(
+        logger=app.logger,
+        reset_storage=reset_storage,
+        config=config)
 
 
 def setup():
     '''Service entry point'''
-    global app, backend
+    global app, backend, config
+    config = service_config.get_config()
     # initialize flask application
     app = Flask(__name__)
     # configure Flask to Gunicorn logging
@@ -45,15 +60,14 @@ def setup():
     app.logger.handlers.extend(gunicorn_handlers)
     app.logger.info('Flask, Gunicorn logging enabled')
     # initialize application backend
-    backend = rest_backend.RestBackend(logger=app.logger)
+    backend = get_backend()
 
 
 def reset_backend():
     '''Initialize application backend'''
     global backend
     app.logger.info('Resetting API service database data')
-    backend = rest_backend.RestBackend(logger=app.logger,
-                                       reset_storage=True)
+    backend = get_backend(reset_storage=True)
 
 
 setup()
@@ -68,9 +82,8 @@ class Service(Api):
         if hasattr(e, 'status_code'):
             app.logger.error('Exception.status_code: {0}'.format(
                 e.status_code))
-            return self.make_response({
-                'error': str(e)
-            }, e.status_code)
+            return self.make_response(e.to_dict(), e.status_code,
+                                      e.get_headers())
         return super(Service, self).handle_error(e)
 
 
@@ -88,14 +101,52 @@ def handle_json_exception(exc):
     raise exceptions.UnexpectedData(request.data)
 
 
+def get_fields():
+    '''Parses the "fields" (comma separated host keys) query parameter'''
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    return [x.strip() for x in fields.split(',') if x.strip()]
+
+
+def make_etag(version):
+    '''Makes the entity tag of a host or pool revision
+
+    The tag is weak: health checks change the alive and last_seen keys
+    of hosts without changing their version or the pool revision.
+    '''
+    return 'W/"{0}"'.format(version)
+
+
+def not_modified(etag):
+    '''Checks if the client already has the representation of an ETag'''
+    return request.if_none_match.contains_weak(unquote_etag(etag)[0])
+
+
+def get_if_match():
+    '''Parses the host versions of the If-Match header (None for any)
+
+    Host versions are compared weakly, like the ETags they come from.
+    '''
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    return [int(x) for x in request.if_match.as_set(include_weak=True)
+            if x.isdigit()]
+
+
 class Host(Resource):
     '''Host object handling'''
     @staticmethod
     def get(host_id):
         '''Get the details of the host with the given host_id'''
         app.logger.debug('GET /host/{0}'.format(host_id))
-        host = backend.get_host(host_id)
-        return host, httplib.OK
+        # Read the version first, so that the ETag is never newer than
+        # the host it is sent with
+        etag = make_etag(backend.get_host_version(host_id))
+        if not_modified(etag):
+            return {}, httplib.NOT_MODIFIED, {ETAG_HEADER: etag}
+        host = backend.get_host(host_id, fields=get_fields())
+        return host, httplib.OK, {ETAG_HEADER: etag}
 
     @staticmethod
     def delete(host_id):
@@ -109,9 +160,10 @@ class Host(Resource):
         '''Updates a host in the host pool'''
         request.on_json_loading_failed = handle_json_exception
         data = request.get_json(force=True) or dict()
-        app.logger.debug('PATCH /host/{0}, data="{1}"'.format(
-            host_id, data))
-        host = backend.update_host(host_id, data)
+        versions = get_if_match()
+        app.logger.debug('PATCH /host/{0}, data="{1}", versions={2}'.format(
+            host_id, data, versions))
+        host = backend.update_host(host_id, data, versions=versions)
         return host, httplib.OK
 
 
@@ -121,6 +173,8 @@ class HostList(Resource):
     def get():
         '''Get the details of the host with the given host_id'''
         data = request.args
+        fields = get_fields()
+        since = data.get('since')
         app.logger.debug('data={0}'.format(data))
         # Workaround for dealing with ImmutableMultiDict types
         if data:
@@ -135,30 +189,75 @@ class HostList(Resource):
         if isinstance(data.get('tags'), text_type):
             data['tags'] = [x.lower() for x in data['tags'].split(',')]
 
-        app.logger.debug('GET /hosts, filters="{0}"'.format(data))
-        hosts = backend.list_hosts(filters=data)
-        return hosts, httplib.OK
+        app.logger.debug(
+            'GET /hosts, filters="{0}", fields={1}, since={2}'.format(
+                data, fields, since))
+        if since is not None:
+            try:
+                since = int(since)
+            except ValueError:
+                raise exceptions.UnexpectedData(
+                    'Revision must be a non-negative integer')
+            changes = backend.list_changes(since, filters=data,
+                                           fields=fields)
+            return changes, httplib.OK, {
+                REVISION_HEADER: str(changes['revision'])}
+        # Read the revision first, so that no change is missed after it
+        revision = backend.get_revision()
+        headers = {REVISION_HEADER: str(revision),
+                   ETAG_HEADER: make_etag(revision)}
+        if not_modified(headers[ETAG_HEADER]):
+            return {}, httplib.NOT_MODIFIED, headers
+        hosts = backend.list_hosts(filters=data, fields=fields)
+        return hosts, httplib.OK, headers
 
     @staticmethod
     def post():
         '''Adds host(s) to the host pool'''
         request.on_json_loading_failed = handle_json_exception
         hosts = request.get_json(force=True) or dict()
-        app.logger.debug('POST /hosts, data="{0}"'.format(hosts))
+        on_duplicate = request.args.get('on_duplicate')
+        app.logger.debug('POST /hosts, data="{0}", on_duplicate={1}'.format(
+            hosts, on_duplicate))
         if not hosts:
             return 'Data must be a valid JSON array', httplib.BAD_REQUEST
-        ret = backend.add_hosts(hosts)
+        ret = backend.add_hosts(hosts, on_duplicate=on_duplicate)
         return ret, httplib.CREATED
 
+    @staticmethod
+    def patch():
+        '''Updates many hosts in the host pool at once'''
+        request.on_json_loading_failed = handle_json_exception
+        data = request.get_json(force=True) or dict()
+        app.logger.debug('PATCH /hosts, data="{0}"'.format(data))
+        host_ids = backend.update_hosts(data)
+        return host_ids, httplib.OK
+
+    @staticmethod
+    def delete():
+        '''Removes many hosts from the host pool at once'''
+        request.on_json_loading_failed = handle_json_exception
+        data = request.get_json(force=True) or dict()
+        app.logger.debug('DELETE /hosts, data="{0}"'.format(data))
+        host_ids = backend.remove_hosts(data)
+        return host_ids, httplib.OK
+
 
 class HostAllocate(Resource):
     '''Endpoint to acquire a host from the pool'''
     @staticmethod
     def post():
-        '''Allocates a host from the pool'''
+        '''Allocates a host (or "count" hosts) from the pool'''
         request.on_json_loading_failed = handle_json_exception
         data = request.get_json(force=True) or dict()
         app.logger.debug('POST /host/allocate, filters="{0}"'.format(data))
+        if isinstance(data, dict) and (
+                data.get('count') is not None or
+                data.get('min_count') is not None):
+            hosts = backend.acquire_host(filters=data,
+                                         count=data.get('count'),
+                                         min_count=data.get('min_count'))
+            return hosts, httplib.OK
         host = backend.acquire_host(filters=data)
         return host, httplib.OK
 
@@ -173,11 +272,31 @@ class HostDeallocate(Resource):
         return host, httplib.NO_CONTENT
 
 
+class Stats(Resource):
+    '''Endpoint for the internal metrics of the serving worker'''
+    @staticmethod
+    def get():
+        '''Gets the lock contention metrics of this worker process'''
+        app.logger.debug('GET /stats')
+        return metrics.snapshot(), httplib.OK
+
+
+class Probes(Resource):
+    '''Endpoint for the probe results of the host endpoints'''
+    @staticmethod
+    def get():
+        '''Gets the recorded probe result of every endpoint'''
+        app.logger.debug('GET /probes')
+        return backend.list_probes(), httplib.OK
+
+
 # Map the endpoints to classes
 api.add_resource(Host, '/host/<int:host_id>')
 api.add_resource(HostList, '/hosts')
 api.add_resource(HostAllocate, '/host/allocate')
 api.add_resource(HostDeallocate, '/host/<int:host_id>/deallocate')
+api.add_resource(Stats, '/stats')
+api.add_resource(Probes, '/probes')
 
 if __name__ == '__main__':
     app.run()
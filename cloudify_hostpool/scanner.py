@@ -0,0 +1,200 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.scanner
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+    Concurrent TCP port scanning of host endpoints
+
+    Endpoints are probed with non-blocking connects, multiplexed with
+    `selectors` (epoll, kqueue or poll, whichever is best here), in
+    waves of at most `wave_size` endpoints. A wave lasts at most the
+    longest probe timeout of its endpoints (see
+    `cloudify_hostpool.timeouts`), so scanning N endpoints takes
+    ceil(N / wave_size) timeouts at worst instead of N, and reachable
+    endpoints are reported as soon as they accept the connection.
+
+    With a probe cache (see `cloudify_hostpool.probes`), recently
+    reached endpoints are reported without probing them and endpoints
+    that recently failed are skipped.
+'''
+
+import time
+import errno
+import socket
+import logging
+
+from ._compat import selectors
+from .probes import PROBES_SUFFIX, ProbeCache
+from .timeouts import TIMEOUT, ProbeTimeouts
+
+# Most endpoints probed at once (each takes a file descriptor)
+WAVE_SIZE = 64
+# connect() results of a connection still in progress
+IN_PROGRESS = set([errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY,
+                   getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)])
+
+
+def endpoint_url(endpoint):
+    '''Formats an endpoint for log messages'''
+    return 'tcp://{0}:{1}'.format(endpoint.get('ip'), endpoint.get('port'))
+
+
+def get_scanner(config, storage, logger=None):
+    '''Creates the port scanner of a storage from the service configuration
+
+    :param dict config: Service configuration
+    :param storage: Storage instance, the probe cache is kept next to it
+    :returns: Port scanner
+    :rtype: PortScanner
+    '''
+    cache = ProbeCache(storage.db_filename + PROBES_SUFFIX,
+                       config['probe_success_ttl'], config['probe_backoff'],
+                       config['probe_max_backoff'])
+    timeouts = ProbeTimeouts(
+        config['probe_timeout_policy'], config['scan_timeout'],
+        config['probe_timeout_percentile'], config['probe_timeout_factor'],
+        config['probe_timeout_floor'], config['probe_timeout_ceiling'])
+    return PortScanner(config['scan_timeout'], config['scan_wave_size'],
+                       logger, cache, timeouts)
+
+
+class PortScanner(object):
+    '''Probes the TCP ports of host endpoints, concurrently'''
+    def __init__(self, timeout=TIMEOUT, wave_size=WAVE_SIZE, logger=None,
+                 cache=None, timeouts=None):
+        self.timeout = timeout or TIMEOUT
+        self.wave_size = max(1, wave_size or WAVE_SIZE)
+        self.logger = logger or logging.getLogger('hostpool.scanner')
+        self.cache = cache
+        self.timeouts = timeouts or ProbeTimeouts(timeout=self.timeout)
+
+    def scan(self, endpoints):
+        '''Yields the positions of the reachable endpoints in a list
+
+        Endpoints known to be reachable from the probe cache come first,
+        then the probed ones in the order they connect, wave by wave.
+        Stop (close) the generator once done with it, to abort the probes
+        in flight.
+
+        :param list endpoints: Endpoints ({"ip": ..., "port": ...})
+        :returns: Generator of positions in `endpoints`
+        '''
+        probed = list()
+        for idx, endpoint in enumerate(endpoints):
+            verdict = None
+            if self.cache is not None:
+                verdict = self.cache.verdict(endpoint)
+            if verdict is None:
+                probed.append(idx)
+            elif verdict:
+                yield idx
+            else:
+                self.logger.debug('Skipping endpoint {0}, it failed '
+                                  'recently'.format(endpoint_url(endpoint)))
+        for start in range(0, len(probed), self.wave_size):
+            wave = probed[start:start + self.wave_size]
+            for idx in self.scan_wave([endpoints[x] for x in wave]):
+                yield wave[idx]
+
+    def scan_wave(self, endpoints):
+        '''Probes endpoints all at once, yielding the reachable ones
+
+        Each endpoint has its own timeout, the wave ends when every
+        endpoint connected, failed or timed out.
+        '''
+        selector = selectors.DefaultSelector()
+        try:
+            for idx, endpoint in enumerate(endpoints):
+                start = time.time()
+                sock, connected = self.connect(endpoint)
+                if connected:
+                    self.timeouts.observe(endpoint, time.time() - start)
+                    yield idx
+                elif sock is not None:
+                    selector.register(sock, selectors.EVENT_WRITE, (
+                        idx, start, start + self.timeouts.timeout(endpoint)))
+            while selector.get_map():
+                now = time.time()
+                for key in list(selector.get_map().values()):
+                    if key.data[2] <= now:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        self.connected(endpoints[key.data[0]],
+                                       socket.timeout('timed out'))
+                if not selector.get_map():
+                    break
+                remaining = min(x.data[2] for x in
+                                selector.get_map().values()) - now
+                for key, _ in selector.select(max(0, remaining)):
+                    idx, start, _ = key.data
+                    selector.unregister(key.fileobj)
+                    error = key.fileobj.getsockopt(
+                        socket.SOL_SOCKET, socket.SO_ERROR)
+                    key.fileobj.close()
+                    if self.connected(endpoints[idx], error):
+                        self.timeouts.observe(endpoints[idx],
+                                              time.time() - start)
+                        yield idx
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+
+    def connect(self, endpoint):
+        '''Starts connecting to an endpoint
+
+        :returns: The socket (None if the connection failed) and whether
+                  it's connected already
+        :rtype: tuple
+        '''
+        if not endpoint or not endpoint.get('ip') or not endpoint.get('port'):
+            self.logger.error('Invalid endpoint specified')
+            return None, False
+        self.logger.info('Testing endpoint {0}'.format(
+            endpoint_url(endpoint)))
+        try:
+            sock = socket.socket(
+                socket.AF_INET6 if ':' in endpoint['ip'] else socket.AF_INET,
+                socket.SOCK_STREAM)
+        except socket.error as exc:
+            self.connected(endpoint, exc)
+            return None, False
+        sock.setblocking(False)
+        try:
+            error = sock.connect_ex((endpoint['ip'], endpoint['port']))
+        except (socket.error, OverflowError, TypeError) as exc:
+            # Unresolvable addresses and bad ports
+            error = exc
+        if error in IN_PROGRESS:
+            return sock, False
+        sock.close()
+        return None, self.connected(endpoint, error)
+
+    def connected(self, endpoint, error):
+        '''Logs (and caches) the outcome of a connection, returns if it
+        succeeded'''
+        if self.cache is not None:
+            self.cache.record(endpoint, not error)
+        if not error:
+            self.logger.info('Successfully connected to endpoint {0}'.format(
+                endpoint_url(endpoint)))
+            return True
+        if not isinstance(error, Exception):
+            error = socket.error(error, errno.errorcode.get(error, ''))
+        self.logger.warn('Error connecting to endpoint {0}. '
+                         'Exception: {1}'.format(endpoint_url(endpoint),
+                                                 error))
+        return False
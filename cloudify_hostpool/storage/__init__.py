@@ -12,3 +12,48 @@
 #    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #    * See the License for the specific language governing permissions and
 #    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+    Storage implementations for the RESTful service
+'''
+
+import importlib
+
+from .. import exceptions
+
+# Maps a storage backend name to the module implementing its Database
+BACKENDS = {
+    'tinydb': 'cloudify_hostpool.storage.tinydb_nosql',
+    'sqlite': 'cloudify_hostpool.storage.sqlite_sql',
+    'journal': 'cloudify_hostpool.storage.journal',
+}
+DEFAULT_BACKEND = 'tinydb'
+
+
+def get_storage(backend=None, storage=None, config=None):
+    '''Creates a storage instance
+
+    Service configuration settings prefixed with the backend name
+    (e.g. "tinydb_flush") are passed on to the backend as options, as
+    is the durability policy of every backend ("storage_durability").
+
+    :param str backend: Storage backend name (see BACKENDS)
+    :param str storage: Storage file path (or None for the default)
+    :param dict config: Service configuration
+    :returns: Storage instance
+    :rtype: cloudify_hostpool.storage.base.Storage
+    '''
+    backend = backend or DEFAULT_BACKEND
+    if backend not in BACKENDS:
+        raise exceptions.ConfigurationError(
+            'Unknown storage backend "{0}"'.format(backend))
+    prefix = backend + '_'
+    options = dict((key[len(prefix):], val)
+                   for key, val in (config or dict()).items()
+                   if key.startswith(prefix))
+    if (config or dict()).get('storage_durability'):
+        options['durability'] = config['storage_durability']
+    module = importlib.import_module(BACKENDS[backend])
+    return module.Database(storage, **options)
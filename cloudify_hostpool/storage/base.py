@@ -20,6 +20,7 @@
 
 import abc
 
+from .. import constants
 from .._compat import ABC
 
 
@@ -34,13 +35,15 @@ class Storage(ABC):
         '''Initializes the database by clearing all data'''
 
     @abc.abstractmethod
-    def get_host(self, eid):
+    def get_host(self, eid, fields=None):
         '''Retrieve a host in the host pool by object ID.
 
         Hosts are represented as dictionaries with the following keys:
 
         {
             'id': Unique database object ID,
+            'version': Pool revision of the last change of the host, set
+                       by the storage on every write (see `get_revision`),
             'alive': Boolean specifying if a host is able to be
                      communicated with,
             'allocated': Boolean specifying if a host is currently
@@ -69,19 +72,70 @@ class Storage(ABC):
             }
         }
 
+        Only the requested top level fields (plus the host ID) are returned
+        if `fields` is set, and the other fields are never copied.
+
         :param int eid: Host ID of the host to retrieve
+        :param list fields: Optional top level fields to return
         :returns: Host object
         :rtype: dict
         '''
 
     @abc.abstractmethod
-    def get_hosts(self):
+    def get_hosts(self, filters=None, fields=None):
         '''Retrieve a list of all hosts is the host pool.
 
-        :returns: A list of all host entries from the database
+        Hosts can be narrowed down with filters, all of which must match:
+
+        {
+            'os': OS type, compared case-insensitively,
+            'tags': List of tags the host must all have,
+            'allocated': Boolean allocation state of the host,
+            'ids': List of host IDs the host must be one of
+        }
+
+        :param dict filters: Optional filters to apply
+        :param list fields: Optional top level fields to return, see
+                            `get_host`
+        :returns: A list of host entries from the database, by host ID
         :rtype: list
         '''
 
+    def get_free_hosts(self, filters=None):
+        '''Retrieve the hosts that aren't allocated, by host ID.
+
+        Storages may answer this from cheaper (shared) state than the
+        full host data, but hosts must still be allocated through
+        `allocate_if_free`.
+
+        :param dict filters: Optional filters to apply, see `get_hosts`
+        :returns: A list of host entries, by host ID
+        :rtype: list
+        '''
+        filters = dict(filters or dict())
+        filters['allocated'] = False
+        return self.get_hosts(filters=filters)
+
+    @abc.abstractmethod
+    def get_host_version(self, eid):
+        '''Retrieve the version of a host, without reading the host.
+
+        :param int eid: Host ID of the host
+        :returns: Host version (0 for a host that was never written
+                  with one), or None if the host doesn't exist
+        :rtype: int
+        '''
+
+    @abc.abstractmethod
+    def get_host_ids_by_endpoint(self, endpoints):
+        '''Looks up existing hosts by their (ip, port) endpoint
+
+        :param list endpoints: List of (ip, port) tuples
+        :returns: Mapping of the (ip, port) tuples that exist to the ID
+                  of the (first) host with that endpoint
+        :rtype: dict
+        '''
+
     @abc.abstractmethod
     def add_hosts(self, hosts):
         '''Adds multiple host entries to the database
@@ -92,13 +146,18 @@ class Storage(ABC):
         '''
 
     @abc.abstractmethod
-    def update_host(self, eid, host):
+    def update_host(self, eid, host, version=None):
         '''Updates an existing host in the database
 
         This will raise a KeyError exception if a non-existent
         host ID is provided.
 
+        If `version` is set, the host is only updated if it is still at
+        that version (compare-and-set), atomically with the update.
+
         :param int eid: Host ID of the host to update
+        :param dict host: Host keys to update
+        :param int version: Version the host must be at (optional)
         :returns: Host ID that was updated (or None)
         :rtype: int
         '''
@@ -114,3 +173,144 @@ class Storage(ABC):
         :returns: Host ID that was removed (or None)
         :rtype: int
         '''
+
+    @abc.abstractmethod
+    def update_hosts(self, eids, patch):
+        '''Updates multiple existing hosts in a single transaction
+
+        The patch is merged recursively into every host. Unknown host
+        IDs are ignored.
+
+        :param list eids: Host IDs of the hosts to update
+        :param dict patch: Partial host object to merge into each host
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+
+    @abc.abstractmethod
+    def remove_hosts(self, eids):
+        '''Removes multiple existing hosts in a single transaction
+
+        Unknown host IDs are ignored.
+
+        :param list eids: Host IDs of the hosts to remove
+        :returns: List of host IDs that were removed
+        :rtype: list
+        '''
+
+    @abc.abstractmethod
+    def add_credentials(self, credentials):
+        '''Stores credentials by their content hash, in one transaction
+
+        Credentials that are already stored are left as they are.
+
+        :param dict credentials: Mapping of content hashes to credentials
+        '''
+
+    @abc.abstractmethod
+    def get_credentials(self, ref):
+        '''Retrieves stored credentials by content hash
+
+        :param str ref: Content hash of the credentials
+        :returns: Credentials object (or an empty dict)
+        :rtype: dict
+        '''
+
+    @abc.abstractmethod
+    def get_revision(self):
+        '''Retrieve the revision of the host pool.
+
+        The revision is persisted with the hosts and grows by one for
+        every host added, updated or removed (and for every purge), so
+        an unchanged revision means an unchanged pool.
+
+        :returns: Pool revision (0 for a pool that never changed)
+        :rtype: int
+        '''
+
+    @abc.abstractmethod
+    def get_changes(self, since):
+        '''Retrieve the changes made to the host pool after a revision.
+
+        Only the last `constants.CHANGE_LOG_SIZE` changes are kept.
+        Changes are represented as dictionaries with the following keys:
+
+        {
+            'revision': Pool revision the change made,
+            'id': Host ID of the changed host (None for a purge),
+            'op': Kind of change, see `constants.CHANGE_*`
+        }
+
+        :param int since: Revision the caller is up to date with
+        :returns: The changes after `since` by revision, or None if
+                  some of them are no longer kept
+        :rtype: list
+        '''
+
+    @abc.abstractmethod
+    def allocate_if_free(self, eid):
+        '''Atomically marks a host as allocated, if it isn't already
+
+        Implementations must guarantee that concurrent callers (threads
+        or processes) can never allocate the same host twice.
+
+        :param int eid: Host ID of the host to allocate
+        :returns: The allocated host object, or an empty dict if the
+                  host doesn't exist or is already allocated
+        :rtype: dict
+        '''
+
+    @abc.abstractmethod
+    def release(self, eid):
+        '''Atomically marks a host as not allocated
+
+        :param int eid: Host ID of the host to release
+        :returns: The released host object, or an empty dict if the
+                  host doesn't exist
+        :rtype: dict
+        '''
+
+    def allocate_hosts(self, eids):
+        '''Marks the hosts that aren't allocated already as allocated
+
+        Storages should allocate all of them in a single transaction,
+        this default allocates them one at a time.
+
+        :param list eids: Host IDs of the hosts to allocate
+        :returns: The allocated host objects (hosts that don't exist or
+                  are already allocated are skipped)
+        :rtype: list
+        '''
+        return [x for x in (self.allocate_if_free(eid) for eid in eids)
+                if x]
+
+    def release_hosts(self, eids):
+        '''Marks hosts as not allocated
+
+        Storages should release all of them in a single transaction,
+        this default releases them one at a time.
+
+        :param list eids: Host IDs of the hosts to release
+        :returns: The released host objects (hosts that don't exist are
+                  skipped)
+        :rtype: list
+        '''
+        return [x for x in (self.release(eid) for eid in eids) if x]
+
+    def set_alive(self, eids, alive, last_seen=None):
+        '''Records whether hosts are alive, as seen by a health check
+
+        Liveness isn't a change of the hosts: storages should record it
+        without logging it in the change log or versioning the hosts,
+        this default updates the hosts (and so does both).
+
+        :param list eids: Host IDs of the hosts checked
+        :param bool alive: If the hosts are alive
+        :param int last_seen: Time the hosts were seen alive (optional)
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        patch = {'alive': alive}
+        if last_seen is not None:
+            patch[constants.HOST_LAST_SEEN_KEY] = last_seen
+        return self.update_hosts(eids, patch)
@@ -0,0 +1,206 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.durability
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Durability policies of the storage files
+
+    Every storage backend honors one of the following policies:
+
+    - strict: A change is on disk when the operation returns. Files are
+      rewritten atomically (temporary file, fsync, rename).
+    - interval: Changes are fsynced at most every sync interval, a
+      crash may lose the changes of the last interval.
+    - none: Changes are never fsynced, leaving it to the OS. For tests
+      and CI only.
+
+    Run this module to benchmark the policies of every backend.
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+
+from .. import exceptions
+
+DURABILITY_STRICT = 'strict'
+DURABILITY_INTERVAL = 'interval'
+DURABILITY_NONE = 'none'
+DURABILITY_POLICIES = [DURABILITY_STRICT, DURABILITY_INTERVAL,
+                       DURABILITY_NONE]
+# Default seconds between fsyncs of the interval policy
+SYNC_INTERVAL = 0.05
+
+TMP_SUFFIX = '.tmp'
+
+
+def validate(policy):
+    '''Checks a durability policy name'''
+    if policy not in DURABILITY_POLICIES:
+        raise exceptions.ConfigurationError(
+            'Unknown storage durability "{0}"'.format(policy))
+    return policy
+
+
+def fsync_dir(path):
+    '''Makes a rename in the directory of a file durable'''
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def replace_file(path, data):
+    '''Atomically replaces the contents of a file, durably
+
+    The data is written to a temporary file next to it, which is fsynced
+    and renamed over the file. Readers see either the old or the new
+    contents, never a partial write. Concurrent callers must be
+    serialized (by the database lock).
+
+    :param str path: File path
+    :param bytes data: New file contents
+    '''
+    tmp_path = path + TMP_SUFFIX
+    with open(tmp_path, 'wb') as f_tmp:
+        f_tmp.write(data)
+        f_tmp.flush()
+        os.fsync(f_tmp.fileno())
+    os.rename(tmp_path, path)
+    fsync_dir(path)
+
+
+class IntervalSync(object):
+    '''
+    fsyncs a file at most every `interval` seconds. A write made less
+    than an interval after the last fsync is fsynced by a timer thread
+    once the interval is over (or when the file is closed).
+    '''
+    def __init__(self, fileobj, interval=SYNC_INTERVAL):
+        self.fileobj = fileobj
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.synced = 0.0
+        self.pending = False
+        self.timer = None
+
+    def written(self):
+        '''Notes a write, fsyncing it now or scheduling it'''
+        with self.lock:
+            self.pending = True
+            wait = self.synced + self.interval - time.time()
+            if wait <= 0:
+                self._sync()
+            elif self.timer is None:
+                self.timer = threading.Timer(wait, self.sync)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def sync(self):
+        '''fsyncs the pending writes, if any'''
+        with self.lock:
+            self.timer = None
+            self._sync()
+
+    def _sync(self):
+        '''fsyncs the pending writes (with the lock held)'''
+        if self.pending and not self.fileobj.closed:
+            os.fsync(self.fileobj.fileno())
+        self.pending = False
+        self.synced = time.time()
+
+    def close(self):
+        '''fsyncs the pending writes and stops the timer'''
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._sync()
+
+
+def _generate_hosts(count):
+    '''Generates host objects to benchmark with'''
+    return [{
+        'name': 'host-{0}'.format(idx),
+        'os': 'linux',
+        'endpoint': {'ip': '10.{0}.{1}.{2}'.format(
+            idx >> 16, (idx >> 8) & 255, idx & 255),
+            'port': 22, 'protocol': 'ssh'},
+        'credentials': {'$ref': '{0:064x}'.format(idx % 4)},
+        'tags': ['rack-{0}'.format(idx % 40), 'all'],
+        'allocated': False,
+        'alive': True
+    } for idx in range(count)]
+
+
+def benchmark(backend, policy, hosts, writes):
+    '''Measures the allocations per second a backend sustains
+
+    :param str backend: Storage backend name
+    :param str policy: Durability policy
+    :param int hosts: Number of hosts in the pool
+    :param int writes: Number of (sequential) allocations to time
+    :returns: Allocations per second
+    :rtype: float
+    '''
+    # Imported here, the backends use this module
+    from ..storage import get_storage
+    workdir = tempfile.mkdtemp()
+    try:
+        storage = get_storage(backend, os.path.join(workdir, 'db_hostpool'),
+                              {'storage_durability': policy})
+        storage.add_hosts(_generate_hosts(hosts))
+        start = time.time()
+        for eid in range(1, writes + 1):
+            storage.allocate_if_free(eid)
+        elapsed = time.time() - start
+        storage.close()
+        return writes / elapsed
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main(argv=None):
+    '''Benchmarks the durability policies of the storage backends'''
+    parser = argparse.ArgumentParser(
+        description='Benchmark the host-pool storage durability policies')
+    parser.add_argument('--hosts', type=int, default=2000,
+                        help='Number of hosts (default: %(default)s)')
+    parser.add_argument('--writes', type=int, default=200,
+                        help='Number of allocations to time '
+                             '(default: %(default)s)')
+    parser.add_argument('--backends', default='tinydb,journal,sqlite',
+                        help='Comma separated storage backends '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    sys.stdout.write('{0} hosts, {1} sequential allocations\n'.format(
+        args.hosts, args.writes))
+    row = '{0:<10} {1:<10} {2:>14}\n'
+    sys.stdout.write(row.format('backend', 'durability', 'allocations/s'))
+    for backend in args.backends.split(','):
+        for policy in DURABILITY_POLICIES:
+            sys.stdout.write(row.format(backend, policy, '{0:.0f}'.format(
+                benchmark(backend, policy, args.hosts, args.writes))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.index
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    In-memory inverted index of the host attributes used by filters
+'''
+
+from collections import defaultdict
+
+from .._compat import text_type
+
+
+def endpoint_key(endpoint):
+    '''Returns the (ip, port) identity of a host endpoint (or None)'''
+    if not isinstance(endpoint, dict) or \
+       not isinstance(endpoint.get('ip'), text_type) or \
+       not isinstance(endpoint.get('port'), int):
+        return None
+    return endpoint['ip'], endpoint['port']
+
+
+def host_keys(host):
+    '''Derives the indexed (os, tags, allocated, endpoint) values of a host
+
+    :param dict host: Host object
+    :returns: Lower case OS (or None), set of tags, allocated flag and
+              (ip, port) endpoint (or None)
+    :rtype: tuple
+    '''
+    host_os = host.get('os')
+    host_os = host_os.lower() if isinstance(host_os, text_type) else None
+    tags = host.get('tags')
+    tags = frozenset(x for x in tags if isinstance(x, text_type)) \
+        if isinstance(tags, list) else frozenset()
+    return (host_os, tags, bool(host.get('allocated')),
+            endpoint_key(host.get('endpoint')))
+
+
+class HostIndex(object):
+    '''
+    Maps OS types, tags and the allocated flag to the set of matching
+    host IDs, so that filters are evaluated as set intersections instead
+    of scanning every host. Endpoints are mapped to host IDs as well, to
+    find duplicate hosts.
+    '''
+    def __init__(self, hosts=None):
+        self.by_os = defaultdict(set)
+        self.by_tag = defaultdict(set)
+        self.by_allocated = {True: set(), False: set()}
+        self.by_endpoint = defaultdict(set)
+        self.keys = dict()
+        for eid, host in (hosts or dict()).items():
+            self.add(eid, host)
+
+    def add(self, eid, host):
+        '''Indexes a host that isn't indexed yet'''
+        host_os, tags, allocated, endpoint = self.keys[eid] = \
+            host_keys(host)
+        if host_os is not None:
+            self.by_os[host_os].add(eid)
+        for tag in tags:
+            self.by_tag[tag].add(eid)
+        self.by_allocated[allocated].add(eid)
+        if endpoint is not None:
+            self.by_endpoint[endpoint].add(eid)
+
+    def discard(self, eid):
+        '''Drops a host from the index, if indexed'''
+        if eid not in self.keys:
+            return
+        host_os, tags, allocated, endpoint = self.keys.pop(eid)
+        if host_os is not None:
+            self._discard(self.by_os, host_os, eid)
+        for tag in tags:
+            self._discard(self.by_tag, tag, eid)
+        self.by_allocated[allocated].discard(eid)
+        if endpoint is not None:
+            self._discard(self.by_endpoint, endpoint, eid)
+
+    @staticmethod
+    def _discard(index, key, eid):
+        '''Drops a host ID from an index entry, and empty entries'''
+        index[key].discard(eid)
+        if not index[key]:
+            del index[key]
+
+    def update(self, eid, host):
+        '''Re-indexes a host (or drops it if host is None)'''
+        if host is not None and self.keys.get(eid) == host_keys(host):
+            return
+        self.discard(eid)
+        if host is not None:
+            self.add(eid, host)
+
+    def select(self, filters):
+        '''Finds the IDs of the hosts matching all filters
+
+        :param dict filters: Storage filters, see `Storage.get_hosts`
+        :returns: Set of matching host IDs
+        :rtype: set
+        '''
+        candidates = list()
+        if filters.get('os') is not None:
+            candidates.append(
+                self.by_os.get(filters['os'].lower(), frozenset()))
+        for tag in set(filters.get('tags') or list()):
+            candidates.append(self.by_tag.get(tag, frozenset()))
+        if filters.get('allocated') is not None:
+            candidates.append(self.by_allocated[bool(filters['allocated'])])
+        if filters.get('ids') is not None:
+            candidates.append(
+                set(x for x in filters['ids'] if x in self.keys))
+        if not candidates:
+            return set(self.keys)
+        # Intersect starting with the most selective entry
+        candidates.sort(key=len)
+        result = set(candidates[0])
+        for candidate in candidates[1:]:
+            if not result:
+                break
+            result.intersection_update(candidate)
+        return result
+
+    def find_endpoint(self, endpoint):
+        '''Returns the lowest ID of the hosts with an (ip, port) endpoint
+
+        :param tuple endpoint: (ip, port) endpoint
+        :returns: Host ID (or None)
+        :rtype: int
+        '''
+        host_ids = self.by_endpoint.get(endpoint)
+        return min(host_ids) if host_ids else None
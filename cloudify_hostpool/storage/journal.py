@@ -0,0 +1,480 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.journal
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Journaled TinyDB storage interface for the RESTful service
+
+    Mutations are appended as one small JSON record per line to a
+    journal file next to the (TinyDB formatted) snapshot file, instead
+    of rewriting the whole database. Journal records are fsynced in
+    groups, and a background thread periodically folds the journal into
+    a new snapshot. Every process replays the snapshot plus the journal
+    on startup and then only reads the journal records it hasn't seen.
+    Under the strict durability policy every append is fsynced, under
+    the none policy the journal is never fsynced.
+
+    Records are idempotent, so replaying a journal over a snapshot that
+    already contains it yields the same state.
+'''
+
+import os
+import json
+import time
+import logging
+import threading
+from copy import deepcopy
+
+from .. import constants
+from ..storage import serializers, tinydb_nosql
+from ..storage.durability import (
+    DURABILITY_STRICT, DURABILITY_NONE, fsync_dir)
+from ..utils import dict_update
+
+JOURNAL_SUFFIX = '.journal'
+# fsync the journal after this many records...
+SYNC_EVERY = 32
+# ... or this many seconds after the first unsynced record
+SYNC_INTERVAL = 0.05
+# Compact once the journal grows past this many bytes
+COMPACT_SIZE = 1024 * 1024
+# Seconds between checks of the journal size
+COMPACT_INTERVAL = 60.0
+
+OP_INSERT = 'insert'
+OP_UPDATE = 'update'
+OP_MERGE = 'merge'
+OP_REMOVE = 'remove'
+OP_PURGE = 'purge'
+OP_CREDENTIALS = 'credentials'
+
+
+class JournalHandle(tinydb_nosql.CachedHandle):
+    '''
+    Long-lived TinyDB handle of a process, kept up to date by replaying
+    the journal. The snapshot file is only ever written by compaction.
+    '''
+    def __init__(self, path):
+        super(JournalHandle, self).__init__(path)
+        self.journal_path = path + JOURNAL_SUFFIX
+        self.journal_inode = None
+        self.offset = 0
+        self.fd = None
+        self.unsynced = 0
+        self.sync_every = SYNC_EVERY
+        self.sync_interval = SYNC_INTERVAL
+        self.compact_size = COMPACT_SIZE
+        self.compact_interval = COMPACT_INTERVAL
+        self.worker = None
+        # Change log entries to journal with the next records
+        self.pending_changes = dict()
+        self.logger = logging.getLogger('hostpool.storage.journal')
+
+    def load(self, signature):
+        '''Loads the snapshot and replays the whole journal'''
+        self.open()
+        raw = tinydb_nosql.normalize(self.db.storage.read())
+        raw.setdefault(tinydb_nosql.TBL_HOSTS, dict())
+        self.signature = signature
+        self.journal_inode = None
+        self.replay()
+
+    def refresh(self):
+        '''Catches up with the snapshot and journal on disk'''
+        signature = tinydb_nosql.file_signature(self.path)
+        if self.db is None or signature != self.signature:
+            self.load(signature)
+            return
+        journal = tinydb_nosql.file_signature(self.journal_path)
+        if not journal or journal[0] != self.journal_inode or \
+           journal[1] > self.offset:
+            self.replay()
+
+    def replay(self):
+        '''Applies the journal records that haven't been applied yet'''
+        fd = os.open(self.journal_path, os.O_RDONLY | os.O_CREAT, 0o644)
+        try:
+            inode = os.fstat(fd).st_ino
+            if inode != self.journal_inode:
+                # A new journal (after compaction) is replayed from the start
+                self.journal_inode = inode
+                self.offset = 0
+            os.lseek(fd, self.offset, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        data = b''.join(chunks)
+        # Only complete lines, a concurrent append may be in progress
+        data = data[:data.rfind(b'\n') + 1]
+        if not data:
+            return
+        for line in data.splitlines():
+            self.apply(json.loads(line.decode('utf-8')))
+        self.offset += len(data)
+        # Tables cache the last used host ID, rebuild them
+        self.db._table_cache.clear()
+
+    def apply(self, record):
+        '''Applies a single journal record to the cached data'''
+        changes = dict((revision, {'id': eid, 'op': op})
+                       for revision, eid, op in record.get('changes') or [])
+        if changes:
+            self.add_changes(changes)
+        table = self.db.storage.read()[tinydb_nosql.TBL_HOSTS]
+        if record['op'] == OP_PURGE:
+            table.clear()
+            self.db.storage.read().pop(tinydb_nosql.TBL_CREDENTIALS, None)
+            self.index = None
+        elif record['op'] == OP_CREDENTIALS:
+            self.db.storage.read().setdefault(
+                tinydb_nosql.TBL_CREDENTIALS, dict()).update(
+                    record['credentials'])
+        elif record['op'] == OP_INSERT:
+            table[record['id']] = record['host']
+        elif record['op'] == OP_UPDATE:
+            if record['id'] in table:
+                table[record['id']].update(record['host'])
+        elif record['op'] == OP_MERGE:
+            for eid in record['ids']:
+                if eid in table:
+                    dict_update(table[eid], deepcopy(record['host']))
+        elif record['op'] == OP_REMOVE:
+            for eid in record.get('ids') or [record['id']]:
+                table.pop(eid, None)
+        if record['op'] != OP_CREDENTIALS:
+            self.reindex(record.get('ids') or [record.get('id')])
+        # Versions are set once the hosts are written
+        self.stamp(changes)
+
+    def log_changes(self, eids, op):
+        '''Records changed hosts in the change log, to be journaled with
+        the next records'''
+        changes = super(JournalHandle, self).log_changes(eids, op)
+        self.pending_changes.update(changes)
+        return changes
+
+    def append(self, records):
+        '''Appends records to the journal
+
+        Pending change log entries are journaled with the last record.
+        The caller must hold the database lock and have refreshed the
+        handle, so that the journal offset is the end of the journal.
+        '''
+        if self.pending_changes:
+            records = records[:-1] + [dict(records[-1], changes=[
+                [revision, x['id'], x['op']] for revision, x in
+                sorted(self.pending_changes.items())])]
+            self.pending_changes = dict()
+        data = ''.join(json.dumps(x) + '\n' for x in records)
+        data = data.encode('utf-8')
+        if self.fd is not None and \
+           os.fstat(self.fd).st_ino != self.journal_inode:
+            os.close(self.fd)
+            self.fd = None
+        if self.fd is None:
+            self.fd = os.open(self.journal_path,
+                              os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.write(self.fd, data)
+        self.offset += len(data)
+        self.unsynced += len(records)
+        if self.unsynced >= self.sync_every or \
+           self.durability == DURABILITY_STRICT:
+            self.sync()
+        else:
+            self.start_worker()
+
+    def sync(self):
+        '''fsyncs the journal records written so far'''
+        if self.unsynced and self.fd is not None and \
+           self.durability != DURABILITY_NONE:
+            os.fsync(self.fd)
+        self.unsynced = 0
+
+    def flush(self):
+        '''Journal records are written (and synced) as they happen'''
+
+    def compact(self):
+        '''Folds the journal into a new snapshot'''
+        with self.rwlock.exclusive():
+            with self.lock:
+                self.refresh()
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'wb') as f_tmp:
+                    f_tmp.write(serializers.dumps(
+                        self.db.storage.read(), self.serializer,
+                        self.compress))
+                    f_tmp.flush()
+                    os.fsync(f_tmp.fileno())
+                os.rename(tmp_path, self.path)
+                tmp_path = self.journal_path + '.tmp'
+                with open(tmp_path, 'w') as f_tmp:
+                    os.fsync(f_tmp.fileno())
+                os.rename(tmp_path, self.journal_path)
+                fsync_dir(self.path)
+                # Everything in the old journal is in the snapshot now
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+                self.unsynced = 0
+                self.signature = tinydb_nosql.file_signature(self.path)
+                self.journal_inode = \
+                    tinydb_nosql.file_signature(self.journal_path)[0]
+                self.offset = 0
+
+    def compaction_due(self):
+        '''Checks if the journal grew large enough to be compacted'''
+        journal = tinydb_nosql.file_signature(self.journal_path)
+        return journal is not None and journal[1] >= self.compact_size
+
+    def start_worker(self):
+        '''Starts the background sync and compaction thread'''
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self.run_worker,
+                                           name='hostpool-journal')
+            self.worker.daemon = True
+            self.worker.start()
+
+    def run_worker(self):
+        '''Background thread syncing and compacting the journal'''
+        last_compact = time.time()
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                with self.lock:
+                    self.sync()
+                if time.time() - last_compact >= self.compact_interval:
+                    last_compact = time.time()
+                    if self.compaction_due():
+                        self.compact()
+            except (IOError, OSError, ValueError) as ex:
+                self.logger.error(
+                    'Journal maintenance of "{0}" failed: {1}'.format(
+                        self.path, ex))
+
+
+class Database(tinydb_nosql.Database):
+    '''
+    Storage wrapper for TinyDB NoSQL DB, writing mutations to a journal
+    '''
+    handle_class = JournalHandle
+
+    def __init__(self, storage=None, sync_every=SYNC_EVERY,
+                 sync_interval=SYNC_INTERVAL, compact_size=COMPACT_SIZE,
+                 compact_interval=COMPACT_INTERVAL, serializer=None,
+                 compress=False, durability=None):
+        super(Database, self).__init__(storage, serializer=serializer,
+                                       compress=compress,
+                                       durability=durability)
+        self._handle.sync_every = sync_every
+        self._handle.sync_interval = sync_interval
+        self._handle.compact_size = compact_size
+        self._handle.compact_interval = compact_interval
+        self._handle.start_worker()
+
+    @tinydb_nosql.locked
+    def init_data(self):
+        '''Wipes all data'''
+        with self._handle.lock:
+            super(Database, self).init_data()
+            self._handle.append([{'op': OP_PURGE}])
+
+    @tinydb_nosql.locked
+    def add_hosts(self, hosts):
+        '''Adds multiple host entries to the database
+
+        :param list hosts: List of host objects to add to the database
+        :returns: List of new host IDs (integers)
+        :rtype: list
+        '''
+        with self._handle.lock:
+            host_ids = super(Database, self).add_hosts(hosts)
+            self._handle.append([
+                {'op': OP_INSERT, 'id': eid, 'host': host}
+                for eid, host in zip(host_ids, hosts)])
+            return host_ids
+
+    @tinydb_nosql.locked
+    def update_host(self, eid, host, version=None):
+        '''Updates an existing host in the database
+
+        :param int eid: Host ID of the host to update
+        :param dict host: Host keys to update
+        :param int version: Version the host must be at (optional)
+        :returns: Host ID that was updated (or None)
+        :rtype: int
+        '''
+        with self._handle.lock:
+            host_id = super(Database, self).update_host(eid, host, version)
+            if host_id is not None:
+                self._handle.append([
+                    {'op': OP_UPDATE, 'id': host_id, 'host': host}])
+            return host_id
+
+    @tinydb_nosql.locked
+    def remove_host(self, eid):
+        '''Removes an existing host from the database
+
+        :param int eid: Host ID of the host to remove
+        :returns: Host ID that was removed (or None if not found)
+        :rtype: int
+        '''
+        with self._handle.lock:
+            host_id = super(Database, self).remove_host(eid)
+            if host_id is not None:
+                self._handle.append([{'op': OP_REMOVE, 'id': host_id}])
+            return host_id
+
+    @tinydb_nosql.locked
+    def update_hosts(self, eids, patch):
+        '''Updates multiple existing hosts with a single journal record
+
+        :param list eids: Host IDs of the hosts to update
+        :param dict patch: Partial host object to merge into each host
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        with self._handle.lock:
+            host_ids = super(Database, self).update_hosts(eids, patch)
+            if host_ids:
+                self._handle.append([
+                    {'op': OP_MERGE, 'ids': host_ids, 'host': patch}])
+            return host_ids
+
+    @tinydb_nosql.locked
+    def remove_hosts(self, eids):
+        '''Removes multiple existing hosts with a single journal record
+
+        :param list eids: Host IDs of the hosts to remove
+        :returns: List of host IDs that were removed
+        :rtype: list
+        '''
+        with self._handle.lock:
+            host_ids = super(Database, self).remove_hosts(eids)
+            if host_ids:
+                self._handle.append([{'op': OP_REMOVE, 'ids': host_ids}])
+            return host_ids
+
+    @tinydb_nosql.locked
+    def set_alive(self, eids, alive, last_seen=None):
+        '''Records whether hosts are alive, with a single journal record
+
+        :param list eids: Host IDs of the hosts checked
+        :param bool alive: If the hosts are alive
+        :param int last_seen: Time the hosts were seen alive (optional)
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        with self._handle.lock:
+            host_ids = super(Database, self).set_alive(eids, alive,
+                                                       last_seen)
+            if host_ids:
+                patch = {'alive': alive}
+                if last_seen is not None:
+                    patch[constants.HOST_LAST_SEEN_KEY] = last_seen
+                self._handle.append([
+                    {'op': OP_MERGE, 'ids': host_ids, 'host': patch}])
+            return host_ids
+
+    @tinydb_nosql.locked
+    def add_credentials(self, credentials):
+        '''Stores credentials by their content hash, in one journal record
+
+        :param dict credentials: Mapping of content hashes to credentials
+        :returns: The credentials that weren't stored yet
+        :rtype: dict
+        '''
+        with self._handle.lock:
+            added = super(Database, self).add_credentials(credentials)
+            if added:
+                self._handle.append([
+                    {'op': OP_CREDENTIALS, 'credentials': added}])
+            return added
+
+    @tinydb_nosql.locked
+    def allocate_if_free(self, eid):
+        '''Marks a host as allocated, if it isn't already
+
+        :param int eid: Host ID of the host to allocate
+        :returns: The allocated host object (or an empty dict)
+        :rtype: dict
+        '''
+        with self._handle.lock:
+            host = super(Database, self).allocate_if_free(eid)
+            if host:
+                self._handle.append([{'op': OP_UPDATE, 'id': eid,
+                                      'host': {'allocated': True}}])
+            return host
+
+    @tinydb_nosql.locked
+    def release(self, eid):
+        '''Marks a host as not allocated
+
+        :param int eid: Host ID of the host to release
+        :returns: The released host object (or an empty dict)
+        :rtype: dict
+        '''
+        with self._handle.lock:
+            host = super(Database, self).release(eid)
+            if host:
+                self._handle.append([{'op': OP_UPDATE, 'id': eid,
+                                      'host': {'allocated': False}}])
+            return host
+
+    @tinydb_nosql.locked
+    def allocate_hosts(self, eids):
+        '''Marks the hosts that aren't allocated already as allocated
+
+        :param list eids: Host IDs of the hosts to allocate
+        :returns: The allocated host objects
+        :rtype: list
+        '''
+        with self._handle.lock:
+            hosts = super(Database, self).allocate_hosts(eids)
+            if hosts:
+                self._handle.append([{
+                    'op': OP_UPDATE, 'id': x[constants.HOST_ID_KEY],
+                    'host': {'allocated': True}} for x in hosts])
+            return hosts
+
+    @tinydb_nosql.locked
+    def release_hosts(self, eids):
+        '''Marks hosts as not allocated
+
+        :param list eids: Host IDs of the hosts to release
+        :returns: The released host objects
+        :rtype: list
+        '''
+        with self._handle.lock:
+            hosts = super(Database, self).release_hosts(eids)
+            if hosts:
+                self._handle.append([{
+                    'op': OP_UPDATE, 'id': x[constants.HOST_ID_KEY],
+                    'host': {'allocated': False}} for x in hosts])
+            return hosts
+
+    def close(self):
+        '''fsyncs any journal records written so far'''
+        with self._handle.lock:
+            self._handle.sync()
+
+    def compact(self):
+        '''Folds the journal into the snapshot now'''
+        self._handle.compact()
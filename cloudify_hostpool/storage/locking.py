@@ -0,0 +1,167 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.locking
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Shared / exclusive (reader / writer) locking of database files
+'''
+
+import os
+import time
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from .. import exceptions
+from .. import metrics
+
+LOCK_SUFFIX = '.lck'
+# Longest sleep between attempts to take a lock with a bounded wait
+MAX_POLL_INTERVAL = 0.05
+
+# Lock wait budget (seconds) left to the operation of each thread
+_BUDGET = threading.local()
+
+
+@contextmanager
+def wait_budget(seconds):
+    '''Bounds the total time the calling thread waits for locks
+
+    Lock acquisitions that would exceed the budget raise
+    `LockTimeoutException`. Nested budgets are part of the outer one.
+
+    :param float seconds: Wait budget (None waits forever)
+    '''
+    if getattr(_BUDGET, 'active', False):
+        yield
+        return
+    _BUDGET.active, _BUDGET.seconds = True, seconds
+    try:
+        yield
+    finally:
+        _BUDGET.active, _BUDGET.seconds = False, None
+
+
+@contextmanager
+def without_budget():
+    '''Lifts the lock wait budget of the calling thread, for work that
+    must not be left half done (such as rolling back an operation)'''
+    saved = (getattr(_BUDGET, 'active', False),
+             getattr(_BUDGET, 'seconds', None))
+    # Active, so that nested budgets don't bound the waits either
+    _BUDGET.active, _BUDGET.seconds = True, None
+    try:
+        yield
+    finally:
+        _BUDGET.active, _BUDGET.seconds = saved
+
+
+def remaining_budget():
+    '''Returns the lock wait budget left (or None if unbounded)'''
+    return getattr(_BUDGET, 'seconds', None)
+
+
+def spend_budget(waited):
+    '''Deducts a lock wait from the budget of the calling thread'''
+    seconds = remaining_budget()
+    if seconds is not None:
+        _BUDGET.seconds = max(0.0, seconds - waited)
+
+
+class RWLock(object):
+    '''
+    Reader / writer lock of a database file, shared by threads and
+    processes, built on flock() of a lock file next to the database.
+
+    Any number of readers hold the lock at once, writers hold it alone.
+    Every acquisition opens the lock file, so that threads of a process
+    exclude each other like processes do. Nested acquisitions by the
+    thread holding the lock are free, except that a shared lock can't
+    be upgraded to an exclusive one. Outermost acquisitions are timed,
+    as "<name>.shared" and "<name>.exclusive" locks (see
+    `cloudify_hostpool.metrics`), and bounded by the lock wait budget of
+    the calling thread (see `wait_budget`).
+    '''
+    def __init__(self, path, name='database'):
+        self.path = path
+        self.name = name
+        self.local = threading.local()
+
+    @property
+    def held(self):
+        '''The lock mode held by this thread (or None)'''
+        return getattr(self.local, 'mode', None)
+
+    @contextmanager
+    def acquire(self, mode):
+        '''Holds the lock in a mode (fcntl.LOCK_SH or fcntl.LOCK_EX)'''
+        if self.held is not None:
+            if mode == fcntl.LOCK_EX and self.held != fcntl.LOCK_EX:
+                raise RuntimeError(
+                    'A shared lock of "{0}" cannot be upgraded'.format(
+                        self.path))
+            yield
+            return
+        name = '{0}.{1}'.format(
+            self.name, 'exclusive' if mode == fcntl.LOCK_EX else 'shared')
+        with metrics.timed(name, self._flock(mode)):
+            self.local.mode = mode
+            try:
+                yield
+            finally:
+                self.local.mode = None
+
+    @contextmanager
+    def _flock(self, mode):
+        '''Holds the lock file locked in a mode'''
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self._lock(fd, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def _lock(self, fd, mode):
+        '''flock()s a file, within the lock wait budget'''
+        timeout = remaining_budget()
+        if timeout is None:
+            fcntl.flock(fd, mode)
+            return
+        start = time.time()
+        interval = 0.001
+        while True:
+            try:
+                fcntl.flock(fd, mode | fcntl.LOCK_NB)
+                break
+            except (IOError, OSError):
+                waited = time.time() - start
+                if waited >= timeout:
+                    spend_budget(waited)
+                    raise exceptions.LockTimeoutException(self.name, waited)
+                time.sleep(min(interval, timeout - waited))
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+        spend_budget(time.time() - start)
+
+    def shared(self):
+        '''Holds the lock along with other readers'''
+        return self.acquire(fcntl.LOCK_SH)
+
+    def exclusive(self):
+        '''Holds the lock alone'''
+        return self.acquire(fcntl.LOCK_EX)
@@ -0,0 +1,210 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.serializers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Serialization formats of the storage files
+
+    Storage files are written in one of the following formats, and the
+    format of an existing file is detected when it is loaded:
+
+    - json: Plain JSON, the original TinyDB file format
+    - fastjson: Plain JSON written (and read) by orjson or ujson if
+      installed, falling back to the json module otherwise
+    - marshal: Compact binary format of the marshal module, prefixed
+      with MAGIC_MARSHAL
+
+    Any of them can be zlib compressed, prefixed with MAGIC_ZLIB.
+
+    Run this module to benchmark the formats on generated host data.
+'''
+
+import sys
+import json
+import time
+import zlib
+import marshal
+import argparse
+
+from .. import exceptions
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+FORMAT_JSON = 'json'
+FORMAT_FAST_JSON = 'fastjson'
+FORMAT_MARSHAL = 'marshal'
+FORMATS = [FORMAT_JSON, FORMAT_FAST_JSON, FORMAT_MARSHAL]
+
+MAGIC_MARSHAL = b'HPM\x01'
+MAGIC_ZLIB = b'HPZ\x01'
+# Marshal format version (Python 3.4+), shares repeated strings
+MARSHAL_VERSION = 4
+
+
+def _json_dumps(data):
+    '''Serializes to JSON with the fastest available encoder'''
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    if ujson is not None:
+        return ujson.dumps(data).encode('utf-8')
+    return json.dumps(data).encode('utf-8')
+
+
+def _json_loads(payload):
+    '''Deserializes JSON with the fastest available decoder'''
+    if orjson is not None:
+        return orjson.loads(payload)
+    if ujson is not None:
+        return ujson.loads(payload.decode('utf-8'))
+    return json.loads(payload.decode('utf-8'))
+
+
+def _marshal_dumps(data):
+    '''Serializes a TinyDB style {table: {id: document}} mapping
+
+    Marshal only handles exact built-in types, so the tables and their
+    documents (dict subclasses) are converted to plain dicts first.
+    '''
+    data = dict((name, dict((key, dict(doc)) for key, doc in table.items())
+                 if isinstance(table, dict) else table)
+                for name, table in data.items())
+    return MAGIC_MARSHAL + marshal.dumps(data, MARSHAL_VERSION)
+
+
+def validate(fmt):
+    '''Checks a serialization format name'''
+    if fmt not in FORMATS:
+        raise exceptions.ConfigurationError(
+            'Unknown storage serializer "{0}"'.format(fmt))
+    return fmt
+
+
+def dumps(data, fmt=FORMAT_JSON, compress=False):
+    '''Serializes storage data
+
+    :param dict data: Storage data
+    :param str fmt: Serialization format (see FORMATS)
+    :param bool compress: zlib compress the serialized data
+    :returns: Serialized data
+    :rtype: bytes
+    '''
+    if validate(fmt) == FORMAT_MARSHAL:
+        payload = _marshal_dumps(data)
+    elif fmt == FORMAT_FAST_JSON:
+        payload = _json_dumps(data)
+    else:
+        payload = json.dumps(data).encode('utf-8')
+    if compress:
+        payload = MAGIC_ZLIB + zlib.compress(payload, 1)
+    return payload
+
+
+def loads(payload):
+    '''Deserializes storage data of any format
+
+    :param bytes payload: Serialized data
+    :returns: Storage data (or None for empty data)
+    :rtype: dict
+    '''
+    if payload.startswith(MAGIC_ZLIB):
+        payload = zlib.decompress(payload[len(MAGIC_ZLIB):])
+    if payload.startswith(MAGIC_MARSHAL):
+        return marshal.loads(payload[len(MAGIC_MARSHAL):])
+    if not payload.strip():
+        return None
+    return _json_loads(payload)
+
+
+def load_file(path):
+    '''Reads a storage file of any format'''
+    with open(path, 'rb') as f_db:
+        return loads(f_db.read())
+
+
+def _generate_data(count):
+    '''Generates TinyDB style data of a pool of hosts'''
+    return {'hosts': dict((str(idx + 1), {
+        'name': 'host-{0}'.format(idx),
+        'os': 'linux',
+        'endpoint': {'ip': '10.{0}.{1}.{2}'.format(
+            idx >> 16, (idx >> 8) & 255, idx & 255),
+            'port': 22, 'protocol': 'ssh'},
+        'credentials': {'$ref': '{0:064x}'.format(idx % 4)},
+        'tags': ['rack-{0}'.format(idx % 40), 'all'],
+        'allocated': bool(idx % 3),
+        'alive': True
+    }) for idx in range(count))}
+
+
+def benchmark(count, rounds=5):
+    '''Measures dump and load times of every format
+
+    :param int count: Number of hosts in the benchmark data
+    :param int rounds: Best of this many rounds is reported
+    :returns: (format, compressed, size, dump seconds, load seconds) rows
+    :rtype: list
+    '''
+    data = _generate_data(count)
+    rows = list()
+    for fmt in FORMATS:
+        for compress in [False, True]:
+            dump_times, load_times = list(), list()
+            for _ in range(rounds):
+                start = time.time()
+                payload = dumps(data, fmt, compress)
+                dump_times.append(time.time() - start)
+                start = time.time()
+                loads(payload)
+                load_times.append(time.time() - start)
+            rows.append((fmt, compress, len(payload),
+                         min(dump_times), min(load_times)))
+    return rows
+
+
+def main(argv=None):
+    '''Benchmarks the storage file formats'''
+    parser = argparse.ArgumentParser(
+        description='Benchmark the host-pool storage file formats')
+    parser.add_argument('--hosts', type=int, default=20000,
+                        help='Number of hosts (default: %(default)s)')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Report the best of this many rounds '
+                             '(default: %(default)s)')
+    args = parser.parse_args(argv)
+    fast = 'orjson' if orjson else 'ujson' if ujson else 'json fallback'
+    sys.stdout.write('{0} hosts, fastjson uses {1}\n'.format(
+        args.hosts, fast))
+    row = '{0:<10} {1:<5} {2:>12} {3:>10} {4:>10}\n'
+    sys.stdout.write(row.format(
+        'format', 'zlib', 'bytes', 'dump ms', 'load ms'))
+    for fmt, compress, size, dump_time, load_time in benchmark(
+            args.hosts, args.rounds):
+        sys.stdout.write(row.format(
+            fmt, 'yes' if compress else 'no', size,
+            '{0:.1f}'.format(dump_time * 1000),
+            '{0:.1f}'.format(load_time * 1000)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
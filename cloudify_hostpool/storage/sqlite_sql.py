@@ -0,0 +1,620 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.sqlite_sql
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    SQLite storage interface for the RESTful service
+'''
+
+import os
+import sys
+import json
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+
+from .. import constants
+from .. import exceptions
+from ..storage import serializers
+from ..storage.base import Storage
+from ..storage.durability import (
+    DURABILITY_STRICT, DURABILITY_INTERVAL, DURABILITY_NONE,
+    validate as validate_durability)
+from ..utils import dict_update, select_fields
+
+DB_FILENAME = 'db_hostpool.sqlite'
+TBL_HOSTS = 'hosts'
+# Same name as the TinyDB credentials table, for the importer
+TBL_CREDENTIALS = 'credentials'
+# Seconds to wait for a concurrent writer before failing
+BUSY_TIMEOUT = 30
+# SQLite synchronous setting of each durability policy. In WAL mode
+# NORMAL only fsyncs at checkpoints, a crash may lose the last commits.
+SYNCHRONOUS = {
+    DURABILITY_STRICT: 'FULL',
+    DURABILITY_INTERVAL: 'NORMAL',
+    DURABILITY_NONE: 'OFF',
+}
+
+# The full host document (but its version) is kept as JSON in
+# "document", the other columns are derived from it so they can be
+# indexed
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT,
+    os TEXT,
+    allocated INTEGER NOT NULL DEFAULT 0,
+    alive INTEGER NOT NULL DEFAULT 0,
+    ip TEXT,
+    port INTEGER,
+    document TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ix_hosts_allocated ON hosts (allocated);
+CREATE INDEX IF NOT EXISTS ix_hosts_os ON hosts (os);
+CREATE INDEX IF NOT EXISTS ix_hosts_endpoint ON hosts (ip, port);
+CREATE TABLE IF NOT EXISTS host_tags (
+    host_id INTEGER NOT NULL REFERENCES hosts (id),
+    tag TEXT NOT NULL,
+    PRIMARY KEY (tag, host_id)
+);
+CREATE INDEX IF NOT EXISTS ix_host_tags_host ON host_tags (host_id);
+CREATE TABLE IF NOT EXISTS credentials (
+    ref TEXT PRIMARY KEY,
+    document TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    revision INTEGER PRIMARY KEY,
+    host_id INTEGER,
+    op TEXT NOT NULL
+);
+'''
+
+
+def host_columns(host):
+    '''Derives the indexed column values of a host document
+
+    :param dict host: Host object
+    :returns: (name, os, allocated, alive, ip, port) values
+    :rtype: tuple
+    '''
+    endpoint = host.get('endpoint')
+    if not isinstance(endpoint, dict):
+        endpoint = dict()
+    return (host.get('name'),
+            (host.get('os') or '').lower() or None,
+            1 if host.get('allocated') else 0,
+            1 if host.get('alive') else 0,
+            endpoint.get('ip'),
+            endpoint.get('port'))
+
+
+def host_tags(host):
+    '''Returns the unique, valid tags of a host document'''
+    tags = host.get('tags')
+    if not isinstance(tags, list):
+        return set()
+    return set(x for x in tags if x is not None)
+
+
+class Database(Storage):
+    '''
+    Storage wrapper for SQLite implementing AbstractStorage interface
+    '''
+    def __init__(self, storage=None, durability=None):
+        self.db_filename = storage or DB_FILENAME
+        self.synchronous = SYNCHRONOUS[validate_durability(
+            durability or DURABILITY_STRICT)]
+        self.tbl_hosts = TBL_HOSTS
+        self._local = threading.local()
+        with self.connect() as dbc:
+            dbc.executescript(SCHEMA)
+            # Databases created before hosts were versioned
+            columns = [x[1] for x in dbc.execute('PRAGMA table_info(hosts)')]
+            if 'version' not in columns:
+                dbc.execute('ALTER TABLE hosts ADD COLUMN '
+                            'version INTEGER NOT NULL DEFAULT 0')
+
+    def _new_connection(self):
+        '''Opens and configures a new database connection'''
+        conn = sqlite3.connect(self.db_filename,
+                               timeout=BUSY_TIMEOUT,
+                               isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous={0}'.format(self.synchronous))
+        return conn
+
+    @contextmanager
+    def connect(self):
+        '''Get a connection to the database
+
+        Connections are kept per thread (and per process, since gunicorn
+        forks its workers after the application may have been loaded).
+        '''
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._new_connection()
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        yield conn
+
+    @contextmanager
+    def transaction(self):
+        '''Get a connection inside of an exclusive write transaction'''
+        with self.connect() as dbc:
+            dbc.execute('BEGIN IMMEDIATE')
+            try:
+                yield dbc
+            except Exception:
+                dbc.execute('ROLLBACK')
+                raise
+            dbc.execute('COMMIT')
+
+    def close(self):
+        '''Closes the connection of the calling thread'''
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @staticmethod
+    def _to_host(row, fields=None):
+        '''Converts an (id, document, version) row to a host object'''
+        if not row:
+            return dict()
+        host = json.loads(row[1])
+        host[constants.HOST_VERSION_KEY] = row[2]
+        if fields is not None:
+            host = select_fields(host, fields)
+        host[constants.HOST_ID_KEY] = row[0]
+        return host
+
+    @staticmethod
+    def _to_document(host):
+        '''Converts a host object to its stored JSON document'''
+        host = dict(host)
+        host.pop(constants.HOST_ID_KEY, None)
+        host.pop(constants.HOST_VERSION_KEY, None)
+        return json.dumps(host)
+
+    @staticmethod
+    def _set_tags(dbc, eid, host):
+        '''Replaces the tag rows of a host'''
+        dbc.execute('DELETE FROM host_tags WHERE host_id = ?', (eid,))
+        dbc.executemany(
+            'INSERT INTO host_tags (host_id, tag) VALUES (?, ?)',
+            [(eid, tag) for tag in host_tags(host)])
+
+    @staticmethod
+    def _insert_host(dbc, host, eid=None):
+        '''Inserts a host row (and its tags), returns the host ID'''
+        cur = dbc.execute(
+            'INSERT INTO hosts '
+            '(id, name, os, allocated, alive, ip, port, document) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (eid,) + host_columns(host) + (Database._to_document(host),))
+        Database._set_tags(dbc, cur.lastrowid, host)
+        return cur.lastrowid
+
+    @staticmethod
+    def _log_changes(dbc, eids, op):
+        '''Records changed hosts in the change log, one revision each,
+        and versions them with it'''
+        revision = dbc.execute(
+            'SELECT COALESCE(MAX(revision), 0) FROM changes').fetchone()[0]
+        changes = [(revision + idx + 1, eid, op)
+                   for idx, eid in enumerate(eids)]
+        dbc.executemany(
+            'INSERT INTO changes (revision, host_id, op) VALUES (?, ?, ?)',
+            changes)
+        dbc.executemany('UPDATE hosts SET version = ? WHERE id = ?',
+                        [x[:2] for x in changes])
+        dbc.execute('DELETE FROM changes WHERE revision <= ?',
+                    (revision + len(eids) - constants.CHANGE_LOG_SIZE,))
+
+    def init_data(self):
+        '''Wipes all data'''
+        with self.transaction() as dbc:
+            dbc.execute('DELETE FROM host_tags')
+            dbc.execute('DELETE FROM hosts')
+            dbc.execute('DELETE FROM credentials')
+            # Restart host IDs from 1, as TinyDB does on purge
+            dbc.execute('DELETE FROM sqlite_sequence WHERE name = ?',
+                        (self.tbl_hosts,))
+            # The revision carries on, so readers notice the purge
+            self._log_changes(dbc, [None], constants.CHANGE_PURGE)
+
+    def get_host(self, eid, fields=None):
+        '''Retrieves a single, specified host
+
+        :param int eid: Host ID of the host to retrieve
+        :param list fields: Optional top level fields to return
+        :returns: Host object
+        :rtype: dict
+        '''
+        with self.connect() as dbc:
+            return self._to_host(dbc.execute(
+                'SELECT id, document, version FROM hosts WHERE id = ?',
+                (eid,)).fetchone(), fields)
+
+    def get_host_version(self, eid):
+        '''Retrieves the version of a host
+
+        :param int eid: Host ID of the host
+        :returns: Host version (or None if the host doesn't exist)
+        :rtype: int
+        '''
+        with self.connect() as dbc:
+            row = dbc.execute('SELECT version FROM hosts WHERE id = ?',
+                              (eid,)).fetchone()
+        return row[0] if row else None
+
+    def get_hosts(self, filters=None, fields=None):
+        '''Retrieves host entries from the database
+
+        Filters are evaluated on the indexed columns and tag table.
+
+        :param dict filters: Optional filters to apply
+        :param list fields: Optional top level fields to return
+        :returns: A list of host entries from the database
+        :rtype: list
+        '''
+        filters = filters or dict()
+        clauses, params = list(), list()
+        if filters.get('os') is not None:
+            clauses.append('os = ?')
+            params.append(filters['os'].lower())
+        if filters.get('allocated') is not None:
+            clauses.append('allocated = ?')
+            params.append(1 if filters['allocated'] else 0)
+        if filters.get('ids') is not None:
+            # Inlined (as integers), there may be more than the maximum
+            # number of query parameters
+            clauses.append('id IN ({0})'.format(', '.join(
+                str(int(x)) for x in set(filters['ids'])) or 'NULL'))
+        tags = set(filters.get('tags') or list())
+        if tags:
+            clauses.append(
+                'id IN (SELECT host_id FROM host_tags WHERE tag IN ({0}) '
+                'GROUP BY host_id HAVING COUNT(*) = ?)'.format(
+                    ', '.join('?' * len(tags))))
+            params.extend(tags)
+            params.append(len(tags))
+        query = 'SELECT id, document, version FROM hosts'
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        with self.connect() as dbc:
+            return [self._to_host(x, fields) for x in dbc.execute(
+                query + ' ORDER BY id', params)]
+
+    def get_host_ids_by_endpoint(self, endpoints):
+        '''Looks up existing hosts by their (ip, port) endpoint
+
+        :param list endpoints: List of (ip, port) tuples
+        :returns: Mapping of existing (ip, port) tuples to host IDs
+        :rtype: dict
+        '''
+        found = dict()
+        with self.connect() as dbc:
+            for endpoint in endpoints:
+                row = dbc.execute(
+                    'SELECT MIN(id) FROM hosts WHERE ip = ? AND port = ?',
+                    tuple(endpoint)).fetchone()
+                if row and row[0] is not None:
+                    found[tuple(endpoint)] = row[0]
+        return found
+
+    def add_hosts(self, hosts):
+        '''Adds multiple host entries to the database
+
+        :param list hosts: List of host objects to add to the database
+        :returns: List of new host IDs (integers)
+        :rtype: list
+        '''
+        with self.transaction() as dbc:
+            host_ids = [self._insert_host(dbc, x) for x in hosts]
+            self._log_changes(dbc, host_ids, constants.CHANGE_ADD)
+            return host_ids
+
+    def update_host(self, eid, host, version=None):
+        '''Updates an existing host in the database
+
+        Only the updated row (and its tags, if changed) is written.
+
+        :param int eid: Host ID of the host to update
+        :param dict host: Host keys to update
+        :param int version: Version the host must be at (optional)
+        :returns: Host ID that was updated (or None)
+        :rtype: int
+        '''
+        with self.transaction() as dbc:
+            row = dbc.execute('SELECT document, version FROM hosts '
+                              'WHERE id = ?', (eid,)).fetchone()
+            if not row or (version is not None and row[1] != version):
+                return None
+            doc = json.loads(row[0])
+            doc.update(host)
+            dbc.execute(
+                'UPDATE hosts SET name = ?, os = ?, allocated = ?, '
+                'alive = ?, ip = ?, port = ?, document = ? WHERE id = ?',
+                host_columns(doc) + (self._to_document(doc), eid))
+            if 'tags' in host:
+                self._set_tags(dbc, eid, doc)
+            self._log_changes(dbc, [eid], constants.CHANGE_UPDATE)
+            return eid
+
+    def remove_host(self, eid):
+        '''Removes an existing host from the database
+
+        :param int eid: Host ID of the host to remove
+        :returns: Host ID that was removed (or None if not found)
+        :rtype: int
+        '''
+        with self.transaction() as dbc:
+            dbc.execute('DELETE FROM host_tags WHERE host_id = ?', (eid,))
+            if not dbc.execute('DELETE FROM hosts WHERE id = ?',
+                               (eid,)).rowcount:
+                return None
+            self._log_changes(dbc, [eid], constants.CHANGE_REMOVE)
+            return eid
+
+    def update_hosts(self, eids, patch):
+        '''Updates multiple existing hosts in a single transaction
+
+        :param list eids: Host IDs of the hosts to update
+        :param dict patch: Partial host object to merge into each host
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        host_ids = []
+        with self.transaction() as dbc:
+            for eid in eids:
+                row = dbc.execute('SELECT document FROM hosts WHERE id = ?',
+                                  (eid,)).fetchone()
+                if not row:
+                    continue
+                doc = dict_update(json.loads(row[0]), patch)
+                dbc.execute(
+                    'UPDATE hosts SET name = ?, os = ?, allocated = ?, '
+                    'alive = ?, ip = ?, port = ?, document = ? '
+                    'WHERE id = ?',
+                    host_columns(doc) + (self._to_document(doc), eid))
+                if 'tags' in patch:
+                    self._set_tags(dbc, eid, doc)
+                host_ids.append(eid)
+            self._log_changes(dbc, host_ids, constants.CHANGE_UPDATE)
+        return host_ids
+
+    def remove_hosts(self, eids):
+        '''Removes multiple existing hosts in a single transaction
+
+        :param list eids: Host IDs of the hosts to remove
+        :returns: List of host IDs that were removed
+        :rtype: list
+        '''
+        host_ids = []
+        with self.transaction() as dbc:
+            for eid in eids:
+                dbc.execute('DELETE FROM host_tags WHERE host_id = ?',
+                            (eid,))
+                if dbc.execute('DELETE FROM hosts WHERE id = ?',
+                               (eid,)).rowcount:
+                    host_ids.append(eid)
+            self._log_changes(dbc, host_ids, constants.CHANGE_REMOVE)
+        return host_ids
+
+    def set_alive(self, eids, alive, last_seen=None):
+        '''Records whether hosts are alive, in a single transaction
+
+        The change log and the host versions are left as they are.
+
+        :param list eids: Host IDs of the hosts checked
+        :param bool alive: If the hosts are alive
+        :param int last_seen: Time the hosts were seen alive (optional)
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        host_ids = []
+        with self.transaction() as dbc:
+            for eid in eids:
+                row = dbc.execute('SELECT document FROM hosts WHERE id = ?',
+                                  (eid,)).fetchone()
+                if not row:
+                    continue
+                doc = json.loads(row[0])
+                doc['alive'] = alive
+                if last_seen is not None:
+                    doc[constants.HOST_LAST_SEEN_KEY] = last_seen
+                dbc.execute(
+                    'UPDATE hosts SET alive = ?, document = ? WHERE id = ?',
+                    (1 if alive else 0, json.dumps(doc), eid))
+                host_ids.append(eid)
+        return host_ids
+
+    def add_credentials(self, credentials):
+        '''Stores credentials by their content hash, in one transaction
+
+        :param dict credentials: Mapping of content hashes to credentials
+        '''
+        with self.transaction() as dbc:
+            dbc.executemany(
+                'INSERT OR IGNORE INTO credentials (ref, document) '
+                'VALUES (?, ?)',
+                [(ref, json.dumps(creds))
+                 for ref, creds in credentials.items()])
+
+    def get_credentials(self, ref):
+        '''Retrieves stored credentials by content hash
+
+        :param str ref: Content hash of the credentials
+        :returns: Credentials object (or an empty dict)
+        :rtype: dict
+        '''
+        with self.connect() as dbc:
+            row = dbc.execute('SELECT document FROM credentials '
+                              'WHERE ref = ?', (ref,)).fetchone()
+        return json.loads(row[0]) if row else dict()
+
+    def get_revision(self):
+        '''Retrieves the revision of the host pool
+
+        :returns: Pool revision
+        :rtype: int
+        '''
+        with self.connect() as dbc:
+            return dbc.execute('SELECT COALESCE(MAX(revision), 0) '
+                               'FROM changes').fetchone()[0]
+
+    def get_changes(self, since):
+        '''Retrieves the changes made after a revision
+
+        :param int since: Revision the caller is up to date with
+        :returns: The changes after `since`, or None if some of them
+                  are no longer kept
+        :rtype: list
+        '''
+        with self.connect() as dbc:
+            rows = dbc.execute(
+                'SELECT revision, host_id, op FROM changes '
+                'WHERE revision > ? ORDER BY revision', (since,)).fetchall()
+        if not rows:
+            return list() if since <= self.get_revision() else None
+        if rows[0][0] != since + 1:
+            return None
+        return [{'revision': x[0], 'id': x[1], 'op': x[2]} for x in rows]
+
+    def _set_allocated(self, eids, allocated, only_if=None):
+        '''Sets the allocation state of hosts in a single transaction
+
+        :returns: The changed host objects
+        :rtype: list
+        '''
+        with self.transaction() as dbc:
+            changed = list()
+            for eid in eids:
+                row = dbc.execute(
+                    'SELECT document, allocated FROM hosts WHERE id = ?',
+                    (eid,)).fetchone()
+                if not row or \
+                   (only_if is not None and bool(row[1]) != only_if):
+                    continue
+                doc = json.loads(row[0])
+                doc['allocated'] = allocated
+                dbc.execute(
+                    'UPDATE hosts SET allocated = ?, document = ? '
+                    'WHERE id = ?',
+                    (1 if allocated else 0, json.dumps(doc), eid))
+                changed.append(eid)
+            if changed:
+                self._log_changes(dbc, changed, constants.CHANGE_UPDATE)
+            return [self.get_host(eid) for eid in changed]
+
+    def allocate_if_free(self, eid):
+        '''Marks a host as allocated, if it isn't already
+
+        :param int eid: Host ID of the host to allocate
+        :returns: The allocated host object (or an empty dict)
+        :rtype: dict
+        '''
+        hosts = self._set_allocated([eid], True, only_if=False)
+        return hosts[0] if hosts else dict()
+
+    def release(self, eid):
+        '''Marks a host as not allocated
+
+        :param int eid: Host ID of the host to release
+        :returns: The released host object (or an empty dict)
+        :rtype: dict
+        '''
+        hosts = self._set_allocated([eid], False)
+        return hosts[0] if hosts else dict()
+
+    def allocate_hosts(self, eids):
+        '''Marks the hosts that aren't allocated already as allocated, in
+        a single transaction
+
+        :param list eids: Host IDs of the hosts to allocate
+        :returns: The allocated host objects
+        :rtype: list
+        '''
+        return self._set_allocated(eids, True, only_if=False)
+
+    def release_hosts(self, eids):
+        '''Marks hosts as not allocated, in a single transaction
+
+        :param list eids: Host IDs of the hosts to release
+        :returns: The released host objects
+        :rtype: list
+        '''
+        return self._set_allocated(eids, False)
+
+    def import_json(self, filename):
+        '''One-shot import of an existing TinyDB database (of any format)
+
+        Host IDs are preserved and every imported host is logged as
+        added. The import is refused if this database already contains
+        hosts.
+
+        :param str filename: Path to the TinyDB JSON file
+        :returns: List of imported host IDs (integers)
+        :rtype: list
+        '''
+        data = serializers.load_file(filename) or dict()
+        hosts = data.get(self.tbl_hosts) or dict()
+        credentials = data.get(TBL_CREDENTIALS) or dict()
+        if not isinstance(hosts, dict) or \
+           not isinstance(credentials, dict):
+            raise exceptions.StorageException(
+                'Invalid TinyDB database file "{0}"'.format(filename))
+        with self.transaction() as dbc:
+            if dbc.execute('SELECT COUNT(*) FROM hosts').fetchone()[0]:
+                raise exceptions.StorageException(
+                    'Refusing to import into non-empty database '
+                    '"{0}"'.format(self.db_filename))
+            dbc.executemany(
+                'INSERT OR IGNORE INTO credentials (ref, document) '
+                'VALUES (?, ?)',
+                [(ref, json.dumps(creds))
+                 for ref, creds in credentials.items()])
+            host_ids = [self._insert_host(dbc, host, int(eid))
+                        for eid, host in sorted(hosts.items(),
+                                                key=lambda x: int(x[0]))]
+            self._log_changes(dbc, host_ids, constants.CHANGE_ADD)
+            return host_ids
+
+
+def main(argv=None):
+    '''Imports a TinyDB JSON database into a SQLite database'''
+    parser = argparse.ArgumentParser(
+        description='Import a host-pool TinyDB (JSON) database into SQLite')
+    parser.add_argument('source', help='TinyDB JSON database file')
+    parser.add_argument('target', nargs='?', default=DB_FILENAME,
+                        help='SQLite database file (default: %(default)s)')
+    args = parser.parse_args(argv)
+    try:
+        host_ids = Database(args.target).import_json(args.source)
+    except exceptions.StorageException as ex:
+        sys.stderr.write('{0}\n'.format(ex))
+        return 1
+    sys.stdout.write('Imported {0} hosts into "{1}"\n'.format(
+        len(host_ids), args.target))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
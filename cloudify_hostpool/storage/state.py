@@ -0,0 +1,202 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.storage.state
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Host allocation state shared by the processes (gunicorn workers)
+    using a database file
+
+    The state is a memory mapped file next to the database file, made of
+    a header and one flags byte per host ID:
+
+    - magic (4 bytes), capacity (uint32): number of host flag bytes
+    - revision (uint64): bumped on every change to the database
+    - layout (uint64): bumped on every change other than the allocated
+      and alive flags of hosts
+
+    A process whose cached hosts were read at the current layout
+    revision only needs the flags to know which hosts are free, not a
+    reload of the database file. The state is only written under the
+    database lock; the database file remains the durable record.
+'''
+
+import os
+import re
+import mmap
+import struct
+
+STATE_SUFFIX = '.state'
+MAGIC = b'HPS\x01'
+HEADER = struct.Struct('<4sIQQ')
+# Smallest number of host flag bytes allocated at once
+MIN_CAPACITY = 4096
+
+FLAG_EXISTS = 1
+FLAG_ALLOCATED = 2
+FLAG_ALIVE = 4
+# Flags bytes of hosts that exist and aren't allocated
+FREE_PATTERN = re.compile(b'[' + re.escape(bytes(bytearray([
+    FLAG_EXISTS, FLAG_EXISTS | FLAG_ALIVE]))) + b']')
+
+
+def host_flags(host):
+    '''Derives the flags byte of a host (or of a missing host)'''
+    if host is None:
+        return 0
+    flags = FLAG_EXISTS
+    if host.get('allocated'):
+        flags |= FLAG_ALLOCATED
+    if host.get('alive'):
+        flags |= FLAG_ALIVE
+    return flags
+
+
+class HostState(object):
+    '''
+    Memory mapped host flags and revision counters of a database file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.mmap = None
+        self.capacity = 0
+
+    def close(self):
+        '''Unmaps the state file'''
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+            self.capacity = 0
+
+    def _map(self, create=False):
+        '''Maps the state file, following any growth of the file
+
+        :param bool create: Create (or reset) the file if it isn't valid.
+                            Only allowed under the database lock.
+        :returns: If the state file is mapped
+        :rtype: bool
+        '''
+        if self.mmap is not None:
+            capacity = HEADER.unpack_from(self.mmap)[1]
+            if capacity == self.capacity:
+                return True
+            self.close()
+        try:
+            fd = os.open(self.path, os.O_RDWR | (os.O_CREAT if create else 0),
+                         0o644)
+        except OSError:
+            return False
+        try:
+            size = os.fstat(fd).st_size
+            if size >= HEADER.size:
+                self.mmap = mmap.mmap(fd, size)
+                if self.mmap[:4] != MAGIC:
+                    self.close()
+            if self.mmap is None:
+                if not create:
+                    return False
+                # New (or foreign) file, start with no hosts
+                size = HEADER.size + MIN_CAPACITY
+                os.ftruncate(fd, size)
+                self.mmap = mmap.mmap(fd, size)
+                self.mmap[:size] = bytes(bytearray(size))
+                HEADER.pack_into(self.mmap, 0, MAGIC, MIN_CAPACITY, 0, 0)
+        finally:
+            os.close(fd)
+        self.capacity = HEADER.unpack_from(self.mmap)[1]
+        return True
+
+    def _grow(self, capacity):
+        '''Grows the state file to hold at least capacity host IDs'''
+        capacity = max(capacity, self.capacity * 2, MIN_CAPACITY)
+        with open(self.path, 'r+b') as f_state:
+            f_state.truncate(HEADER.size + capacity)
+        self.close()
+        self._map()
+        header = list(HEADER.unpack_from(self.mmap))
+        header[1] = capacity
+        HEADER.pack_into(self.mmap, 0, *header)
+        self.capacity = capacity
+
+    def _bump(self, layout):
+        '''Increments the revision (and layout revision) counters'''
+        _, capacity, revision, layout_revision = \
+            HEADER.unpack_from(self.mmap)
+        HEADER.pack_into(self.mmap, 0, MAGIC, capacity, revision + 1,
+                         layout_revision + 1 if layout else layout_revision)
+
+    @property
+    def revision(self):
+        '''Revision counter (0 if there's no state yet)'''
+        if not self._map():
+            return 0
+        return HEADER.unpack_from(self.mmap)[2]
+
+    @property
+    def layout(self):
+        '''Layout revision counter (None if there's no state yet)'''
+        if not self._map():
+            return None
+        return HEADER.unpack_from(self.mmap)[3]
+
+    def flags(self, eid):
+        '''Returns the flags byte of a host'''
+        if not self._map() or not 0 <= eid < self.capacity:
+            return 0
+        return bytearray(self.mmap[HEADER.size + eid:
+                                   HEADER.size + eid + 1])[0]
+
+    def free_ids(self):
+        '''Finds the IDs of the existing, not allocated hosts
+
+        :returns: Set of host IDs
+        :rtype: set
+        '''
+        if not self._map():
+            return set()
+        return set(match.start() - HEADER.size for match in
+                   FREE_PATTERN.finditer(self.mmap, HEADER.size))
+
+    def update(self, hosts, layout=True):
+        '''Records the flags of changed hosts (under the database lock)
+
+        :param dict hosts: Mapping of host IDs to host objects (or None
+                           for removed hosts)
+        :param bool layout: If anything other than the allocated and
+                            alive flags of the hosts changed
+        '''
+        if not self._map(create=True):
+            return
+        if hosts and max(hosts) >= self.capacity:
+            self._grow(max(hosts) + 1)
+        for eid, host in hosts.items():
+            offset = HEADER.size + eid
+            self.mmap[offset:offset + 1] = struct.pack('B', host_flags(host))
+        self._bump(layout)
+
+    def rebuild(self, hosts):
+        '''Replaces the flags of every host (under the database lock)
+
+        :param dict hosts: Mapping of host IDs to host objects
+        '''
+        if not self._map(create=True):
+            return
+        if hosts and max(hosts) >= self.capacity:
+            self._grow(max(hosts) + 1)
+        flags = bytearray(self.capacity)
+        for eid, host in hosts.items():
+            flags[eid] = host_flags(host)
+        self.mmap[HEADER.size:HEADER.size + self.capacity] = bytes(flags)
+        self._bump(True)
@@ -19,57 +19,523 @@
     TinyDB NoSQL storage interface for the RESTful service
 '''
 
-import filelock
+import os
+import time
+import threading
+from copy import deepcopy
 from contextlib import contextmanager
 
 from tinydb import TinyDB
+from tinydb.storages import Storage as TinyDBStorage, touch
+from tinydb.middlewares import CachingMiddleware
 
 from .. import constants
+from .. import exceptions
+from .. import metrics
+from ..storage import serializers
 from ..storage.base import Storage
+from ..storage.durability import (
+    DURABILITY_STRICT, DURABILITY_INTERVAL, SYNC_INTERVAL, IntervalSync,
+    replace_file, validate as validate_durability)
+from ..storage.index import HostIndex
+from ..storage.locking import (
+    RWLock, LOCK_SUFFIX, remaining_budget, spend_budget)
+from ..storage.state import HostState, FLAG_ALIVE, STATE_SUFFIX
+from ..utils import dict_update, select_fields
 
-LOCK_FILE = 'db_ops.lck'
 DB_FILENAME = 'db_hostpool.json'
 TBL_HOSTS = 'hosts'
+# Raw table of credentials, by content hash (not usable as a TinyDB table)
+TBL_CREDENTIALS = 'credentials'
+# Raw table of the change log, by revision
+TBL_CHANGES = 'changes'
+
+# Write the database file at the end of every storage operation
+FLUSH_ALWAYS = 'always'
+# Write the database file every "flush_every" storage operations. Only
+# safe when a single process (gunicorn worker) uses the database file.
+FLUSH_DEFERRED = 'deferred'
+FLUSH_POLICIES = [FLUSH_ALWAYS, FLUSH_DEFERRED]
+# Without a shared state revision, a file modified less than this many
+# seconds ago is always re-read, since its mtime may be too coarse to
+# notice a follow-up write
+RACY_WINDOW = 2.0
+
+# Open database handles of this process, by database file path
+_HANDLES = dict()
+_HANDLES_LOCK = threading.Lock()
+
+
+class SerializedStorage(TinyDBStorage):
+    '''
+    TinyDB storage writing a database file in any of the formats of
+    `cloudify_hostpool.storage.serializers`. The format of the existing
+    file is detected on read, so a file changes format on its next write.
+
+    Writes honor a durability policy (see
+    `cloudify_hostpool.storage.durability`): the strict policy replaces
+    the file atomically, the others rewrite it in place and fsync it
+    every sync_interval seconds at most (interval) or never (none).
+    '''
+    def __init__(self, path, serializer=None, compress=False,
+                 durability=None, sync_interval=None):
+        super(SerializedStorage, self).__init__()
+        touch(path, create_dirs=False)
+        self.path = path
+        self.serializer = serializers.validate(
+            serializer or serializers.FORMAT_JSON)
+        self.compress = compress
+        self.durability = validate_durability(
+            durability or DURABILITY_STRICT)
+        self._handle = open(path, 'r+b')
+        self.syncer = IntervalSync(self._handle,
+                                   sync_interval or SYNC_INTERVAL)
+
+    def close(self):
+        self.syncer.close()
+        self._handle.close()
+
+    def read(self):
+        self._handle.seek(0)
+        return serializers.loads(self._handle.read())
+
+    def write(self, data):
+        payload = serializers.dumps(data, self.serializer, self.compress)
+        if self.durability == DURABILITY_STRICT:
+            replace_file(self.path, payload)
+            # Switch to the new file
+            self.syncer.close()
+            self._handle.close()
+            self._handle = open(self.path, 'r+b')
+            self.syncer.fileobj = self._handle
+            return
+        self._handle.seek(0)
+        self._handle.write(payload)
+        self._handle.truncate()
+        self._handle.flush()
+        if self.durability == DURABILITY_INTERVAL:
+            self.syncer.written()
+
+
+def normalize(raw):
+    '''Converts the keys of the raw tables read from JSON back to integers
+
+    :param dict raw: Raw database data (changed in place)
+    :returns: The raw database data
+    :rtype: dict
+    '''
+    for name in [TBL_HOSTS, TBL_CHANGES]:
+        if raw and raw.get(name):
+            raw[name] = dict((int(key), value)
+                             for key, value in raw[name].items())
+    return raw
+
+
+class GroupCommit(object):
+    '''
+    Leader / follower group commit of the writes of a process.
+
+    Writers queue their operation and wait. The first one becomes the
+    leader: it waits up to `delay` seconds for more writers, then runs
+    every queued operation under a single hold of the exclusive database
+    lock, writes the database file once and hands every writer its
+    result (or exception). Writers arriving meanwhile queue up for the
+    next batch, so batches grow with the load even without a delay.
+
+    Waiting for a leader counts against the lock wait budget of the
+    writer (see `cloudify_hostpool.storage.locking.wait_budget`): a
+    writer whose budget runs out before its operation started withdraws
+    it and fails with `LockTimeoutException`. When the leader times out
+    on the database lock, writers with budget left retry in a new batch.
+    '''
+    def __init__(self, handle):
+        self.handle = handle
+        self.delay = 0.0
+        self.cond = threading.Condition()
+        self.queue = list()
+        self.leading = False
+
+    def submit(self, func):
+        '''Runs an operation in the next batch, waits for its result'''
+        start = time.time()
+        budget = remaining_budget()
+        entry = {'func': func, 'done': False,
+                 'deadline': None if budget is None else start + budget}
+        with self.cond:
+            self.queue.append(entry)
+            self.wait(entry, start)
+            lead = not entry['done']
+            if lead:
+                self.leading = True
+        spend_budget(time.time() - start)
+        if lead:
+            try:
+                if self.delay:
+                    time.sleep(self.delay)
+                with self.cond:
+                    batch, self.queue = self.queue, list()
+                self.commit(batch, entry)
+            finally:
+                with self.cond:
+                    self.leading = False
+                    self.cond.notify_all()
+        if 'error' in entry:
+            raise entry['error']
+        return entry['result']
+
+    def wait(self, entry, start):
+        '''Waits (holding the condition) until there's no leader or the
+        entry is done, within the lock wait budget of the writer'''
+        while self.leading and not entry['done']:
+            if entry['deadline'] is None or entry.get('started'):
+                # A started operation runs under the lock, and must not
+                # be reported as failed
+                self.cond.wait()
+                continue
+            remaining = entry['deadline'] - time.time()
+            if remaining <= 0:
+                entry['abandoned'] = True
+                self.queue = [x for x in self.queue if x is not entry]
+                waited = time.time() - start
+                spend_budget(waited)
+                # Reported like a timeout of the exclusive lock itself
+                name = '{0}.exclusive'.format(self.handle.rwlock.name)
+                lock_metrics = metrics.get_lock_metrics(name)
+                with lock_metrics.lock:
+                    lock_metrics.timeouts += 1
+                raise exceptions.LockTimeoutException(
+                    name, waited, lock_metrics.retry_after())
+            self.cond.wait(remaining)
+
+    def begin(self, entry):
+        '''Marks an operation as started, unless its writer gave up'''
+        with self.cond:
+            if entry.get('abandoned'):
+                return False
+            entry['started'] = True
+            return True
+
+    def commit(self, batch, leader=None):
+        '''Runs a batch of operations, writing the database file once
+
+        :param list batch: Queued operations
+        :param dict leader: Operation of the leading writer
+        '''
+        handle = self.handle
+        retry = list()
+        try:
+            with handle.rwlock.exclusive():
+                with handle.lock:
+                    handle.committing, handle.flush_due = True, False
+                    try:
+                        for entry in batch:
+                            if not self.begin(entry):
+                                continue
+                            try:
+                                entry['result'] = entry['func']()
+                            except Exception as ex:  # pylint: disable=W0703
+                                entry['error'] = ex
+                    finally:
+                        handle.committing = False
+                    if handle.flush_due:
+                        handle.flush()
+        except exceptions.LockTimeoutException as ex:
+            # Nothing ran, the budget of the leader ran out
+            now = time.time()
+            for entry in batch:
+                if entry is not leader and not entry.get('abandoned') and \
+                   (entry['deadline'] is None or entry['deadline'] > now):
+                    retry.append(entry)
+                else:
+                    entry['error'] = ex
+        except Exception as ex:  # pylint: disable=W0703
+            # Nothing of the batch is known to be written
+            for entry in batch:
+                entry['error'] = ex
+        finally:
+            with self.cond:
+                # Back to the front of the queue, one of them leads next
+                self.queue[:0] = retry
+                for entry in batch:
+                    if not any(x is entry for x in retry):
+                        entry['done'] = True
+
+
+def file_signature(path):
+    '''Returns what identifies a version of a file on disk (or None)'''
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    mtime_ns = getattr(stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(stat.st_mtime * 1e9)
+    return (stat.st_ino, stat.st_size, mtime_ns)
+
+
+class CachedHandle(object):
+    '''
+    Long-lived TinyDB handle of a process.
+
+    The database contents are kept in memory (CachingMiddleware) and only
+    re-read when the database file changed on disk (inode, size or mtime)
+    or the revision of the shared host state moved, so that writes from
+    other processes are still seen. An inverted index
+    of the cached hosts is kept in sync with every mutation, and so is the
+    host state shared with the other processes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.serializer = serializers.FORMAT_JSON
+        self.compress = False
+        self.durability = DURABILITY_STRICT
+        self.sync_interval = SYNC_INTERVAL
+        self.lock = threading.RLock()
+        self.db = None
+        self.index = None
+        self.state = HostState(path + STATE_SUFFIX)
+        self.rwlock = RWLock(path + LOCK_SUFFIX)
+        # Layout revision of the shared state the cached hosts match
+        self.layout = None
+        self.committer = GroupCommit(self)
+        # Set while a group commit runs, writes are deferred to its end
+        self.committing = False
+        self.flush_due = False
+        self.signature = None
+        self.racy = True
+        self.pid = os.getpid()
+
+    def open(self):
+        '''(Re)opens the TinyDB handle, dropping any cached data'''
+        if self.db is not None:
+            # Close the file only, unflushed data is stale by now
+            self.db.storage.storage.close()
+        self.db = TinyDB(self.path,
+                         storage=CachingMiddleware(SerializedStorage),
+                         serializer=self.serializer, compress=self.compress,
+                         durability=self.durability,
+                         sync_interval=self.sync_interval)
+        self.db.storage.WRITE_CACHE_SIZE = float('inf')
+        self.index = None
+
+    def configure(self, serializer=None, compress=False, durability=None,
+                  sync_interval=None):
+        '''Sets the format and durability the database file is written
+        with'''
+        with self.lock:
+            self.serializer = serializers.validate(
+                serializer or serializers.FORMAT_JSON)
+            self.compress = compress
+            self.durability = validate_durability(
+                durability or DURABILITY_STRICT)
+            self.sync_interval = sync_interval or SYNC_INTERVAL
+            if self.db is not None:
+                storage = self.db.storage.storage
+                storage.serializer = self.serializer
+                storage.compress = self.compress
+                storage.durability = self.durability
+                storage.syncer.interval = self.sync_interval
+
+    @property
+    def table(self):
+        '''The raw (cached) hosts table, by integer host ID'''
+        raw = self.db.storage.read() or dict()
+        return raw.get(TBL_HOSTS) or dict()
+
+    @property
+    def credentials(self):
+        '''The raw (cached) credentials table, by content hash'''
+        raw = self.db.storage.read() or dict()
+        return raw.get(TBL_CREDENTIALS) or dict()
+
+    def add_credentials(self, credentials):
+        '''Adds credentials to the raw credentials table
+
+        :returns: The credentials that weren't stored yet
+        :rtype: dict
+        '''
+        raw = self.db.storage.read() or dict()
+        table = raw.setdefault(TBL_CREDENTIALS, dict())
+        added = dict((ref, creds) for ref, creds in credentials.items()
+                     if ref not in table)
+        if added:
+            table.update(added)
+            self.db.storage.write(raw)
+            # Readers must notice the write through the state revision
+            self.state.update(dict(), layout=False)
+        return added
+
+    def get_index(self):
+        '''Returns the index of the cached hosts, building it if needed'''
+        if self.index is None:
+            self.index = HostIndex(self.table)
+        return self.index
+
+    def reindex(self, eids):
+        '''Updates the index after the given hosts changed'''
+        if self.index is None:
+            return
+        table = self.table
+        for eid in eids:
+            self.index.update(eid, table.get(eid))
+
+    def publish(self, eids, layout=True):
+        '''Records changed hosts in the shared state (under the lock)
+
+        The cached data is up to date under the database lock, so it
+        matches the new layout revision (once the state was synced).
+        '''
+        table = self.table
+        self.state.update(dict((eid, table.get(eid)) for eid in eids),
+                          layout)
+        if self.layout is not None:
+            self.layout = self.state.layout
+
+    @property
+    def changes(self):
+        '''The raw (cached) change log, by integer revision'''
+        raw = self.db.storage.read() or dict()
+        return raw.get(TBL_CHANGES) or dict()
+
+    @property
+    def revision(self):
+        '''The revision of the cached data'''
+        changes = self.changes
+        return max(changes) if changes else 0
+
+    def add_changes(self, changes):
+        '''Adds entries to the raw change log, keeping the latest ones
+
+        :param dict changes: Change log entries, by revision
+        '''
+        raw = self.db.storage.read() or dict()
+        table = raw.setdefault(TBL_CHANGES, dict())
+        table.update(changes)
+        oldest = max(table) - constants.CHANGE_LOG_SIZE
+        for revision in [x for x in table if x <= oldest]:
+            del table[revision]
+        return raw
+
+    def stamp(self, changes):
+        '''Sets the version of the changed hosts that still exist
+
+        :param dict changes: Change log entries, by revision
+        '''
+        table = self.table
+        for revision, change in changes.items():
+            host = table.get(change['id'])
+            if host is not None:
+                host[constants.HOST_VERSION_KEY] = revision
+
+    def log_changes(self, eids, op):
+        '''Records changed hosts in the change log, one revision each,
+        and versions them with it
+
+        :returns: The new change log entries, by revision
+        :rtype: dict
+        '''
+        revision = self.revision
+        changes = dict()
+        for eid in eids:
+            revision += 1
+            changes[revision] = {'id': eid, 'op': op}
+        if changes:
+            self.stamp(changes)
+            self.db.storage.write(self.add_changes(changes))
+        return changes
+
+    def changed(self, eids, op, layout=True):
+        '''Keeps the index, shared state and change log up to date after
+        the given hosts changed (under the database lock)'''
+        self.reindex(eids)
+        self.publish(eids, layout)
+        self.log_changes(eids, op)
+
+    @property
+    def dirty(self):
+        '''Checks if there are cached writes not on disk yet'''
+        return self.db is not None and \
+            self.db.storage._cache_modified_count > 0
+
+    def current(self):
+        '''Returns what identifies the data on disk: the database file
+        signature and the shared state revision (None without a state)'''
+        revision = self.state.revision \
+            if self.state.layout is not None else None
+        return file_signature(self.path), revision
+
+    def refresh(self):
+        '''Drops the cached data if the database file changed'''
+        signature = self.current()
+        if self.db is None or \
+           (not self.dirty and (self.racy or signature != self.signature)):
+            self.open()
+            # Load the data now so the signature matches what's cached
+            normalize(self.db.storage.read())
+            self.remember(signature)
+
+    def remember(self, signature=None):
+        '''Records the signature of the data the cache matches
+
+        Every write bumps the shared state revision under the lock, so
+        only a file without a state is re-read while its mtime is recent.
+        '''
+        self.signature = signature or self.current()
+        stat, revision = self.signature
+        self.racy = not stat or (
+            revision is None and
+            time.time() - stat[2] / 1e9 < RACY_WINDOW)
+
+    def flush(self):
+        '''Writes cached data to the database file'''
+        if self.dirty:
+            self.db.storage.flush()
+            self.remember()
+
+
+def get_handle(path, handle_class=CachedHandle):
+    '''Returns the cached database handle of this process'''
+    key = os.path.abspath(path)
+    with _HANDLES_LOCK:
+        handle = _HANDLES.get(key)
+        # Handles must not be shared with forked (gunicorn) workers
+        if handle is None or handle.pid != os.getpid() or \
+           type(handle) is not handle_class:
+            handle = handle_class(path)
+            _HANDLES[key] = handle
+        return handle
 
 
 def locked(func):
-    '''Decorate to provide locking'''
-    def wrapper(*args, **kwargs):
+    '''Decorate to run a method under the exclusive database lock'''
+    def wrapper(self, *args, **kwargs):
         '''Post processor'''
-        with filelock.FileLock(LOCK_FILE):
-            return func(*args, **kwargs)
+        with self._handle.rwlock.exclusive():
+            return func(self, *args, **kwargs)
     return wrapper
 
 
-def postprocess_host(func):
-    '''Decorator to force consistent returns'''
-    def wrapper(*args, **kwargs):
+def committed(func):
+    '''Decorate to run a method under the exclusive database lock, as
+    part of a group commit with the concurrent writes of the process'''
+    func = locked(func)
+
+    def wrapper(self, *args, **kwargs):
         '''Post processor'''
-        host = func(*args, **kwargs)
-        # Fix a bad return
-        if not host or \
-           not isinstance(host, dict) or \
-           not hasattr(host, 'eid'):
-            return dict()
-        # Assign a standard ID
-        host[constants.HOST_ID_KEY] = host.eid
-        return host
+        if self._handle.rwlock.held is not None:
+            # Part of a batch (or of a larger locked operation) already
+            return func(self, *args, **kwargs)
+        return self._handle.committer.submit(
+            lambda: func(self, *args, **kwargs))
     return wrapper
 
 
-def postprocess_hosts(func):
-    '''Decorator to force consistent returns'''
-    def wrapper(*args, **kwargs):
+def read_locked(func):
+    '''Decorate to run a method under the shared database lock'''
+    def wrapper(self, *args, **kwargs):
         '''Post processor'''
-        hosts = func(*args, **kwargs)
-        # Fix a bad return
-        if not hosts or not isinstance(hosts, list):
-            return list()
-        # Assign standard IDs
-        hosts = [x for x in hosts if hasattr(x, 'eid')]
-        for host in hosts:
-            host[constants.HOST_ID_KEY] = host.eid
-        return hosts
+        with self._handle.rwlock.shared():
+            return func(self, *args, **kwargs)
     return wrapper
 
 
@@ -91,45 +557,196 @@ class Database(Storage):
     '''
     Storage wrapper for TinyDB NoSQL DB implementing AbstractStorage interface
     '''
-    def __init__(self, storage=None):
+    handle_class = CachedHandle
+
+    def __init__(self, storage=None, flush=None, flush_every=100,
+                 serializer=None, compress=False, commit_delay=0.0,
+                 durability=None, sync_interval=SYNC_INTERVAL):
         self.db_filename = storage or DB_FILENAME
         self.tbl_hosts = TBL_HOSTS
+        self.flush = flush or FLUSH_ALWAYS
+        self.flush_every = flush_every
+        if self.flush not in FLUSH_POLICIES:
+            raise exceptions.ConfigurationError(
+                'Unknown TinyDB flush policy "{0}"'.format(self.flush))
+        self._handle = get_handle(self.db_filename, self.handle_class)
+        self._handle.configure(serializer, compress, durability,
+                               sync_interval)
+        self._handle.committer.delay = commit_delay or 0.0
+        self._ops = 0
 
+    @locked
     def init_data(self):
         '''Wipes all data'''
         with self.connect() as dbc:
             tbl = dbc.table(self.tbl_hosts)
             tbl.purge()
+            self._handle.index = None
+            self._handle.state.rebuild(dict())
+            self._handle.layout = self._handle.state.layout
+            raw = dbc.storage.read() or dict()
+            if raw.pop(TBL_CREDENTIALS, None) is not None:
+                dbc.storage.write(raw)
+            # The revision carries on, so readers notice the purge
+            self._handle.log_changes([None], constants.CHANGE_PURGE)
 
     @contextmanager
     def connect(self):
-        '''Get a connection to the database'''
-        yield TinyDB(self.db_filename)
+        '''Get a connection to the database
+
+        The connection is the long-lived handle of this process. Its
+        cached data is refreshed if needed and any writes made through
+        it are flushed according to the flush policy.
+        '''
+        with self._handle.lock:
+            self._handle.refresh()
+            try:
+                yield self._handle.db
+            finally:
+                self._ops += 1
+                if self.flush == FLUSH_ALWAYS or \
+                   self._ops % self.flush_every == 0:
+                    if self._handle.committing:
+                        # Written once for the whole batch
+                        self._handle.flush_due = True
+                    else:
+                        self._handle.flush()
+
+    def close(self):
+        '''Flushes any pending writes to the database file'''
+        with self._handle.lock:
+            self._handle.flush()
 
-    @postprocess_host
-    def get_host(self, eid):
+    @read_locked
+    def get_host(self, eid, fields=None):
         '''Retrieves a single, specified host
 
         :param int eid: Host ID of the host to retrieve
+        :param list fields: Optional top level fields to return
         :returns: Host object
         :rtype: dict
         '''
-        with self.connect() as dbc:
-            tbl = dbc.table(self.tbl_hosts)
-            return tbl.get(eid=eid)
+        with self.connect():
+            host = self._handle.table.get(eid)
+            if host is None:
+                return dict()
+            # Detach from the cached document
+            host = deepcopy(select_fields(host, fields)
+                            if fields is not None else dict(host))
+            host[constants.HOST_ID_KEY] = eid
+            return host
 
-    @postprocess_hosts
-    @locked
-    def get_hosts(self):
-        '''Retrieves all host entries from the database
+    @read_locked
+    def get_hosts(self, filters=None, fields=None):
+        '''Retrieves host entries from the database
+
+        Filters are evaluated against the inverted index, so the cost
+        depends on the number of matching hosts, not the pool size.
 
-        :returns: A list of all host entries from the database
+        :param dict filters: Optional filters to apply
+        :param list fields: Optional top level fields to return
+        :returns: A list of host entries from the database
         :rtype: list
         '''
-        with self.connect() as dbc:
-            tbl = dbc.table(self.tbl_hosts)
-            return tbl.all()
+        with self.connect():
+            table = self._handle.table
+            if filters:
+                host_ids = self._handle.get_index().select(filters)
+            else:
+                host_ids = table.keys()
+            hosts = list()
+            for eid in sorted(host_ids):
+                host = select_fields(table[eid], fields) \
+                    if fields is not None else dict(table[eid])
+                host[constants.HOST_ID_KEY] = eid
+                hosts.append(host)
+            return hosts
+
+    def get_free_hosts(self, filters=None):
+        '''Retrieves the hosts that aren't allocated
+
+        Which hosts are free (and alive) is read from the state shared
+        by the processes using the database file, so the database file
+        is only re-read if hosts were added, removed or changed (other
+        than being allocated, released or health checked) since it was
+        last read.
+
+        :param dict filters: Optional filters to apply
+        :returns: A list of host entries
+        :rtype: list
+        '''
+        filters = dict(filters or dict())
+        filters.pop('allocated', None)
+        layout = self._handle.state.layout
+        if layout is None or layout != self._handle.layout:
+            self.sync_state()
+        if self._handle.layout is None:
+            # No shared state, use the database
+            filters['allocated'] = False
+            return self.get_hosts(filters=filters)
+        free_ids = self._handle.state.free_ids()
+        with self._handle.lock:
+            table = self._handle.table
+            if filters:
+                free_ids.intersection_update(
+                    self._handle.get_index().select(filters))
+            hosts = list()
+            for eid in sorted(free_ids):
+                if eid not in table:
+                    continue
+                host = dict(table[eid])
+                host['allocated'] = False
+                # Liveness changes don't reload the cached hosts
+                host['alive'] = bool(
+                    self._handle.state.flags(eid) & FLAG_ALIVE)
+                host[constants.HOST_ID_KEY] = eid
+                hosts.append(host)
+            return hosts
+
+    @locked
+    def sync_state(self):
+        '''Catches up with the database and the shared host state
+
+        The state is rebuilt from the database the first time a process
+        uses it, in case it was left behind by an earlier run.
+        '''
+        with self.connect():
+            if self._handle.layout is None:
+                self._handle.state.rebuild(self._handle.table)
+            self._handle.layout = self._handle.state.layout
+
+    @read_locked
+    def get_host_version(self, eid):
+        '''Retrieves the version of a host
+
+        :param int eid: Host ID of the host
+        :returns: Host version (or None if the host doesn't exist)
+        :rtype: int
+        '''
+        with self.connect():
+            host = self._handle.table.get(eid)
+            if host is None:
+                return None
+            return host.get(constants.HOST_VERSION_KEY, 0)
+
+    @read_locked
+    def get_host_ids_by_endpoint(self, endpoints):
+        '''Looks up existing hosts by their (ip, port) endpoint
+
+        :param list endpoints: List of (ip, port) tuples
+        :returns: Mapping of existing (ip, port) tuples to host IDs
+        :rtype: dict
+        '''
+        with self.connect():
+            index = self._handle.get_index()
+            found = dict()
+            for endpoint in endpoints:
+                host_id = index.find_endpoint(tuple(endpoint))
+                if host_id is not None:
+                    found[tuple(endpoint)] = host_id
+            return found
 
+    @committed
     def add_hosts(self, hosts):
         '''Adds multiple host entries to the database
 
@@ -139,24 +756,34 @@ class Database(Storage):
         '''
         with self.connect() as dbc:
             tbl = dbc.table(self.tbl_hosts)
-            return tbl.insert_multiple(hosts)
+            host_ids = tbl.insert_multiple(hosts)
+            self._handle.changed(host_ids, constants.CHANGE_ADD)
+            return host_ids
 
     @postprocess_host_id
-    def update_host(self, eid, host):
+    @committed
+    def update_host(self, eid, host, version=None):
         '''Updates an existing host in the database
 
-        This will raise a KeyError exception if a non-existent
-        host ID is provided.
-
         :param int eid: Host ID of the host to update
+        :param dict host: Host keys to update
+        :param int version: Version the host must be at (optional)
         :returns: Host ID that was updated (or None)
         :rtype: int
         '''
-        with self.connect() as dbc:
-            tbl = dbc.table(self.tbl_hosts)
-            return tbl.update(host, eids=[eid])
+        with self.connect():
+            # Updated in place, TinyDB tables convert every document
+            current = self._handle.table.get(eid)
+            if current is None or (
+                    version is not None and
+                    current.get(constants.HOST_VERSION_KEY, 0) != version):
+                return None
+            current.update(host)
+            self._handle.changed([eid], constants.CHANGE_UPDATE)
+            return eid
 
     @postprocess_host_id
+    @committed
     def remove_host(self, eid):
         '''Removes an existing host from the database
 
@@ -170,6 +797,194 @@ class Database(Storage):
         with self.connect() as dbc:
             tbl = dbc.table(self.tbl_hosts)
             try:
-                return tbl.remove(eids=[eid])
+                host_ids = tbl.remove(eids=[eid])
             except KeyError:
                 return None
+            self._handle.changed(host_ids, constants.CHANGE_REMOVE)
+            return host_ids
+
+    @committed
+    def update_hosts(self, eids, patch):
+        '''Updates multiple existing hosts with a single file write
+
+        :param list eids: Host IDs of the hosts to update
+        :param dict patch: Partial host object to merge into each host
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        wanted = set(eids)
+        with self.connect() as dbc:
+            tbl = dbc.table(self.tbl_hosts)
+            host_ids = tbl.update(
+                lambda host: dict_update(host, deepcopy(patch)),
+                cond=lambda host: host.doc_id in wanted)
+            self._handle.changed(host_ids, constants.CHANGE_UPDATE)
+            return host_ids
+
+    @committed
+    def remove_hosts(self, eids):
+        '''Removes multiple existing hosts with a single file write
+
+        :param list eids: Host IDs of the hosts to remove
+        :returns: List of host IDs that were removed
+        :rtype: list
+        '''
+        wanted = set(eids)
+        with self.connect() as dbc:
+            tbl = dbc.table(self.tbl_hosts)
+            host_ids = tbl.remove(cond=lambda host: host.doc_id in wanted)
+            self._handle.changed(host_ids, constants.CHANGE_REMOVE)
+            return host_ids
+
+    @committed
+    def set_alive(self, eids, alive, last_seen=None):
+        '''Records whether hosts are alive, with a single file write
+
+        Only the alive flags of the shared state change, the change log
+        and the host versions are left as they are.
+
+        :param list eids: Host IDs of the hosts checked
+        :param bool alive: If the hosts are alive
+        :param int last_seen: Time the hosts were seen alive (optional)
+        :returns: List of host IDs that were updated
+        :rtype: list
+        '''
+        with self.connect() as dbc:
+            table = self._handle.table
+            host_ids = list()
+            for eid in eids:
+                host = table.get(eid)
+                if host is None:
+                    continue
+                host['alive'] = alive
+                if last_seen is not None:
+                    host[constants.HOST_LAST_SEEN_KEY] = last_seen
+                host_ids.append(eid)
+            if host_ids:
+                self._handle.reindex(host_ids)
+                self._handle.publish(host_ids, layout=False)
+                dbc.storage.write(dbc.storage.read())
+            return host_ids
+
+    @committed
+    def add_credentials(self, credentials):
+        '''Stores credentials by their content hash, in one file write
+
+        :param dict credentials: Mapping of content hashes to credentials
+        :returns: The credentials that weren't stored yet
+        :rtype: dict
+        '''
+        with self.connect():
+            return self._handle.add_credentials(credentials)
+
+    @read_locked
+    def get_revision(self):
+        '''Retrieves the revision of the host pool
+
+        :returns: Pool revision
+        :rtype: int
+        '''
+        with self.connect():
+            return self._handle.revision
+
+    @read_locked
+    def get_changes(self, since):
+        '''Retrieves the changes made after a revision
+
+        :param int since: Revision the caller is up to date with
+        :returns: The changes after `since`, or None if some of them
+                  are no longer kept
+        :rtype: list
+        '''
+        with self.connect():
+            changes = self._handle.changes
+            revision = max(changes) if changes else 0
+            if since > revision or \
+               (since < revision and since + 1 not in changes):
+                return None
+            return [dict(changes[x], revision=x)
+                    for x in range(since + 1, revision + 1)]
+
+    @read_locked
+    def get_credentials(self, ref):
+        '''Retrieves stored credentials by content hash
+
+        :param str ref: Content hash of the credentials
+        :returns: Credentials object (or an empty dict)
+        :rtype: dict
+        '''
+        with self.connect():
+            return deepcopy(self._handle.credentials.get(ref) or dict())
+
+    def _set_allocated(self, eids, allocated, only_if=None):
+        '''Sets the allocation state of hosts, in place
+
+        :returns: The changed host objects
+        :rtype: list
+        '''
+        with self.connect():
+            table = self._handle.table
+            changed = list()
+            for eid in eids:
+                host = table.get(eid)
+                if not host or (
+                        only_if is not None and
+                        bool(host.get('allocated')) != only_if):
+                    continue
+                host['allocated'] = allocated
+                changed.append(eid)
+            if changed:
+                self._handle.changed(changed, constants.CHANGE_UPDATE,
+                                     layout=False)
+            hosts = list()
+            for eid in changed:
+                host = deepcopy(dict(table[eid]))
+                host[constants.HOST_ID_KEY] = eid
+                hosts.append(host)
+            return hosts
+
+    @committed
+    def allocate_if_free(self, eid):
+        '''Marks a host as allocated, if it isn't already
+
+        The check and the update are made under the database lock and
+        cost a single file write (shared by concurrent writes).
+
+        :param int eid: Host ID of the host to allocate
+        :returns: The allocated host object (or an empty dict)
+        :rtype: dict
+        '''
+        hosts = self._set_allocated([eid], True, only_if=False)
+        return hosts[0] if hosts else dict()
+
+    @committed
+    def release(self, eid):
+        '''Marks a host as not allocated
+
+        :param int eid: Host ID of the host to release
+        :returns: The released host object (or an empty dict)
+        :rtype: dict
+        '''
+        hosts = self._set_allocated([eid], False)
+        return hosts[0] if hosts else dict()
+
+    @committed
+    def allocate_hosts(self, eids):
+        '''Marks the hosts that aren't allocated already as allocated,
+        with a single file write
+
+        :param list eids: Host IDs of the hosts to allocate
+        :returns: The allocated host objects
+        :rtype: list
+        '''
+        return self._set_allocated(eids, True, only_if=False)
+
+    @committed
+    def release_hosts(self, eids):
+        '''Marks hosts as not allocated, with a single file write
+
+        :param list eids: Host IDs of the hosts to release
+        :returns: The released host objects
+        :rtype: list
+        '''
+        return self._set_allocated(eids, False)
@@ -18,36 +18,48 @@
     Tests for REST backend service
 '''
 
+import os
 import json
 import mock
+import shutil
+import tempfile
+import threading
+import filelock
 import testtools
 from testtools import matchers
 
 from ... import constants, exceptions
 from ...rest.backend import RestBackend
+from ...storage import locking
 
 
-def _mock_scan_alive(self, _):
+def _mock_scan_alive(self, endpoints):
     '''Simulates all hosts being "alive"'''
     if self and self.logger:
         self.logger.debug('_mock_scan_alive()')
-    return True
+    return (idx for idx in range(len(endpoints)))
 
 
-def _mock_scan_dead(self, _):
+def _mock_scan_dead(self, endpoints):
     '''Simulates all hosts being "dead"'''
     if self and self.logger:
         self.logger.debug('_mock_scan_dead()')
-    return False
+    return (idx for idx in [])
 
 
 class RestBackendTest(testtools.TestCase):
     '''Test class for REST backend service'''
     NUMBER_OF_HOSTS = 5
+    STORAGE_BACKEND = None
 
     def setUp(self):
         testtools.TestCase.setUp(self)
-        self.backend = RestBackend(reset_storage=True)
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        storage = os.path.join(workdir, 'db_hostpool')
+        self.backend = RestBackend(reset_storage=True,
+                                   storage=storage,
+                                   storage_backend=self.STORAGE_BACKEND)
         hosts = self._generate_hosts(self.NUMBER_OF_HOSTS)
         self.backend.add_hosts({'hosts': hosts})
 
@@ -85,6 +97,100 @@ class RestBackendTest(testtools.TestCase):
             len(self.backend.list_hosts(filters={
                 'tags': ['test_0', 'test_x']})), 0)
 
+    def test_add_hosts_duplicates(self):
+        '''Test re-adding hosts with each duplicate policy'''
+        hosts = self._generate_hosts(self.NUMBER_OF_HOSTS + 1)
+        hosts[0]['credentials']['password'] = 'changed'
+        # Skip (the default) only adds the new host
+        ret = self.backend.add_hosts({'hosts': hosts})
+        self.assertEqual([x['result'] for x in ret],
+                         [constants.HOST_SKIPPED] * self.NUMBER_OF_HOSTS +
+                         [constants.HOST_ADDED])
+        self.assertEqual([x[constants.HOST_ID_KEY] for x in ret],
+                         list(range(1, self.NUMBER_OF_HOSTS + 2)))
+        self.assertEqual(self.backend.get_host(1)['credentials']['password'],
+                         'p4ssw0rd')
+        # Merge updates the existing host, but not its allocation
+        self.backend.storage.allocate_if_free(1)
+        ret = self.backend.add_hosts({'hosts': hosts[:1]},
+                                     on_duplicate=constants.DUPLICATE_MERGE)
+        self.assertEqual(ret[0]['result'], constants.HOST_MERGED)
+        host = self.backend.get_host(1)
+        self.assertEqual(host['credentials']['password'], 'changed')
+        self.assertTrue(host['allocated'])
+        # Reject adds nothing at all
+        hosts = self._generate_hosts(self.NUMBER_OF_HOSTS + 2)
+        ex = self.assertRaises(exceptions.DuplicateHostException,
+                               self.backend.add_hosts, {'hosts': hosts},
+                               on_duplicate=constants.DUPLICATE_REJECT)
+        self.assertEqual(len(ex.duplicates), self.NUMBER_OF_HOSTS + 1)
+        self.assertEqual(len(self.backend.list_hosts()),
+                         self.NUMBER_OF_HOSTS + 1)
+        self.assertRaises(exceptions.UnexpectedData,
+                          self.backend.add_hosts, {'hosts': hosts},
+                          on_duplicate='overwrite')
+
+    def test_add_hosts_lock(self):
+        '''Test host additions lock a file next to the database'''
+        with mock.patch.object(filelock, 'FileLock',
+                               wraps=filelock.FileLock) as lock:
+            self.backend.add_hosts({'hosts': self._generate_hosts(1)})
+        lock.assert_called_once_with(
+            self.backend.storage.db_filename + '.add.lck')
+
+    def test_add_hosts_duplicate_entries(self):
+        '''Test duplicate entries within a single request'''
+        self.backend.storage.init_data()
+        hosts = self._generate_hosts(1) * 2
+        hosts[1] = dict(hosts[1], name='renamed')
+        ret = self.backend.add_hosts({'hosts': hosts},
+                                     on_duplicate=constants.DUPLICATE_MERGE)
+        self.assertEqual([x['result'] for x in ret],
+                         [constants.HOST_ADDED, constants.HOST_MERGED])
+        self.assertEqual(ret[0][constants.HOST_ID_KEY],
+                         ret[1][constants.HOST_ID_KEY])
+        hosts = self.backend.list_hosts()
+        self.assertEqual([x['name'] for x in hosts], ['renamed'])
+
+    def test_credentials_shared(self):
+        '''Test hosts keep a reference to shared credentials'''
+        self.backend.storage.init_data()
+        self.backend.add_hosts({
+            'default': {'credentials': {'username': 'centos',
+                                        'key': 'k' * 4096}},
+            'hosts': [{'os': 'linux',
+                       'endpoint': {'ip': '10.0.0.0/30', 'port': 22,
+                                    'protocol': 'ssh'}}]})
+        hosts = self.backend.list_hosts()
+        self.assertEqual(len(hosts), 4)
+        self.assertEqual(len(set(
+            x['credentials'][constants.CREDENTIALS_REF_KEY]
+            for x in hosts)), 1)
+        self.assertEqual(self.backend.get_host(2)['credentials'],
+                         {'username': 'centos', 'key': 'k' * 4096})
+        # Updates only re-reference the credentials of updated hosts
+        self.backend.update_host(1, {'credentials': {'password': 'p'}})
+        self.assertEqual(self.backend.get_host(1)['credentials'],
+                         {'username': 'centos', 'key': 'k' * 4096,
+                          'password': 'p'})
+        self.backend.update_hosts({'ids': [1, 2],
+                                   'updates': {'credentials': {
+                                       'username': 'root'}}})
+        self.assertEqual(self.backend.get_host(1)['credentials']['password'],
+                         'p')
+        self.assertEqual(self.backend.get_host(2)['credentials'],
+                         {'username': 'root', 'key': 'k' * 4096})
+        self.assertEqual(self.backend.get_host(3)['credentials']['username'],
+                         'centos')
+
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
+                _mock_scan_alive)
+    def test_acquire_resolves_credentials(self):
+        '''Test allocated hosts are returned with their credentials'''
+        host = self.backend.acquire_host()
+        self.assertEqual(host['credentials'],
+                         {'username': 'ubuntu', 'password': 'p4ssw0rd'})
+
     def test_add_host_invalid(self):
         '''Test various invalid attempts at adding a host'''
         # Test with no hosts
@@ -167,7 +273,7 @@ class RestBackendTest(testtools.TestCase):
                 }]
             })))
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_acquire_host(self):
         '''Test acquire & release a host'''
@@ -182,7 +288,7 @@ class RestBackendTest(testtools.TestCase):
         self.assertIsNotNone(host[constants.HOST_ID_KEY])
         self.assertEqual(host['allocated'], False)
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_acquire_host_filter(self):
         '''Test acquire & release a host with tag filter'''
@@ -197,7 +303,7 @@ class RestBackendTest(testtools.TestCase):
         self.assertIsNotNone(host[constants.HOST_ID_KEY])
         self.assertEqual(host['allocated'], False)
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_acquire_host_filter_bad(self):
         '''Test acquire & release a host with bad tag filter'''
@@ -208,13 +314,90 @@ class RestBackendTest(testtools.TestCase):
                           self.backend.acquire_host,
                           filters={'tags': ['test_x']})
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_dead)
     def test_allocate_none_available(self):
         '''Test allocate without any available hosts'''
         self.assertRaises(exceptions.NoHostAvailableException,
                           self.backend.acquire_host)
 
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
+                side_effect=AssertionError('Scanned on allocation'))
+    def test_acquire_health_checked(self, _):
+        '''Test health checked pools allocate known-alive hosts'''
+        self.backend.config.update(health_interval=30.0)
+        self.assertRaises(exceptions.NoHostAvailableException,
+                          self.backend.acquire_host)
+        self.backend.storage.update_hosts([3], {'alive': True})
+        host = self.backend.acquire_host()
+        self.assertEqual(host[constants.HOST_ID_KEY], 3)
+        self.assertRaises(exceptions.NoHostAvailableException,
+                          self.backend.acquire_host)
+
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
+                _mock_scan_alive)
+    def test_acquire_count(self):
+        '''Test acquiring several hosts at once, all or nothing'''
+        with mock.patch.object(self.backend.storage, 'allocate_hosts',
+                               wraps=self.backend.storage.allocate_hosts) \
+                as allocate_hosts:
+            hosts = self.backend.acquire_host(count=3)
+            self.assertEqual(allocate_hosts.call_count, 1)
+        host_ids = [x[constants.HOST_ID_KEY] for x in hosts]
+        self.assertEqual(len(set(host_ids)), 3)
+        self.assertTrue(all(x['allocated'] for x in hosts))
+        self.assertEqual(hosts[0]['credentials'],
+                         {'username': 'ubuntu', 'password': 'p4ssw0rd'})
+        # Not enough hosts left, none are acquired (nor allocated)
+        with mock.patch.object(self.backend.storage, 'allocate_hosts',
+                               wraps=self.backend.storage.allocate_hosts) \
+                as allocate_hosts:
+            self.assertRaises(exceptions.NoHostAvailableException,
+                              self.backend.acquire_host, count=3)
+            self.assertFalse(allocate_hosts.called)
+        self.assertEqual(len(self.backend.get_unallocated_hosts()), 2)
+        # ... unless fewer are good enough
+        hosts = self.backend.acquire_host(count=3, min_count=1)
+        self.assertEqual(len(hosts), 2)
+        self.assertEqual(self.backend.get_unallocated_hosts(), list())
+        for count, min_count in [(0, None), (True, None), (2, 3),
+                                 ('2', None), (2, -1), (2, 0), (None, 1)]:
+            self.assertRaises(exceptions.UnexpectedData,
+                              self.backend.acquire_host,
+                              count=count, min_count=min_count)
+
+    def test_acquire_count_rollback(self):
+        '''Test the rollback of a short acquisition outlives its budget'''
+        self.backend.config['lock_budget_acquire'] = 60
+        storage = self.backend.storage
+        allocate_hosts, release_hosts = \
+            storage.allocate_hosts, storage.release_hosts
+        budgets = list()
+
+        def allocate_hosts_raced(host_ids):
+            '''Loses a host to another client, then runs out of budget'''
+            allocate_hosts(host_ids[:1])
+            allocated = allocate_hosts(host_ids)
+            locking.spend_budget(60)
+            return allocated
+
+        def release_hosts_budget(host_ids):
+            '''Records the wait budget the rollback runs with'''
+            budgets.append(locking.remaining_budget())
+            return release_hosts(host_ids)
+
+        free = len(self.backend.get_unallocated_hosts())
+        with mock.patch.object(storage, 'allocate_hosts',
+                               side_effect=allocate_hosts_raced), \
+                mock.patch.object(storage, 'release_hosts',
+                                  side_effect=release_hosts_budget):
+            self.assertRaises(exceptions.NoHostAvailableException,
+                              self.backend.acquire_host, count=free)
+        self.assertEqual(budgets, [None])
+        # Only the host lost to the other client stays allocated
+        self.assertEqual(len(self.backend.get_unallocated_hosts()),
+                         free - 1)
+
     def test_get_host(self):
         '''Test retrieve a host'''
         hosts = self.backend.list_hosts()
@@ -225,6 +408,64 @@ class RestBackendTest(testtools.TestCase):
         self.assertIsNotNone(host)
         self.assertIsNotNone(host[constants.HOST_ID_KEY])
 
+    def test_update_host_versions(self):
+        '''Test conditional and concurrent host updates'''
+        host = self.backend.list_hosts()[0]
+        host_id = host[constants.HOST_ID_KEY]
+        version = host[constants.HOST_VERSION_KEY]
+        ex = self.assertRaises(exceptions.HostVersionMismatchException,
+                               self.backend.update_host, host_id,
+                               {'name': 'stale'}, versions=[version - 1])
+        self.assertEqual(ex.version, version)
+        self.backend.update_host(host_id, {'name': 'fresh'},
+                                 versions=[version])
+        host = self.backend.get_host(host_id)
+        self.assertEqual(host['name'], 'fresh')
+        self.assertThat(host[constants.HOST_VERSION_KEY],
+                        matchers.GreaterThan(version))
+        # A host changed after it was read is read again
+        storage = self.backend.storage
+        get_host = storage.get_host
+
+        def get_host_raced(eid, fields=None):
+            '''Reads a host, then changes it behind the caller's back'''
+            host = get_host(eid, fields)
+            if not get_host_raced.raced:
+                get_host_raced.raced = True
+                storage.update_host(eid, {'other': True})
+            return host
+
+        get_host_raced.raced = False
+        with mock.patch.object(storage, 'get_host', get_host_raced):
+            self.backend.update_host(host_id, {'name': 'again'})
+        host = self.backend.get_host(host_id)
+        self.assertEqual((host['name'], host['other']), ('again', True))
+        # ... unless the update is conditional
+        version = host[constants.HOST_VERSION_KEY]
+        get_host_raced.raced = False
+        with mock.patch.object(storage, 'get_host', get_host_raced):
+            self.assertRaises(exceptions.HostVersionMismatchException,
+                              self.backend.update_host, host_id,
+                              {'name': 'lost'}, versions=[version])
+        self.assertEqual(self.backend.get_host(host_id)['name'], 'again')
+        # Concurrent updates of the same host are all applied
+
+        def update(key):
+            '''Sets host keys one at a time'''
+            for idx in range(10):
+                self.backend.update_host(host_id, {key + str(idx): idx})
+
+        threads = [threading.Thread(target=update, args=(x,))
+                   for x in ['a', 'b', 'c']]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        host = self.backend.get_host(host_id)
+        self.assertEqual(
+            [x + str(y) for x in 'abc' for y in range(10)
+             if x + str(y) not in host], [])
+
     def test_release_non_existing_host(self):
         '''Test release a non-existent host'''
         self.assertRaises(exceptions.HostNotFoundException,
@@ -234,3 +475,13 @@ class RestBackendTest(testtools.TestCase):
         '''Test retrieve a non-existent host'''
         self.assertRaises(exceptions.HostNotFoundException,
                           self.backend.get_host, 'test')
+
+
+class RestBackendSQLiteTest(RestBackendTest):
+    '''Runs the REST backend tests against the SQLite storage'''
+    STORAGE_BACKEND = 'sqlite'
+
+
+class RestBackendJournalTest(RestBackendTest):
+    '''Runs the REST backend tests against the journaled storage'''
+    STORAGE_BACKEND = 'journal'
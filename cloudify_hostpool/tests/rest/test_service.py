@@ -25,27 +25,29 @@ import os
 import mock
 import json
 import yaml
+import shutil
 import logging
+import tempfile
 import threading
 import testtools
 
-from ... import constants
+from ... import constants, health
 from ...tests import rest
 from ..._compat import httplib
 
 
-def _mock_scan_alive(self, _):
+def _mock_scan_alive(self, endpoints):
     '''Simulates all hosts being "alive"'''
     if self and self.logger:
         self.logger.debug('_mock_scan_alive()')
-    return True
+    return (idx for idx in range(len(endpoints)))
 
 
-def _mock_scan_dead(self, _):
+def _mock_scan_dead(self, endpoints):
     '''Simulates all hosts being "dead"'''
     if self and self.logger:
         self.logger.debug('_mock_scan_dead()')
-    return False
+    return (idx for idx in [])
 
 
 class ServiceTest(testtools.TestCase):
@@ -64,6 +66,13 @@ class ServiceTest(testtools.TestCase):
 
         from ...rest import service
 
+        # keep the database (and its sidecar files) out of the tree
+        self._workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._workdir)
+        patcher = mock.patch.dict(service.config, {
+            'storage_path': os.path.join(self._workdir, 'db_hostpool.json')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
         # flask feature, should provider more detailed errors
         service.app.config['TESTING'] = True
         # configure Flask to Gunicorn logging
@@ -72,6 +81,7 @@ class ServiceTest(testtools.TestCase):
         service.app.logger.info('Flask, Gunicorn logging enabled')
         # force database initial load
         service.reset_backend()
+        self.config = config
         self.app = service.app.test_client()
         self.app.post('/hosts',
                       data=json.dumps(config),
@@ -85,6 +95,26 @@ class ServiceTest(testtools.TestCase):
         result = self.app.post('/hosts')
         self.assertEqual(result.status_code, httplib.BAD_REQUEST)
 
+    def test_add_hosts_again(self):
+        '''Tests POST /hosts of already added hosts'''
+        host_count = len(json.loads(self.app.get('/hosts').data))
+        result = self.app.post('/hosts',
+                               data=json.dumps(self.config),
+                               content_type='application/json')
+        self.assertEqual(result.status_code, httplib.CREATED)
+        entries = json.loads(result.data)
+        self.assertEqual(len(entries), host_count)
+        self.assertEqual(set(x['result'] for x in entries),
+                         set([constants.HOST_SKIPPED]))
+        self.assertEqual(len(json.loads(self.app.get('/hosts').data)),
+                         host_count)
+        result = self.app.post('/hosts?on_duplicate=reject',
+                               data=json.dumps(self.config),
+                               content_type='application/json')
+        self.assertEqual(result.status_code, httplib.CONFLICT)
+        self.assertEqual(len(json.loads(result.data)['duplicates']),
+                         host_count)
+
     def test_add_host_bad_format(self):
         '''Tests POSt /hosts with non-JSON data'''
         data = {
@@ -151,6 +181,71 @@ class ServiceTest(testtools.TestCase):
             self.assertIsNotNone(host[constants.HOST_ID_KEY])
             self.assertIsInstance(host[constants.HOST_ID_KEY], int)
 
+    def test_get_hosts_fields(self):
+        '''Tests GET /hosts and GET /host/<host_id> with fields'''
+        result = self.app.get('/hosts?fields=name,allocated&os=linux')
+        self.assertEqual(result.status_code, httplib.OK)
+        hosts = json.loads(result.data)
+        self.assertThat(len(hosts), testtools.matchers.GreaterThan(0))
+        for host in hosts:
+            self.assertEqual(sorted(host.keys()),
+                             ['allocated', constants.HOST_ID_KEY, 'name'])
+        result = self.app.get('/host/{0}?fields=credentials'.format(
+            hosts[0][constants.HOST_ID_KEY]))
+        self.assertEqual(result.status_code, httplib.OK)
+        self.assertEqual(sorted(json.loads(result.data).keys()),
+                         ['credentials', constants.HOST_ID_KEY])
+
+    def test_get_stats(self):
+        '''Tests GET /stats reports database lock metrics'''
+        self.app.get('/hosts')
+        result = self.app.get('/stats')
+        self.assertEqual(result.status_code, httplib.OK)
+        stats = json.loads(result.data)
+        self.assertEqual(stats['pid'], os.getpid())
+        shared = stats['locks']['database.shared']
+        self.assertThat(shared['wait']['count'],
+                        testtools.matchers.GreaterThan(0))
+        self.assertEqual(shared['waiters'], 0)
+
+    def test_get_probes(self):
+        '''Tests GET /probes reports the probe result of endpoints'''
+        from ...rest import service
+        service.backend.probes.record({'ip': '192.0.2.7', 'port': 22},
+                                      False, now=100)
+        result = self.app.get('/probes')
+        self.assertEqual(result.status_code, httplib.OK)
+        probe = [x for x in json.loads(result.data)
+                 if x['ip'] == '192.0.2.7'][0]
+        self.assertEqual((probe['port'], probe['reachable'], probe['checked']),
+                         (22, False, 100))
+
+    def test_lock_budget(self):
+        '''Tests operations waiting too long for locks get a 503'''
+        from ...rest import service
+        self.patch(service.backend, 'config', dict(
+            service.backend.config, lock_budget_read=0.1))
+        rwlock = service.backend.storage._handle.rwlock
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            '''Holds the database lock from another thread'''
+            with rwlock.exclusive():
+                locked.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.addCleanup(holder.join)
+        self.addCleanup(release.set)
+        self.assertTrue(locked.wait(5))
+        result = self.app.get('/host/1')
+        self.assertEqual(result.status_code, httplib.SERVICE_UNAVAILABLE)
+        data = json.loads(result.data)
+        self.assertEqual(data['lock'], 'database.shared')
+        self.assertEqual(result.headers['Retry-After'],
+                         str(data['retry_after']))
+
     def test_get_host(self):
         '''Tests GET /host/<host_id>'''
         result = self.app.get('/hosts')
@@ -198,6 +293,123 @@ class ServiceTest(testtools.TestCase):
         host = json.loads(result.data)
         self.assertIsInstance(host, dict)
         self.assertIsInstance(host.get('tags'), list)
+        # Conditional updates
+        etag = result.headers['ETag']
+        result = self.app.patch('/host/{0}'.format(host_id),
+                                data=json.dumps({'name': 'first'}),
+                                content_type='application/json',
+                                headers={'If-Match': etag})
+        self.assertEqual(result.status_code, httplib.OK)
+        result = self.app.patch('/host/{0}'.format(host_id),
+                                data=json.dumps({'name': 'second'}),
+                                content_type='application/json',
+                                headers={'If-Match': etag})
+        self.assertEqual(result.status_code, httplib.PRECONDITION_FAILED)
+        self.assertNotEqual(result.headers['ETag'], etag)
+        result = self.app.get('/host/{0}'.format(host_id))
+        self.assertEqual(json.loads(result.data)['name'], 'first')
+
+    def test_get_hosts_since(self):
+        '''Tests GET /hosts?since=<revision> returns the changes only'''
+        result = self.app.get('/hosts')
+        revision = int(result.headers['X-Hostpool-Revision'])
+        host_ids = [x[constants.HOST_ID_KEY]
+                    for x in json.loads(result.data)]
+        self.app.patch('/host/{0}'.format(host_ids[0]),
+                       data=json.dumps({'tags': ['changed']}),
+                       content_type='application/json')
+        self.app.delete('/host/{0}'.format(host_ids[1]))
+        result = self.app.get('/hosts?since={0}&fields=tags'.format(
+            revision))
+        self.assertEqual(result.status_code, httplib.OK)
+        changes = json.loads(result.data)
+        self.assertEqual(changes['revision'], revision + 2)
+        self.assertEqual(result.headers['X-Hostpool-Revision'],
+                         str(revision + 2))
+        self.assertEqual(changes['hosts'], [
+            {constants.HOST_ID_KEY: host_ids[0], 'tags': ['changed']}])
+        self.assertEqual(changes['removed'], [host_ids[1]])
+        # Changed hosts no longer matching the filters are removed too
+        result = self.app.get('/hosts?since={0}&tags=nope'.format(
+            revision))
+        self.assertEqual(json.loads(result.data)['removed'],
+                         sorted(host_ids[:2]))
+        # Nothing changed since
+        result = self.app.get('/hosts?since={0}'.format(revision + 2))
+        self.assertEqual(json.loads(result.data), {
+            'revision': revision + 2, 'hosts': [], 'removed': []})
+        result = self.app.get('/hosts?since={0}'.format(revision + 3))
+        self.assertEqual(result.status_code, httplib.GONE)
+        result = self.app.get('/hosts?since=-1')
+        self.assertEqual(result.status_code, httplib.BAD_REQUEST)
+
+    def test_get_not_modified(self):
+        '''Tests conditional GET /hosts and GET /host/<host_id>'''
+        result = self.app.get('/hosts')
+        etag = result.headers['ETag']
+        self.assertEqual(etag, 'W/"{0}"'.format(
+            result.headers['X-Hostpool-Revision']))
+        host_id = json.loads(result.data)[0][constants.HOST_ID_KEY]
+        result = self.app.get('/hosts', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, httplib.NOT_MODIFIED)
+        self.assertEqual(result.headers['ETag'], etag)
+        self.assertEqual(result.data, b'')
+        result = self.app.get('/host/{0}'.format(host_id))
+        host_etag = result.headers['ETag']
+        self.assertEqual(host_etag, 'W/"{0}"'.format(
+            json.loads(result.data)['version']))
+        result = self.app.get('/host/{0}'.format(host_id),
+                              headers={'If-None-Match': host_etag})
+        self.assertEqual(result.status_code, httplib.NOT_MODIFIED)
+        # Changing another host only changes the pool
+        self.app.patch('/host/{0}'.format(host_id + 1),
+                       data=json.dumps({'tags': ['changed']}),
+                       content_type='application/json')
+        result = self.app.get('/hosts', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, httplib.OK)
+        self.assertNotEqual(result.headers['ETag'], etag)
+        result = self.app.get('/host/{0}'.format(host_id),
+                              headers={'If-None-Match': host_etag})
+        self.assertEqual(result.status_code, httplib.NOT_MODIFIED)
+        self.app.patch('/host/{0}'.format(host_id),
+                       data=json.dumps({'tags': ['changed']}),
+                       content_type='application/json')
+        result = self.app.get('/host/{0}'.format(host_id),
+                              headers={'If-None-Match': host_etag})
+        self.assertEqual(result.status_code, httplib.OK)
+        self.assertNotEqual(result.headers['ETag'], host_etag)
+        result = self.app.get('/host/999999',
+                              headers={'If-None-Match': '*'})
+        self.assertEqual(result.status_code, httplib.NOT_FOUND)
+
+    def test_get_not_modified_health(self):
+        '''Tests conditional GETs across a health check sweep'''
+        from ...rest import service
+        result = self.app.get('/hosts')
+        etag = result.headers['ETag']
+        host_id = json.loads(result.data)[0][constants.HOST_ID_KEY]
+        result = self.app.get('/host/{0}'.format(host_id))
+        host_etag = result.headers['ETag']
+        self.assertFalse(json.loads(result.data)['alive'])
+        scanner = mock.Mock(scan=lambda endpoints: (
+            idx for idx in range(len(endpoints))))
+        checker = health.HealthChecker(service.backend.storage, scanner, 60)
+        self.assertIn(host_id, checker.sweep()[0])
+        # Liveness isn't covered by the (weak) ETags
+        result = self.app.get('/hosts', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, httplib.NOT_MODIFIED)
+        result = self.app.get('/host/{0}'.format(host_id),
+                              headers={'If-None-Match': host_etag})
+        self.assertEqual(result.status_code, httplib.NOT_MODIFIED)
+        result = self.app.get('/host/{0}'.format(host_id))
+        self.assertEqual(result.headers['ETag'], host_etag)
+        self.assertTrue(json.loads(result.data)['alive'])
+        # ... nor by the versions conditional updates compare
+        result = self.app.patch('/host/{0}'.format(host_id),
+                                data=json.dumps({'name': 'checked'}),
+                                content_type='application/json',
+                                headers={'If-Match': host_etag})
+        self.assertEqual(result.status_code, httplib.OK)
 
     def test_delete_host(self):
         '''Tests DELETE /host/<host_id>'''
@@ -229,6 +441,56 @@ class ServiceTest(testtools.TestCase):
         result = self.app.delete('/host/xyz123')
         self.assertEqual(result.status_code, httplib.NOT_FOUND)
 
+    def test_update_hosts(self):
+        '''Tests PATCH /hosts by IDs and by filters'''
+        data = {'ids': [1, 2, 999999], 'updates': {'tags': ['bulk']}}
+        result = self.app.patch('/hosts',
+                                data=json.dumps(data),
+                                content_type='application/json')
+        self.assertEqual(result.status_code, httplib.OK)
+        self.assertEqual(json.loads(result.data), [1, 2])
+        data = {'filters': {'os': 'windows'},
+                'updates': {'endpoint': {'port': 5986}}}
+        result = self.app.patch('/hosts',
+                                data=json.dumps(data),
+                                content_type='application/json')
+        self.assertEqual(result.status_code, httplib.OK)
+        host_ids = json.loads(result.data)
+        self.assertThat(len(host_ids), testtools.matchers.GreaterThan(0))
+        for host_id in host_ids:
+            host = json.loads(self.app.get(
+                '/host/{0}'.format(host_id)).data)
+            self.assertEqual(host['os'], 'windows')
+            self.assertEqual(host['endpoint']['port'], 5986)
+            self.assertIsNotNone(host['endpoint'].get('ip'))
+
+    def test_update_hosts_bad_request(self):
+        '''Tests PATCH /hosts with malformed selections'''
+        for data in [{'updates': {'tags': []}},
+                     {'ids': [1], 'filters': {'os': 'linux'},
+                      'updates': {'tags': []}},
+                     {'ids': ['1'], 'updates': {'tags': []}},
+                     {'filters': {}, 'updates': {'tags': []}},
+                     {'ids': [1]}]:
+            result = self.app.patch('/hosts',
+                                    data=json.dumps(data),
+                                    content_type='application/json')
+            self.assertEqual(result.status_code, httplib.BAD_REQUEST)
+
+    def test_delete_hosts(self):
+        '''Tests DELETE /hosts by filters'''
+        host_count = len(json.loads(self.app.get('/hosts').data))
+        linux_count = len(json.loads(self.app.get('/hosts?os=linux').data))
+        result = self.app.delete('/hosts',
+                                 data=json.dumps({
+                                     'filters': {'os': 'linux'}}),
+                                 content_type='application/json')
+        self.assertEqual(result.status_code, httplib.OK)
+        self.assertEqual(len(json.loads(result.data)), linux_count)
+        hosts = json.loads(self.app.get('/hosts').data)
+        self.assertEqual(len(hosts), host_count - linux_count)
+        self.assertNotIn('linux', [x['os'] for x in hosts])
+
     def allocate(self, data=None, req_os=None):
         '''allocate & deallocate helper'''
         # Allocate
@@ -255,25 +517,25 @@ class ServiceTest(testtools.TestCase):
         self.assertIsInstance(host[constants.HOST_ID_KEY], int)
         self.assertEqual(host['allocated'], False)
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_allocate_windows(self):
         '''Tests allocate & deallocate with OS=Windows'''
         self.allocate(data={'os': 'windows'}, req_os='windows')
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_allocate_linux(self):
         '''Tests allocate & deallocate with OS=Linux'''
         self.allocate(data={'os': 'linux'}, req_os='linux')
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_allocate_no_os(self):
         '''Tests allocate & deallocate without OS'''
         self.allocate()
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_allocate_bad_os(self):
         '''Tests POST /host/allocate with bad OS'''
@@ -285,7 +547,7 @@ class ServiceTest(testtools.TestCase):
         self.assertIn('error', response)
         self.assertIn('Cannot acquire host', response['error'])
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_allocate_bad_os_type(self):
         '''Tests POST /host/allocate with bad OS type'''
@@ -297,7 +559,7 @@ class ServiceTest(testtools.TestCase):
         self.assertIn('error', response)
         self.assertIn('Cannot acquire host', response['error'])
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_allocate_bad_data_format(self):
         '''Tests POST /host/allocate without JSON header'''
@@ -308,7 +570,34 @@ class ServiceTest(testtools.TestCase):
         self.assertIn('error', response)
         self.assertIn('Unexpected data', response['error'])
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
+                _mock_scan_alive)
+    def test_allocate_count(self):
+        '''Tests POST /host/allocate of several hosts at once'''
+        result = self.app.post('/host/allocate',
+                               data=json.dumps({'count': 2}),
+                               content_type='application/json')
+        self.assertEqual(result.status_code, httplib.OK)
+        hosts = json.loads(result.data)
+        self.assertEqual(len(hosts), 2)
+        self.assertTrue(all(x['allocated'] for x in hosts))
+        for host in hosts:
+            self.app.delete('/host/{0}/deallocate'.format(
+                host[constants.HOST_ID_KEY]))
+        for data in [{'count': 2, 'min_count': 3}, {'min_count': 1},
+                     {'count': 2, 'min_count': 0}, {'count': 0},
+                     {'count': 2, 'min_count': -1}]:
+            result = self.app.post('/host/allocate',
+                                   data=json.dumps(data),
+                                   content_type='application/json')
+            self.assertEqual(result.status_code, httplib.BAD_REQUEST)
+            self.assertIn('Unexpected data',
+                          json.loads(result.data)['error'])
+        # Nothing was allocated by the refused requests
+        self.assertFalse(any(x['allocated'] for x in json.loads(
+            self.app.get('/hosts').data)))
+
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_dead)
     def test_allocate_no_free_host(self):
         '''Tests allocate with no available hosts'''
@@ -336,6 +625,13 @@ class ServiceConcurrencyTest(testtools.TestCase):
 
         from ...rest import service
 
+        # keep the database (and its sidecar files) out of the tree
+        self._workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._workdir)
+        patcher = mock.patch.dict(service.config, {
+            'storage_path': os.path.join(self._workdir, 'db_hostpool.json')})
+        patcher.start()
+        self.addCleanup(patcher.stop)
         # flask feature, should provider more detailed errors
         service.app.config['TESTING'] = True
         # configure Flask to Gunicorn logging
@@ -385,7 +681,7 @@ class ServiceConcurrencyTest(testtools.TestCase):
             self.assertIsInstance(host[constants.HOST_ID_KEY], int)
             self.assertEqual(host['allocated'], False)
 
-    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.host_port_scan',
+    @mock.patch('cloudify_hostpool.rest.backend.RestBackend.scan_endpoints',
                 _mock_scan_alive)
     def test_multithread_acquire(self):
         '''Tests allocate with multiple threads'''
@@ -0,0 +1,76 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_durability
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the storage durability policies
+'''
+
+import os
+import mock
+import shutil
+import tempfile
+import testtools
+
+from ... import exceptions
+from ...storage import durability
+
+
+class DurabilityTest(testtools.TestCase):
+    '''Test class for the storage durability policies'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'hosts.json')
+
+    def test_validate(self):
+        '''Test unknown policies are refused'''
+        for policy in durability.DURABILITY_POLICIES:
+            self.assertEqual(durability.validate(policy), policy)
+        self.assertRaises(exceptions.ConfigurationError,
+                          durability.validate, 'sometimes')
+
+    def test_replace_file(self):
+        '''Test files are replaced by a rename, leaving no temp file'''
+        with open(self.path, 'wb') as f_db:
+            f_db.write(b'old contents')
+        inode = os.stat(self.path).st_ino
+        durability.replace_file(self.path, b'new')
+        with open(self.path, 'rb') as f_db:
+            self.assertEqual(f_db.read(), b'new')
+        self.assertNotEqual(os.stat(self.path).st_ino, inode)
+        self.assertEqual(os.listdir(self.workdir), ['hosts.json'])
+
+    def test_interval_sync(self):
+        '''Test writes are fsynced at most once per interval'''
+        with open(self.path, 'wb') as f_db, \
+                mock.patch.object(durability.os, 'fsync') as fsync:
+            syncer = durability.IntervalSync(f_db, interval=60)
+            syncer.written()
+            self.assertEqual(fsync.call_count, 1)
+            syncer.written()
+            syncer.written()
+            self.assertEqual(fsync.call_count, 1)
+            self.assertIsNotNone(syncer.timer)
+            syncer.close()
+            self.assertEqual(fsync.call_count, 2)
+            self.assertIsNone(syncer.timer)
+
+    def test_benchmark(self):
+        '''Test the benchmark runs every backend'''
+        for backend in ['tinydb', 'journal', 'sqlite']:
+            self.assertGreater(durability.benchmark(
+                backend, durability.DURABILITY_NONE, 5, 2), 0)
@@ -0,0 +1,67 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_index
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the in-memory inverted host index
+'''
+
+import testtools
+
+from ...storage.index import HostIndex
+from .test_sqlite_sql import _generate_hosts
+
+
+class HostIndexTest(testtools.TestCase):
+    '''Test class for the inverted host index'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.index = HostIndex(dict(
+            (idx + 1, host) for idx, host in enumerate(_generate_hosts(6))))
+
+    def test_select(self):
+        '''Test filters are evaluated as set intersections'''
+        self.assertEqual(self.index.select(dict()), set(range(1, 7)))
+        self.assertEqual(self.index.select({'os': 'LINUX'}), set([2, 4, 6]))
+        self.assertEqual(self.index.select({'tags': ['all', 'test_1']}),
+                         set([2]))
+        self.assertEqual(self.index.select({'tags': ['test_1', 'test_2']}),
+                         set())
+        self.assertEqual(self.index.select({'os': 'windows',
+                                            'tags': ['test_1']}), set())
+        self.assertEqual(self.index.select({'tags': ['unknown']}), set())
+        self.assertEqual(self.index.select({'os': 'linux',
+                                            'ids': [1, 2, 4, 9]}),
+                         set([2, 4]))
+
+    def test_update(self):
+        '''Test re-indexing changed and removed hosts'''
+        self.index.update(2, {'os': 'windows', 'tags': ['new'],
+                              'allocated': True})
+        self.index.update(3, None)
+        self.assertEqual(self.index.select({'allocated': True}), set([2]))
+        self.assertEqual(self.index.select({'allocated': False}),
+                         set([1, 4, 5, 6]))
+        self.assertEqual(self.index.select({'tags': ['test_1']}), set())
+        self.assertEqual(self.index.select({'tags': ['new'],
+                                            'os': 'windows'}), set([2]))
+        self.assertNotIn('test_2', self.index.by_tag)
+
+    def test_find_endpoint(self):
+        '''Test looking up hosts by (ip, port) endpoint'''
+        self.assertEqual(self.index.find_endpoint(('172.16.0.11', 22)), 2)
+        self.assertIsNone(self.index.find_endpoint(('172.16.0.11', 23)))
+        self.index.update(2, None)
+        self.assertIsNone(self.index.find_endpoint(('172.16.0.11', 22)))
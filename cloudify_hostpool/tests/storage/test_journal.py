@@ -0,0 +1,143 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_journal
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the journaled TinyDB storage backend
+'''
+
+import os
+import json
+import shutil
+import tempfile
+import testtools
+
+from ...storage import journal, tinydb_nosql
+from .test_sqlite_sql import _check_change_log, _generate_hosts
+
+
+class JournalDatabaseTest(testtools.TestCase):
+    '''Test class for the journaled TinyDB storage backend'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.db_path = os.path.join(self.workdir, 'hosts.json')
+        self.journal_path = self.db_path + journal.JOURNAL_SUFFIX
+        self.db = journal.Database(self.db_path, sync_every=1)
+
+    def reopen(self):
+        '''Simulates another process (or a restart) opening the files'''
+        tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+        return journal.Database(self.db_path)
+
+    def test_mutations_append_records(self):
+        '''Test every mutation appends a single small record'''
+        self.db.add_hosts(_generate_hosts(50))
+        snapshot_size = os.path.getsize(self.db_path)
+        sizes = [os.path.getsize(self.journal_path)]
+        for eid in [10, 25, 50]:
+            self.db.update_host(eid, {'allocated': True})
+            sizes.append(os.path.getsize(self.journal_path))
+        # The snapshot is untouched, each record costs the same
+        self.assertEqual(os.path.getsize(self.db_path), snapshot_size)
+        self.assertEqual(len(set(
+            b - a for a, b in zip(sizes, sizes[1:]))), 1)
+        self.assertTrue(self.db.get_host(25)['allocated'])
+
+    def test_replay(self):
+        '''Test a new process replays the snapshot plus journal'''
+        self.db.add_hosts(_generate_hosts(3))
+        self.db.update_host(2, {'allocated': True})
+        self.db.remove_host(3)
+        other = self.reopen()
+        hosts = other.get_hosts()
+        self.assertEqual([x['id'] for x in hosts], [1, 2])
+        self.assertTrue(other.get_host(2)['allocated'])
+        self.assertEqual(other.add_hosts(_generate_hosts(1)), [3])
+
+    def test_tail_other_process(self):
+        '''Test records appended by other processes are picked up'''
+        self.db.add_hosts(_generate_hosts(2))
+        other = self.reopen()
+        self.assertEqual(len(other.get_hosts()), 2)
+        self.db.update_host(1, {'allocated': True})
+        self.assertTrue(other.get_host(1)['allocated'])
+
+    def test_tail_updates_index(self):
+        '''Test replayed records keep the host index up to date'''
+        self.db.add_hosts(_generate_hosts(4))
+        other = self.reopen()
+        self.assertEqual(len(other.get_hosts({'allocated': False})), 4)
+        self.db.allocate_if_free(1)
+        self.db.update_hosts([2, 3], {'tags': ['bulk']})
+        self.db.remove_host(4)
+        self.assertEqual([x['id'] for x in other.get_hosts(
+            {'allocated': False})], [2, 3])
+        self.assertEqual([x['id'] for x in other.get_hosts(
+            {'tags': ['bulk'], 'os': 'linux'})], [2])
+
+    def test_change_log(self):
+        '''Test the change log is journaled and replayed'''
+        _check_change_log(self, self.db, self.reopen)
+        self.db.compact()
+        self.assertEqual(self.reopen().get_revision(), 12)
+
+    def test_credentials(self):
+        '''Test credentials are journaled and compacted'''
+        self.db.add_credentials({'ref1': {'username': 'ubuntu'}})
+        self.assertEqual(self.reopen().get_credentials('ref1'),
+                         {'username': 'ubuntu'})
+        self.db.compact()
+        self.assertEqual(self.reopen().get_credentials('ref1'),
+                         {'username': 'ubuntu'})
+
+    def test_compact(self):
+        '''Test compaction folds the journal into the snapshot'''
+        self.db.add_hosts(_generate_hosts(3))
+        self.db.update_host(1, {'allocated': True})
+        other = self.reopen()
+        self.assertEqual(len(other.get_hosts()), 3)
+        self.db.compact()
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        with open(self.db_path) as f_db:
+            self.assertTrue(json.load(f_db)['hosts']['1']['allocated'])
+        # Other processes switch to the new snapshot and journal
+        self.db.update_host(2, {'allocated': True})
+        self.assertTrue(other.get_host(1)['allocated'])
+        self.assertTrue(other.get_host(2)['allocated'])
+        self.assertEqual(len(self.reopen().get_hosts()), 3)
+
+    def test_init_data(self):
+        '''Test wiping the database through the journal'''
+        self.db.add_hosts(_generate_hosts(3))
+        self.db.init_data()
+        self.assertEqual(self.reopen().get_hosts(), list())
+
+    def test_bulk_update_remove(self):
+        '''Test bulk operations append a single record each'''
+        self.db.add_hosts(_generate_hosts(4))
+        size = os.path.getsize(self.journal_path)
+        self.db.update_hosts([1, 2], {'endpoint': {'port': 2222}})
+        self.db.remove_hosts([3, 4])
+        with open(self.journal_path) as f_journal:
+            records = [json.loads(x) for x in f_journal.read()[size:]
+                       .splitlines()]
+        self.assertEqual([x['op'] for x in records],
+                         [journal.OP_MERGE, journal.OP_REMOVE])
+        other = self.reopen()
+        self.assertEqual([x['id'] for x in other.get_hosts()], [1, 2])
+        self.assertEqual(other.get_host(2)['endpoint'],
+                         dict(_generate_hosts(2)[1]['endpoint'], port=2222))
@@ -0,0 +1,109 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_locking
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the database reader / writer lock
+'''
+
+import os
+import shutil
+import tempfile
+import threading
+import testtools
+
+from ... import exceptions
+from ...storage import locking
+
+
+class RWLockTest(testtools.TestCase):
+    '''Test class for the database reader / writer lock'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.lock = locking.RWLock(os.path.join(self.workdir, 'hosts.lck'))
+
+    def run_thread(self, mode):
+        '''Tries to take the lock from another thread'''
+        acquired = threading.Event()
+
+        def target():
+            '''Takes the lock'''
+            with getattr(self.lock, mode)():
+                acquired.set()
+
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread, acquired
+
+    def test_shared(self):
+        '''Test readers share the lock and writers wait for them'''
+        with self.lock.shared():
+            _, acquired = self.run_thread('shared')
+            self.assertTrue(acquired.wait(5))
+            thread, acquired = self.run_thread('exclusive')
+            self.assertFalse(acquired.wait(0.2))
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_exclusive(self):
+        '''Test writers exclude readers, and nest'''
+        with self.lock.exclusive():
+            thread, acquired = self.run_thread('shared')
+            self.assertFalse(acquired.wait(0.2))
+            with self.lock.shared():
+                with self.lock.exclusive():
+                    self.assertEqual(self.lock.held, locking.fcntl.LOCK_EX)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+        self.assertIsNone(self.lock.held)
+
+    def test_wait_budget(self):
+        '''Test lock waits past the budget fail with a retry estimate'''
+        locked, release = threading.Event(), threading.Event()
+
+        def hold():
+            '''Holds the lock from another thread'''
+            with self.lock.exclusive():
+                locked.set()
+                release.wait(10)
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        self.assertTrue(locked.wait(5))
+        try:
+            with locking.wait_budget(0.1):
+                with locking.wait_budget(60):
+                    ex = self.assertRaises(
+                        exceptions.LockTimeoutException,
+                        self.lock.shared().__enter__)
+                self.assertEqual(locking.remaining_budget(), 0)
+            self.assertIsNone(locking.remaining_budget())
+        finally:
+            release.set()
+            holder.join()
+        self.assertEqual(ex.lock, 'database.shared')
+        self.assertGreaterEqual(ex.waited, 0.1)
+        self.assertGreaterEqual(ex.retry_after, 1)
+        self.assertEqual(ex.get_headers(),
+                         {'Retry-After': str(ex.retry_after)})
+
+    def test_no_upgrade(self):
+        '''Test a shared lock can't be upgraded'''
+        with self.lock.shared():
+            self.assertRaises(RuntimeError,
+                              self.lock.exclusive().__enter__)
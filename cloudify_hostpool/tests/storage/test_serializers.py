@@ -0,0 +1,50 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_serializers
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the storage file formats
+'''
+
+import json
+import testtools
+
+from ...storage import serializers
+
+
+class SerializersTest(testtools.TestCase):
+    '''Test class for the storage file formats'''
+    def test_round_trip(self):
+        '''Test every format loads back, with and without compression'''
+        data = serializers._generate_data(10)
+        for fmt in serializers.FORMATS:
+            for compress in [False, True]:
+                loaded = serializers.loads(
+                    serializers.dumps(data, fmt, compress))
+                self.assertEqual(loaded, data)
+
+    def test_detect_json(self):
+        '''Test plain (TinyDB) JSON and empty files are detected'''
+        self.assertEqual(serializers.loads(b'{"hosts": {}}'), {'hosts': {}})
+        self.assertEqual(
+            json.loads(serializers.dumps(
+                {'hosts': {1: {}}}, serializers.FORMAT_FAST_JSON).decode()),
+            {'hosts': {'1': {}}})
+        self.assertIsNone(serializers.loads(b''))
+
+    def test_benchmark(self):
+        '''Test the benchmark reports every format'''
+        rows = serializers.benchmark(10, rounds=1)
+        self.assertEqual(len(rows), len(serializers.FORMATS) * 2)
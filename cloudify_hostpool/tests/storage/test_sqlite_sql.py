@@ -0,0 +1,272 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_sqlite_sql
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the SQLite storage backend
+'''
+
+import os
+import json
+import shutil
+import sqlite3
+import mock
+import tempfile
+import testtools
+
+from ... import constants, exceptions
+from ...storage import sqlite_sql, tinydb_nosql
+
+
+def _generate_hosts(count):
+    '''Generate a list of hosts'''
+    return [{
+        'name': 'test-host-{0}'.format(idx),
+        'os': 'linux' if idx % 2 else 'windows',
+        'endpoint': {
+            'ip': '172.16.0.{0}'.format(idx + 10),
+            'port': 22,
+            'protocol': 'ssh'
+        },
+        'credentials': {'username': 'ubuntu'},
+        'tags': ['test_{0}'.format(idx), 'all'],
+        'allocated': False,
+        'alive': False
+    } for idx in range(count)]
+
+
+def _check_change_log(test, db, reopen=None):
+    '''Checks the revision and change log of any storage backend'''
+    reopen = reopen or (lambda: db)
+    test.assertEqual(db.get_revision(), 0)
+    db.add_hosts(_generate_hosts(3))
+    db.update_host(2, {'name': 'renamed'})
+    db.allocate_if_free(3)
+    db.remove_hosts([1, 3])
+    other = reopen()
+    test.assertEqual(other.get_revision(), 7)
+    test.assertEqual(other.get_changes(4), [
+        {'revision': 5, 'id': 3, 'op': constants.CHANGE_UPDATE},
+        {'revision': 6, 'id': 1, 'op': constants.CHANGE_REMOVE},
+        {'revision': 7, 'id': 3, 'op': constants.CHANGE_REMOVE}])
+    test.assertEqual(other.get_changes(7), [])
+    test.assertIsNone(other.get_changes(8))
+    # Hosts are versioned with the revision of their last change
+    test.assertEqual(other.get_host(2)[constants.HOST_VERSION_KEY], 4)
+    test.assertEqual(other.get_hosts()[0][constants.HOST_VERSION_KEY], 4)
+    test.assertEqual(other.get_host_version(2), 4)
+    test.assertIsNone(other.get_host_version(1))
+    db.init_data()
+    test.assertEqual(reopen().get_changes(7), [
+        {'revision': 8, 'id': None, 'op': constants.CHANGE_PURGE}])
+    with mock.patch.object(constants, 'CHANGE_LOG_SIZE', 2):
+        db.add_hosts(_generate_hosts(3))
+        other = reopen()
+        test.assertEqual(other.get_revision(), 11)
+        test.assertIsNone(other.get_changes(8))
+        test.assertEqual([x['revision'] for x in other.get_changes(9)],
+                         [10, 11])
+    # Updates conditional on the host version
+    test.assertIsNone(db.update_host(1, {'name': 'stale'}, version=8))
+    test.assertEqual(db.update_host(1, {'name': 'fresh'}, version=9), 1)
+    test.assertIsNone(db.update_host(4, {'name': 'none'}, version=0))
+    test.assertEqual(reopen().get_host(1)['name'], 'fresh')
+
+
+class SQLiteDatabaseTest(testtools.TestCase):
+    '''Test class for the SQLite storage backend'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.db = sqlite_sql.Database(
+            os.path.join(self.workdir, 'hosts.sqlite'))
+        self.addCleanup(self.db.close)
+
+    def test_add_get_hosts(self):
+        '''Test adding and retrieving hosts'''
+        host_ids = self.db.add_hosts(_generate_hosts(3))
+        self.assertEqual(host_ids, [1, 2, 3])
+        hosts = self.db.get_hosts()
+        self.assertEqual([x[constants.HOST_ID_KEY] for x in hosts],
+                         host_ids)
+        host = self.db.get_host(2)
+        self.assertEqual(host['name'], 'test-host-1')
+        self.assertEqual(host['endpoint']['ip'], '172.16.0.11')
+        self.assertEqual(self.db.get_host(999), dict())
+
+    def test_get_hosts_filters(self):
+        '''Test filtered reads on the indexed columns and tags'''
+        self.db.add_hosts(_generate_hosts(6))
+        self.db.allocate_if_free(4)
+        self.assertEqual([x['id'] for x in self.db.get_hosts(
+            {'os': 'LINUX', 'allocated': False})], [2, 6])
+        self.assertEqual([x['id'] for x in self.db.get_hosts(
+            {'tags': ['all', 'test_1', 'all']})], [2])
+        self.assertEqual(self.db.get_hosts(
+            {'tags': ['test_1', 'test_2']}), list())
+
+    def test_fields(self):
+        '''Test field projections of host reads'''
+        self.db.add_hosts(_generate_hosts(2))
+        self.assertEqual(self.db.get_hosts(
+            filters={'os': 'windows'}, fields=['name']),
+            [{'id': 1, 'name': 'test-host-0'}])
+        self.assertEqual(self.db.get_host(2, fields=['endpoint']), {
+            'id': 2, 'endpoint': _generate_hosts(2)[1]['endpoint']})
+
+    def test_update_host(self):
+        '''Test updating a single host row and its tags'''
+        self.db.add_hosts(_generate_hosts(2))
+        self.assertEqual(self.db.update_host(1, {'allocated': True}), 1)
+        self.assertTrue(self.db.get_host(1)['allocated'])
+        self.assertFalse(self.db.get_host(2)['allocated'])
+        self.db.update_host(1, {'tags': ['other']})
+        with self.db.connect() as dbc:
+            tags = dbc.execute(
+                'SELECT tag FROM host_tags WHERE host_id = 1').fetchall()
+            allocated = dbc.execute(
+                'SELECT id FROM hosts WHERE allocated = 1').fetchall()
+        self.assertEqual(tags, [('other',)])
+        self.assertEqual(allocated, [(1,)])
+        self.assertIsNone(self.db.update_host(999, {'allocated': True}))
+
+    def test_remove_host(self):
+        '''Test removing a host'''
+        self.db.add_hosts(_generate_hosts(2))
+        self.assertEqual(self.db.remove_host(1), 1)
+        self.assertIsNone(self.db.remove_host(1))
+        self.assertEqual(len(self.db.get_hosts()), 1)
+
+    def test_bulk_update_remove(self):
+        '''Test bulk updates merge documents and keep columns in sync'''
+        self.db.add_hosts(_generate_hosts(4))
+        self.assertEqual(self.db.update_hosts(
+            [1, 3, 999], {'endpoint': {'port': 2222}, 'tags': ['bulk']}),
+            [1, 3])
+        self.assertEqual(self.db.get_host(3)['endpoint']['ip'],
+                         '172.16.0.12')
+        self.assertEqual(self.db.remove_hosts([2, 3, 999]), [2, 3])
+        with self.db.connect() as dbc:
+            self.assertEqual(dbc.execute(
+                'SELECT host_id FROM host_tags WHERE tag = ?',
+                ('bulk',)).fetchall(), [(1,)])
+            self.assertEqual(dbc.execute(
+                'SELECT id FROM hosts WHERE port = 2222').fetchall(), [(1,)])
+
+    def test_allocate_if_free(self):
+        '''Test allocating and releasing a host'''
+        self.db.add_hosts(_generate_hosts(2))
+        self.assertTrue(self.db.allocate_if_free(2)['allocated'])
+        self.assertEqual(self.db.allocate_if_free(2), dict())
+        self.assertEqual(self.db.allocate_if_free(999), dict())
+        self.assertFalse(self.db.release(2)['allocated'])
+        self.assertEqual(self.db.release(999), dict())
+        # Several at once, skipping allocated and unknown hosts
+        self.assertEqual(self.db.allocate_if_free(2)['id'], 2)
+        self.assertEqual([x['id'] for x in self.db.allocate_hosts(
+            [1, 2, 999])], [1])
+        self.assertEqual([x['id'] for x in self.db.release_hosts(
+            [1, 2, 999])], [1, 2])
+        with self.db.connect() as dbc:
+            self.assertEqual(dbc.execute(
+                'SELECT COUNT(*) FROM hosts WHERE allocated = 1').fetchone(),
+                (0,))
+
+    def test_change_log(self):
+        '''Test mutations bump the revision and fill the change log'''
+        _check_change_log(self, self.db)
+
+    def test_unversioned_database(self):
+        '''Test databases created before hosts were versioned'''
+        path = os.path.join(self.workdir, 'old.sqlite')
+        conn = sqlite3.connect(path)
+        conn.execute('CREATE TABLE hosts (id INTEGER PRIMARY KEY '
+                     'AUTOINCREMENT, name TEXT, os TEXT, allocated INTEGER, '
+                     'alive INTEGER, ip TEXT, port INTEGER, document TEXT)')
+        conn.execute('INSERT INTO hosts (name, document) VALUES (?, ?)',
+                     ('old', json.dumps({'name': 'old'})))
+        conn.commit()
+        conn.close()
+        db = sqlite_sql.Database(path)
+        self.addCleanup(db.close)
+        self.assertEqual(db.get_host(1)[constants.HOST_VERSION_KEY], 0)
+        db.update_host(1, {'name': 'new'})
+        self.assertEqual(db.get_host_version(1), 1)
+
+    def test_durability(self):
+        '''Test durability policies map to the synchronous setting'''
+        with self.db.connect() as dbc:
+            self.assertEqual(
+                dbc.execute('PRAGMA synchronous').fetchone()[0], 2)
+        db = sqlite_sql.Database(
+            os.path.join(self.workdir, 'hosts.sqlite'), durability='none')
+        self.addCleanup(db.close)
+        with db.connect() as dbc:
+            self.assertEqual(
+                dbc.execute('PRAGMA synchronous').fetchone()[0], 0)
+
+    def test_credentials(self):
+        '''Test the content-addressed credentials table'''
+        self.db.add_credentials({'ref1': {'username': 'ubuntu'}})
+        self.db.add_credentials({'ref1': {'username': 'other'}})
+        self.assertEqual(self.db.get_credentials('ref1'),
+                         {'username': 'ubuntu'})
+        self.assertEqual(self.db.get_credentials('ref2'), dict())
+
+    def test_init_data(self):
+        '''Test wiping the database restarts host IDs'''
+        self.db.add_hosts(_generate_hosts(2))
+        self.db.init_data()
+        self.assertEqual(self.db.get_hosts(), list())
+        self.assertEqual(self.db.add_hosts(_generate_hosts(1)), [1])
+
+    def test_import_json(self):
+        '''Test the one-shot TinyDB importer'''
+        json_path = os.path.join(self.workdir, 'hosts.json')
+        tdb = tinydb_nosql.Database(json_path)
+        tdb.add_hosts(_generate_hosts(3))
+        tdb.remove_host(1)
+        tdb.update_host(3, {'allocated': True})
+        tdb.add_credentials({'ref1': {'username': 'ubuntu'}})
+        revision = self.db.get_revision()
+        self.assertEqual(self.db.import_json(json_path), [2, 3])
+        # Imported hosts are versioned and in the change log
+        self.assertEqual(self.db.get_revision(), revision + 2)
+        self.assertEqual(
+            [(x['id'], x['op']) for x in self.db.get_changes(revision)],
+            [(2, constants.CHANGE_ADD), (3, constants.CHANGE_ADD)])
+        self.assertEqual(self.db.get_host_version(2), revision + 1)
+        self.assertEqual(self.db.get_host(3)[constants.HOST_VERSION_KEY],
+                         revision + 2)
+        self.assertEqual(self.db.get_credentials('ref1'),
+                         {'username': 'ubuntu'})
+        self.assertEqual(self.db.get_host(2)['name'], 'test-host-1')
+        self.assertTrue(self.db.get_host(3)['allocated'])
+        # New hosts must not reuse imported IDs
+        self.assertEqual(self.db.add_hosts(_generate_hosts(1)), [4])
+        # A second import is refused
+        self.assertRaises(exceptions.StorageException,
+                          self.db.import_json, json_path)
+
+    def test_import_json_cli(self):
+        '''Test the importer command line entry point'''
+        json_path = os.path.join(self.workdir, 'hosts.json')
+        with open(json_path, 'w') as f_db:
+            json.dump({'hosts': {'7': _generate_hosts(1)[0]}}, f_db)
+        target = os.path.join(self.workdir, 'cli.sqlite')
+        self.assertEqual(sqlite_sql.main([json_path, target]), 0)
+        self.assertEqual(sqlite_sql.Database(target).get_host(7)['name'],
+                         'test-host-0')
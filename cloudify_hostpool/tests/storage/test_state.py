@@ -0,0 +1,72 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_state
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the shared host state
+'''
+
+import os
+import shutil
+import tempfile
+import testtools
+
+from ...storage import state
+
+
+class HostStateTest(testtools.TestCase):
+    '''Test class for the shared host state'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'hosts.json.state')
+        self.state = state.HostState(self.path)
+        self.addCleanup(self.state.close)
+
+    def test_no_state(self):
+        '''Test a missing state file is only created by writers'''
+        self.assertIsNone(self.state.layout)
+        self.assertEqual(self.state.free_ids(), set())
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_update(self):
+        '''Test flags and revisions are shared through the file'''
+        self.state.rebuild({1: {}, 2: {'allocated': True}, 3: {}})
+        other = state.HostState(self.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.free_ids(), set([1, 3]))
+        layout, revision = other.layout, other.revision
+        self.state.update({1: {'allocated': True, 'alive': True}},
+                          layout=False)
+        self.assertEqual(other.free_ids(), set([3]))
+        self.assertEqual(other.flags(1),
+                         state.FLAG_EXISTS | state.FLAG_ALLOCATED |
+                         state.FLAG_ALIVE)
+        self.assertEqual(other.revision, revision + 1)
+        self.assertEqual(other.layout, layout)
+        self.state.update({3: None})
+        self.assertEqual(other.free_ids(), set())
+        self.assertEqual(other.layout, layout + 1)
+
+    def test_grow(self):
+        '''Test readers follow the growth of the state file'''
+        self.state.rebuild({1: {}})
+        other = state.HostState(self.path)
+        self.addCleanup(other.close)
+        self.assertEqual(other.free_ids(), set([1]))
+        self.state.update({state.MIN_CAPACITY * 3: {}})
+        self.assertEqual(other.free_ids(),
+                         set([1, state.MIN_CAPACITY * 3]))
@@ -0,0 +1,413 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.storage.test_tinydb_nosql
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the TinyDB storage backend
+'''
+
+import os
+import json
+import time
+import mock
+import shutil
+import tempfile
+import threading
+import testtools
+
+from ... import constants, exceptions, metrics
+from ...storage import locking, serializers, tinydb_nosql
+from .test_sqlite_sql import _check_change_log, _generate_hosts
+
+
+class TinyDBDatabaseTest(testtools.TestCase):
+    '''Test class for the TinyDB storage backend'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.db_path = os.path.join(self.workdir, 'hosts.json')
+        self.db = tinydb_nosql.Database(self.db_path)
+
+    def age_file(self):
+        '''Moves the database file mtime out of the racy window'''
+        past = time.time() - 10
+        os.utime(self.db_path, (past, past))
+
+    def write_externally(self, hosts):
+        '''Simulates another worker rewriting the database file'''
+        with open(self.db_path, 'w') as f_db:
+            json.dump({'hosts': dict(
+                (str(idx + 1), host) for idx, host in enumerate(hosts))},
+                f_db)
+        self.age_file()
+
+    def test_handle_is_shared(self):
+        '''Test a process keeps one handle per database file'''
+        other = tinydb_nosql.Database(self.db_path)
+        self.assertIs(self.db._handle, other._handle)
+
+    def test_unchanged_reads_are_cached(self):
+        '''Test reads on an unchanged pool do not read the file'''
+        self.db.add_hosts(_generate_hosts(3))
+        self.age_file()
+        self.assertEqual(len(self.db.get_hosts()), 3)
+        with mock.patch.object(tinydb_nosql.SerializedStorage, 'read') as read:
+            self.assertEqual(len(self.db.get_hosts()), 3)
+            self.assertEqual(self.db.get_host(2)['name'], 'test-host-1')
+            self.assertEqual(read.call_count, 0)
+
+    def test_own_writes_stay_cached(self):
+        '''Test a fresh write does not make the writer re-read the file'''
+        self.db.add_hosts(_generate_hosts(3))
+        with mock.patch.object(tinydb_nosql.SerializedStorage, 'read') as read:
+            for idx in range(10):
+                self.db.update_host(1, {'name': 'renamed-{0}'.format(idx)})
+                self.assertEqual(self.db.get_host(1)['name'],
+                                 'renamed-{0}'.format(idx))
+            self.assertEqual(read.call_count, 0)
+
+    def test_state_revision_invalidates(self):
+        '''Test writes are seen even if the file signature is unchanged'''
+        class OtherHandle(tinydb_nosql.CachedHandle):
+            '''Handle of another process'''
+        other = tinydb_nosql.Database(self.db_path)
+        other._handle = tinydb_nosql.get_handle(self.db_path, OtherHandle)
+        self.db.add_hosts(_generate_hosts(3))
+        self.assertEqual(other.get_host(1)['name'], 'test-host-0')
+        stat = os.stat(self.db_path)
+        self.db.update_host(1, {'name': 'test-host-9'})
+        # Same size, and the mtime of a coarse clock
+        os.utime(self.db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(other.get_host(1)['name'], 'test-host-9')
+
+    def test_external_writes_are_seen(self):
+        '''Test writes of other processes invalidate the cache'''
+        self.db.add_hosts(_generate_hosts(3))
+        self.age_file()
+        self.assertEqual(len(self.db.get_hosts()), 3)
+        self.write_externally(_generate_hosts(5))
+        self.assertEqual(len(self.db.get_hosts()), 5)
+        # New IDs must not collide with the externally added hosts
+        self.assertEqual(self.db.add_hosts(_generate_hosts(1)), [6])
+
+    def test_returned_hosts_are_detached(self):
+        '''Test modifying a returned host does not modify the cache'''
+        self.db.add_hosts(_generate_hosts(1))
+        host = self.db.get_host(1)
+        host['credentials']['username'] = 'changed'
+        self.assertEqual(self.db.get_host(1)['credentials']['username'],
+                         'ubuntu')
+
+    def test_deferred_flush(self):
+        '''Test the deferred flush policy batches file writes'''
+        db = tinydb_nosql.Database(
+            os.path.join(self.workdir, 'deferred.json'),
+            flush=tinydb_nosql.FLUSH_DEFERRED, flush_every=4)
+        db.add_hosts(_generate_hosts(2))
+        with mock.patch.object(tinydb_nosql.SerializedStorage,
+                               'write') as write:
+            db.update_host(1, {'allocated': True})
+            db.update_host(2, {'allocated': True})
+            self.assertEqual(write.call_count, 0)
+            db.get_host(1)
+            self.assertEqual(write.call_count, 1)
+        db.close()
+
+    def test_allocate_if_free(self):
+        '''Test allocating and releasing a host'''
+        self.db.add_hosts(_generate_hosts(2))
+        host = self.db.allocate_if_free(1)
+        self.assertEqual(host['id'], 1)
+        self.assertTrue(host['allocated'])
+        self.assertEqual(self.db.allocate_if_free(1), dict())
+        self.assertEqual(self.db.allocate_if_free(999), dict())
+        self.assertFalse(self.db.release(1)['allocated'])
+        self.assertEqual(self.db.release(999), dict())
+        # Several at once, skipping allocated and unknown hosts
+        self.assertEqual(self.db.allocate_if_free(2)['id'], 2)
+        self.assertEqual([x['id'] for x in self.db.allocate_hosts(
+            [1, 2, 999])], [1])
+        self.assertEqual([x['id'] for x in self.db.release_hosts(
+            [1, 2, 999])], [1, 2])
+        self.assertTrue(self.db.allocate_if_free(1)['allocated'])
+
+    def test_allocate_if_free_concurrent(self):
+        '''Test concurrent allocations of a host have a single winner'''
+        self.db.add_hosts(_generate_hosts(1))
+        results = []
+
+        def allocate():
+            '''Thread body, tries to allocate the host'''
+            results.append(self.db.allocate_if_free(1))
+        threads = [threading.Thread(target=allocate) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len([x for x in results if x]), 1)
+
+    def test_group_commit(self):
+        '''Test concurrent writes are committed with a single file write'''
+        self.db.add_hosts(_generate_hosts(8))
+        db = tinydb_nosql.Database(self.db_path, commit_delay=0.1)
+        errors = list()
+
+        def update(eid):
+            '''Updates a host, or fails to'''
+            try:
+                if eid == 8:
+                    db.update_hosts([eid], None)
+                else:
+                    db.update_host(eid, {'name': 'updated'})
+            except AttributeError as ex:
+                errors.append(ex)
+
+        write = tinydb_nosql.SerializedStorage.write
+        with mock.patch.object(tinydb_nosql.SerializedStorage, 'write',
+                               autospec=True, side_effect=write) as writes:
+            threads = [threading.Thread(target=update, args=(x + 1,))
+                       for x in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLess(writes.call_count, 4)
+        # A failed write only fails its own writer
+        self.assertEqual(len(errors), 1)
+        tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+        hosts = tinydb_nosql.Database(self.db_path).get_hosts()
+        self.assertEqual([x['name'] for x in hosts],
+                         ['updated'] * 7 + ['test-host-7'])
+
+    def run_writers(self, budgets, hold):
+        '''Renames hosts from concurrent writers (one per lock wait
+        budget, the first one leads) while another process holds the
+        database lock for `hold` seconds
+
+        :returns: The result (or exception) of each writer
+        :rtype: list
+        '''
+        self.db.add_hosts(_generate_hosts(len(budgets)))
+        db = tinydb_nosql.Database(self.db_path, commit_delay=0.1)
+        results = [None] * len(budgets)
+
+        def update(idx):
+            '''Renames a host within a lock wait budget'''
+            try:
+                with locking.wait_budget(budgets[idx]):
+                    results[idx] = db.update_host(idx + 1,
+                                                  {'name': 'updated'})
+            except exceptions.LockTimeoutException as ex:
+                results[idx] = ex
+        other = locking.RWLock(self.db_path + locking.LOCK_SUFFIX)
+        with other.exclusive():
+            threads = [threading.Thread(target=update, args=(x,))
+                       for x in range(len(budgets))]
+            threads[0].start()
+            while not db._handle.committer.leading:
+                time.sleep(0.001)
+            for thread in threads[1:]:
+                thread.start()
+            time.sleep(hold)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_group_commit_follower_budget(self):
+        '''Test followers give up waiting for a leader within budget'''
+        start = time.time()
+        timeouts = metrics.get_lock_metrics('database.exclusive').timeouts
+        results = self.run_writers([None, 0.2], 0.5)
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], exceptions.LockTimeoutException)
+        # Reported as a timeout of the exclusive lock, with a retry hint
+        self.assertEqual(results[1].lock, 'database.exclusive')
+        self.assertIn('Retry-After', results[1].get_headers())
+        self.assertGreaterEqual(results[1].retry_after, 1)
+        self.assertEqual(metrics.snapshot()['locks']['database.exclusive'][
+            'timeouts'], timeouts + 1)
+        # The withdrawn write is not applied
+        self.assertEqual(self.db.get_host(2)['name'], 'test-host-1')
+        self.assertGreater(time.time() - start, 0.5)
+
+    def test_group_commit_leader_budget(self):
+        '''Test followers with budget left outlive a leader timeout'''
+        results = self.run_writers([0.2, None, 0.01], 0.5)
+        self.assertIsInstance(results[0], exceptions.LockTimeoutException)
+        self.assertEqual(results[1], 2)
+        self.assertIsInstance(results[2], exceptions.LockTimeoutException)
+        self.assertEqual([x['name'] for x in self.db.get_hosts()],
+                         ['test-host-0', 'updated', 'test-host-2'])
+
+    def test_free_hosts(self):
+        '''Test free hosts are found in the state shared by processes'''
+        self.db.add_hosts(_generate_hosts(4))
+        self.assertEqual([x['id'] for x in self.db.get_free_hosts(
+            {'os': 'linux'})], [2, 4])
+        self.age_file()
+        # Another worker, with its own handle and state mapping
+        handle = tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+        other = tinydb_nosql.Database(self.db_path)
+        tinydb_nosql._HANDLES[os.path.abspath(self.db_path)] = handle
+        self.assertTrue(other.allocate_if_free(2))
+        self.age_file()
+        with mock.patch.object(tinydb_nosql.SerializedStorage,
+                               'read') as read:
+            hosts = self.db.get_free_hosts()
+            self.assertEqual(read.call_count, 0)
+        self.assertEqual([x['id'] for x in hosts], [1, 3, 4])
+        self.assertFalse(self.db.allocate_if_free(2))
+        # Added hosts are a layout change, which re-reads the file
+        other.add_hosts(_generate_hosts(2))
+        self.assertEqual([x['id'] for x in self.db.get_free_hosts(
+            {'os': 'linux'})], [4, 6])
+
+    def test_set_alive(self):
+        '''Test liveness reaches other processes without a reload'''
+        class OtherHandle(tinydb_nosql.CachedHandle):
+            '''Handle of another process'''
+        other = tinydb_nosql.Database(self.db_path)
+        other._handle = tinydb_nosql.get_handle(self.db_path, OtherHandle)
+        self.db.add_hosts(_generate_hosts(3))
+        revision = self.db.get_revision()
+        self.assertEqual([x['alive'] for x in other.get_free_hosts()],
+                         [False, False, False])
+        self.assertEqual(self.db.set_alive([1, 3, 999], True, 1234), [1, 3])
+        with mock.patch.object(tinydb_nosql.SerializedStorage, 'read') as read:
+            self.assertEqual([x['alive'] for x in other.get_free_hosts()],
+                             [True, False, True])
+            self.assertEqual(read.call_count, 0)
+        self.assertEqual(other.get_changes(revision), [])
+        host = other.get_host(3)
+        self.assertEqual(host[constants.HOST_LAST_SEEN_KEY], 1234)
+        self.assertEqual(host[constants.HOST_VERSION_KEY], 3)
+
+    def test_bulk_update_remove(self):
+        '''Test bulk updates and removals write the file once'''
+        self.db.add_hosts(_generate_hosts(4))
+        storage_write = tinydb_nosql.SerializedStorage.write
+        with mock.patch.object(tinydb_nosql.SerializedStorage, 'write',
+                               autospec=True,
+                               side_effect=storage_write) as write:
+            self.assertEqual(sorted(self.db.update_hosts(
+                [1, 3, 999], {'endpoint': {'port': 2222}})), [1, 3])
+            self.assertEqual(write.call_count, 1)
+            self.assertEqual(sorted(self.db.remove_hosts([2, 4, 999])),
+                             [2, 4])
+            self.assertEqual(write.call_count, 2)
+        host = self.db.get_host(3)
+        self.assertEqual(host['endpoint']['port'], 2222)
+        self.assertEqual(host['endpoint']['ip'], '172.16.0.12')
+        self.assertEqual(len(self.db.get_hosts()), 2)
+
+    def test_get_hosts_filters(self):
+        '''Test filtered reads follow every mutation'''
+        self.db.add_hosts(_generate_hosts(6))
+        self.assertEqual([x['id'] for x in self.db.get_hosts(
+            {'os': 'linux', 'allocated': False})], [2, 4, 6])
+        self.db.allocate_if_free(4)
+        self.db.update_host(6, {'os': 'windows'})
+        self.db.remove_hosts([2])
+        self.db.add_hosts(_generate_hosts(2))
+        self.assertEqual([x['id'] for x in self.db.get_hosts(
+            {'os': 'linux', 'allocated': False})], [8])
+        self.assertEqual([x['id'] for x in self.db.get_hosts(
+            {'tags': ['all', 'test_0']})], [1, 7])
+        # External writes rebuild the index
+        self.write_externally(_generate_hosts(2))
+        self.assertEqual([x['id'] for x in self.db.get_hosts(
+            {'os': 'linux'})], [2])
+
+    def test_fields(self):
+        '''Test field projections of host reads'''
+        self.db.add_hosts(_generate_hosts(2))
+        self.assertEqual(self.db.get_hosts(fields=['name', 'missing']), [
+            {'id': 1, 'name': 'test-host-0'},
+            {'id': 2, 'name': 'test-host-1'}])
+        self.assertEqual(self.db.get_host(2, fields=['allocated']),
+                         {'id': 2, 'allocated': False})
+        self.assertEqual(self.db.get_host(3, fields=['name']), dict())
+
+    def test_change_log(self):
+        '''Test mutations bump the revision and fill the change log'''
+        def reopen():
+            '''Simulates a restart reading the database file'''
+            tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+            return tinydb_nosql.Database(self.db_path)
+
+        _check_change_log(self, self.db, reopen)
+
+    def test_credentials(self):
+        '''Test the content-addressed credentials table'''
+        self.db.add_hosts(_generate_hosts(1))
+        creds = {'username': 'ubuntu', 'key': 'x' * 4096}
+        self.assertEqual(self.db.add_credentials({'ref1': creds}),
+                         {'ref1': creds})
+        self.assertEqual(self.db.add_credentials({'ref1': creds}), dict())
+        self.assertEqual(self.db.get_credentials('ref1'), creds)
+        self.assertEqual(self.db.get_credentials('ref2'), dict())
+        self.assertEqual(len(self.db.get_hosts()), 1)
+        with open(self.db_path) as f_db:
+            self.assertEqual(json.load(f_db)['credentials'], {'ref1': creds})
+        self.db.init_data()
+        self.assertEqual(self.db.get_credentials('ref1'), dict())
+
+    def test_serializers(self):
+        '''Test files of any format are read and converted on write'''
+        self.db.add_hosts(_generate_hosts(2))
+        tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+        db = tinydb_nosql.Database(
+            self.db_path, serializer=serializers.FORMAT_MARSHAL,
+            compress=True)
+        self.assertEqual(len(db.get_hosts()), 2)
+        db.update_host(2, {'allocated': True})
+        with open(self.db_path, 'rb') as f_db:
+            self.assertTrue(f_db.read().startswith(serializers.MAGIC_ZLIB))
+        tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+        db = tinydb_nosql.Database(self.db_path)
+        self.assertTrue(db.get_host(2)['allocated'])
+        self.assertEqual(db.add_hosts(_generate_hosts(1)), [3])
+        with open(self.db_path) as f_db:
+            self.assertEqual(len(json.load(f_db)['hosts']), 3)
+        self.assertRaises(exceptions.ConfigurationError,
+                          tinydb_nosql.Database, self.db_path,
+                          serializer='yaml')
+
+    def test_durability(self):
+        '''Test strict writes replace the file, the others rewrite it'''
+        self.db.add_hosts(_generate_hosts(2))
+        inode = os.stat(self.db_path).st_ino
+        self.db.update_host(1, {'allocated': True})
+        self.assertNotEqual(os.stat(self.db_path).st_ino, inode)
+        for policy in ['interval', 'none']:
+            tinydb_nosql._HANDLES.pop(os.path.abspath(self.db_path))
+            db = tinydb_nosql.Database(self.db_path, durability=policy)
+            inode = os.stat(self.db_path).st_ino
+            with mock.patch.object(tinydb_nosql.os, 'fsync') as fsync:
+                db.update_host(2, {'allocated': policy == 'interval'})
+                db.close()
+            self.assertEqual(os.stat(self.db_path).st_ino, inode)
+            self.assertEqual(fsync.call_count, int(policy == 'interval'))
+            self.assertEqual(db.get_host(2)['allocated'],
+                             policy == 'interval')
+        self.assertRaises(exceptions.ConfigurationError,
+                          tinydb_nosql.Database, self.db_path,
+                          durability='sometimes')
+
+    def test_bad_flush_policy(self):
+        '''Test an unknown flush policy is refused'''
+        self.assertRaises(exceptions.ConfigurationError,
+                          tinydb_nosql.Database, self.db_path, flush='x')
@@ -0,0 +1,112 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.test_health
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the background health checker
+'''
+
+import os
+import mock
+import shutil
+import socket
+import tempfile
+import testtools
+
+from .. import constants, health
+from ..scanner import PortScanner
+from ..storage import get_storage
+
+
+class HealthCheckerTest(testtools.TestCase):
+    '''Test class for the background health checker'''
+    STORAGE_BACKEND = 'tinydb'
+
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.storage = get_storage(self.STORAGE_BACKEND,
+                                   os.path.join(workdir, 'hosts.db'))
+        self.listener = socket.socket()
+        self.addCleanup(self.listener.close)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        self.storage.add_hosts([{
+            'name': 'host-{0}'.format(port),
+            'endpoint': {'ip': '127.0.0.1', 'port': port},
+            'allocated': False,
+            'alive': False
+        } for port in [self.listener.getsockname()[1], closed_port]])
+        self.checker = health.HealthChecker(
+            self.storage, PortScanner(timeout=5), 60, batch_size=1)
+        self.addCleanup(self.checker.resign)
+
+    def test_sweep(self):
+        '''Test sweeps record alive hosts and only write changes'''
+        self.assertEqual(self.checker.sweep(), ([1], []))
+        host = self.storage.get_host(1)
+        self.assertTrue(host['alive'])
+        self.assertIsNotNone(host[constants.HOST_LAST_SEEN_KEY])
+        self.assertFalse(self.storage.get_host(2)['alive'])
+        revision = self.storage.get_revision()
+        self.assertEqual(self.checker.sweep(), ([], []))
+        self.assertEqual(self.storage.get_revision(), revision)
+        self.listener.close()
+        self.assertEqual(self.checker.sweep(), ([], [1]))
+        self.assertFalse(self.storage.get_host(1)['alive'])
+
+    def test_sweep_outside_change_log(self):
+        '''Test sweeps leave the change log and host versions alone'''
+        revision = self.storage.get_revision()
+        versions = [self.storage.get_host_version(x) for x in [1, 2]]
+        self.assertEqual(self.checker.sweep(), ([1], []))
+        self.listener.close()
+        self.assertEqual(self.checker.sweep(), ([], [1]))
+        self.assertFalse(self.storage.get_host(1)['alive'])
+        self.assertIsNotNone(
+            self.storage.get_host(1)[constants.HOST_LAST_SEEN_KEY])
+        self.assertEqual(self.storage.get_revision(), revision)
+        self.assertEqual(self.storage.get_changes(revision), [])
+        self.assertEqual([self.storage.get_host_version(x) for x in [1, 2]],
+                         versions)
+
+    def test_election(self):
+        '''Test a single checker of a database sweeps'''
+        other = health.HealthChecker(
+            self.storage, PortScanner(timeout=5), 60)
+        self.addCleanup(other.resign)
+        self.assertTrue(self.checker.elect())
+        self.assertFalse(other.elect())
+        with mock.patch.object(other, 'sweep') as sweep:
+            other.run(once=True)
+            self.assertEqual(sweep.call_count, 0)
+        self.checker.resign()
+        self.assertTrue(other.elect())
+        self.assertTrue(other.leader)
+
+
+class HealthCheckerSQLiteTest(HealthCheckerTest):
+    '''Test class for the health checker of a SQLite storage'''
+    STORAGE_BACKEND = 'sqlite'
+
+
+class HealthCheckerJournalTest(HealthCheckerTest):
+    '''Test class for the health checker of a journaled storage'''
+    STORAGE_BACKEND = 'journal'
@@ -0,0 +1,73 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.test_metrics
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the lock contention metrics
+'''
+
+import mock
+import threading
+import testtools
+
+from .. import metrics
+
+
+class MetricsTest(testtools.TestCase):
+    '''Test class for the lock contention metrics'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.addCleanup(metrics.configure, None)
+
+    def test_histogram(self):
+        '''Test durations fall in the first bucket bounding them'''
+        histogram = metrics.Histogram()
+        for value in [0.0005, 0.001, 0.3, 60]:
+            histogram.observe(value)
+        data = histogram.to_dict()
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(data['max'], 60)
+        counts = dict((x['le'], x['count']) for x in data['buckets'])
+        self.assertEqual(counts[0.001], 2)
+        self.assertEqual(counts[0.5], 1)
+        self.assertEqual(counts[None], 1)
+
+    def test_timed(self):
+        '''Test waiters, wait and hold times are recorded'''
+        lock = threading.Lock()
+        with metrics.timed('test', lock):
+            self.assertTrue(lock.locked())
+            self.assertEqual(
+                metrics.get_lock_metrics('test').holders, 1)
+        self.assertFalse(lock.locked())
+        data = metrics.snapshot()['locks']['test']
+        self.assertEqual(data['waiters'], 0)
+        self.assertEqual(data['holders'], 0)
+        self.assertEqual(data['wait']['count'], 1)
+        self.assertEqual(data['hold']['count'], 1)
+
+    def test_slow_acquisitions(self):
+        '''Test acquisitions waiting past the threshold are logged'''
+        metrics.configure(0.0001)
+        with mock.patch.object(metrics, 'time') as clock:
+            clock.time.side_effect = [0.0, 1.0, 1.0, 2.0]
+            with mock.patch.object(metrics.logger, 'warning') as warning:
+                with metrics.timed('test', threading.Lock()):
+                    pass
+        self.assertEqual(warning.call_count, 1)
+        self.assertEqual(
+            metrics.snapshot()['locks']['test']['wait']['max'], 1.0)
@@ -0,0 +1,106 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.test_probes
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the shared probe result cache
+'''
+
+import os
+import mock
+import shutil
+import tempfile
+import testtools
+
+from .. import probes
+from ..scanner import PortScanner
+
+ENDPOINT = {'ip': '192.0.2.1', 'port': 22}
+
+
+class ProbeCacheTest(testtools.TestCase):
+    '''Test class for the shared probe result cache'''
+    def setUp(self):
+        testtools.TestCase.setUp(self)
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        self.path = os.path.join(workdir, 'hosts.json.probes')
+        self.cache = self.open_cache()
+
+    def open_cache(self, **kwargs):
+        '''Opens the probe cache, as another worker would'''
+        cache = probes.ProbeCache(self.path, success_ttl=5, backoff=1,
+                                  max_backoff=4, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_success_ttl(self):
+        '''Test successes are trusted for a while, by every worker'''
+        self.assertIsNone(self.cache.verdict(ENDPOINT))
+        self.cache.record(ENDPOINT, True, now=100)
+        other = self.open_cache()
+        self.assertTrue(other.verdict(ENDPOINT, now=104))
+        self.assertIsNone(other.verdict(ENDPOINT, now=105))
+        self.assertIsNone(other.verdict(dict(ENDPOINT, port=23), now=100))
+
+    def test_backoff(self):
+        '''Test failures skip the endpoint, exponentially longer'''
+        for failures, until in [(1, 101), (2, 102), (3, 104), (4, 104)]:
+            self.cache.record(ENDPOINT, False, now=100)
+            probe = self.cache.get(ENDPOINT)
+            self.assertEqual((probe['failures'], probe['until']),
+                             (failures, until))
+        self.assertFalse(self.cache.verdict(ENDPOINT, now=103))
+        self.assertIsNone(self.cache.verdict(ENDPOINT, now=104))
+        self.cache.record(ENDPOINT, True, now=110)
+        self.assertEqual(self.cache.get(ENDPOINT)['failures'], 0)
+
+    def test_entries(self):
+        '''Test entries list IPv4 and IPv6 endpoints, not invalid ones'''
+        self.cache.record({'ip': '::1', 'port': 5985}, True, now=100)
+        self.cache.record(ENDPOINT, False, now=100)
+        self.cache.record({'ip': 'bad', 'port': 22}, False)
+        self.cache.record({'ip': '192.0.2.2'}, False)
+        self.assertEqual(self.cache.entries(), [{
+            'ip': '192.0.2.1', 'port': 22, 'reachable': False,
+            'failures': 1, 'checked': 100, 'until': 101
+        }, {
+            'ip': '::1', 'port': 5985, 'reachable': True,
+            'failures': 0, 'checked': 100, 'until': 105
+        }])
+
+    def test_full(self):
+        '''Test a full table replaces its least recently checked results'''
+        cache = probes.ProbeCache(self.path + '.small', capacity=4)
+        self.addCleanup(cache.close)
+        for idx in range(6):
+            cache.record({'ip': '192.0.2.{0}'.format(idx), 'port': 22},
+                         True, now=100 + idx)
+        self.assertEqual(sorted(x['ip'] for x in cache.entries()),
+                         ['192.0.2.{0}'.format(idx) for idx in range(2, 6)])
+
+    def test_scanner(self):
+        '''Test the scanner trusts and records cached results'''
+        endpoints = [ENDPOINT, dict(ENDPOINT, ip='192.0.2.2'),
+                     dict(ENDPOINT, ip='192.0.2.3')]
+        self.cache.record(endpoints[0], True)
+        self.cache.record(endpoints[1], False)
+        scanner = PortScanner(timeout=0.1, cache=self.cache)
+        with mock.patch.object(scanner, 'scan_wave',
+                               return_value=iter([])) as scan_wave:
+            self.assertEqual(list(scanner.scan(endpoints)), [0])
+            scan_wave.assert_called_once_with([endpoints[2]])
+        self.assertEqual(list(scanner.scan([endpoints[2]])), [])
+        self.assertFalse(self.cache.get(endpoints[2])['reachable'])
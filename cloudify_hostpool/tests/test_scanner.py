@@ -0,0 +1,117 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.test_scanner
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the concurrent port scanner
+'''
+
+import time
+import socket
+import mock
+import testtools
+
+from .. import scanner, timeouts
+
+
+class PortScannerTest(testtools.TestCase):
+    '''Test class for the concurrent port scanner'''
+    def listen(self):
+        '''Opens a listening socket, returns its endpoint'''
+        sock = socket.socket()
+        self.addCleanup(sock.close)
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(64)
+        return {'ip': '127.0.0.1', 'port': sock.getsockname()[1]}
+
+    def closed_port(self):
+        '''Returns the endpoint of a port nothing listens on'''
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        return {'ip': '127.0.0.1', 'port': port}
+
+    def test_scan(self):
+        '''Test only the reachable endpoints are yielded'''
+        endpoints = [self.closed_port(), self.listen(), {'ip': '127.0.0.1'},
+                     self.listen(), self.closed_port()]
+        self.assertEqual(
+            sorted(scanner.PortScanner(timeout=5).scan(endpoints)), [1, 3])
+
+    def test_waves(self):
+        '''Test endpoints are scanned in waves of bounded size'''
+        endpoints = [self.listen() for _ in range(5)]
+        port_scanner = scanner.PortScanner(timeout=5, wave_size=2)
+        waves = []
+        original = port_scanner.scan_wave
+
+        def scan_wave(wave):
+            waves.append(len(wave))
+            return original(wave)
+        port_scanner.scan_wave = scan_wave
+        self.assertEqual(sorted(port_scanner.scan(endpoints)),
+                         [0, 1, 2, 3, 4])
+        self.assertEqual(waves, [2, 2, 1])
+
+    def test_immediate_result(self):
+        '''Test connects that succeed or fail at once are handled'''
+        endpoints = [self.closed_port(), self.closed_port()]
+        port_scanner = scanner.PortScanner(timeout=5)
+        with mock.patch.object(port_scanner, 'connect',
+                               side_effect=[(None, True), (None, False)]):
+            self.assertEqual(list(port_scanner.scan(endpoints)), [0])
+
+    def test_bounded_latency(self):
+        '''Test a wave of unreachable endpoints takes one timeout'''
+        # TEST-NET-1 addresses, black holes (or unroutable)
+        endpoints = [{'ip': '192.0.2.{0}'.format(idx), 'port': 22}
+                     for idx in range(1, 31)]
+        endpoints.append(self.listen())
+        start = time.time()
+        self.assertEqual(
+            list(scanner.PortScanner(timeout=0.2).scan(endpoints)), [30])
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_close(self):
+        '''Test closing a scan aborts the probes in flight'''
+        endpoints = [self.listen()] + [
+            {'ip': '192.0.2.{0}'.format(idx), 'port': 22}
+            for idx in range(1, 11)]
+        scan = scanner.PortScanner(timeout=30).scan(endpoints)
+        start = time.time()
+        self.assertEqual(next(scan), 0)
+        scan.close()
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_adaptive_timeouts(self):
+        '''Test endpoints time out after their own probe timeout'''
+        reachable = self.listen()
+        probe_timeouts = timeouts.ProbeTimeouts(
+            timeouts.POLICY_ADAPTIVE, timeout=30, floor=0.1)
+        port_scanner = scanner.PortScanner(timeout=30,
+                                           timeouts=probe_timeouts)
+        for _ in range(3):
+            self.assertEqual(list(port_scanner.scan([reachable])), [0])
+        self.assertEqual(probe_timeouts.timeout(reachable), 0.1)
+        # Black holes time out after their own timeout, not scan_timeout
+        probe_timeouts.observe({'ip': '192.0.2.1', 'port': 22}, 0.01)
+        probe_timeouts.observe({'ip': '192.0.2.1', 'port': 22}, 0.01)
+        probe_timeouts.observe({'ip': '192.0.2.1', 'port': 22}, 0.01)
+        start = time.time()
+        self.assertEqual(list(port_scanner.scan([
+            {'ip': '192.0.2.{0}'.format(idx), 'port': 22}
+            for idx in range(1, 11)] + [reachable])), [10])
+        self.assertLess(time.time() - start, 5)
@@ -0,0 +1,86 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+'''
+    cloudify_hostpool.tests.test_timeouts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Tests for the adaptive probe timeouts
+'''
+
+import testtools
+
+from .. import exceptions, timeouts
+
+ENDPOINT = {'ip': '10.0.0.5', 'port': 22}
+
+
+class ProbeTimeoutsTest(testtools.TestCase):
+    '''Test class for the adaptive probe timeouts'''
+    def test_percentile(self):
+        '''Test nearest-rank percentiles'''
+        values = [5, 1, 4, 2, 3]
+        self.assertEqual(timeouts.percentile(values, 50), 3)
+        self.assertEqual(timeouts.percentile(values, 99), 5)
+        self.assertEqual(timeouts.percentile(values, 1), 1)
+
+    def test_subnet(self):
+        '''Test endpoints are grouped by /24 (or /64) subnet'''
+        self.assertEqual(timeouts.subnet('10.0.0.5'), '10.0.0.0/24')
+        self.assertEqual(timeouts.subnet('fd00:1:2:3:4::5'),
+                         'fd00:1:2:3::/64')
+        # Compressed IPv6 addresses of a /64 share it
+        self.assertEqual(timeouts.subnet('fe80::1'), 'fe80::/64')
+        self.assertEqual(timeouts.subnet('fe80:0:0:0:ffff::2'), 'fe80::/64')
+        self.assertEqual(timeouts.subnet('::1'), '::/64')
+        self.assertEqual(timeouts.subnet('2001:db8::1:0:0:1'),
+                         '2001:db8::/64')
+        # Anything else is a subnet of its own
+        self.assertEqual(timeouts.subnet('10.0.0.300'), '10.0.0.300')
+        self.assertEqual(timeouts.subnet('example.com'), 'example.com')
+        self.assertEqual(timeouts.subnet(''), '')
+
+    def test_fixed(self):
+        '''Test the fixed policy ignores RTTs'''
+        probe_timeouts = timeouts.ProbeTimeouts(timeout=2.0)
+        for _ in range(5):
+            probe_timeouts.observe(ENDPOINT, 0.001)
+        self.assertEqual(probe_timeouts.timeout(ENDPOINT), 2.0)
+
+    def test_adaptive(self):
+        '''Test adaptive timeouts follow the RTTs, within bounds'''
+        probe_timeouts = timeouts.ProbeTimeouts(
+            timeouts.POLICY_ADAPTIVE, timeout=1.0, factor=2.0, floor=0.01,
+            ceiling=3.0)
+        neighbour = dict(ENDPOINT, ip='10.0.0.6')
+        self.assertEqual(probe_timeouts.timeout(ENDPOINT), 1.0)
+        for rtt in [0.001, 0.002, 0.02]:
+            probe_timeouts.observe(ENDPOINT, rtt)
+        self.assertEqual(probe_timeouts.timeout(ENDPOINT), 0.04)
+        # Endpoints without RTTs of their own get their subnet's
+        self.assertEqual(probe_timeouts.timeout(neighbour), 0.04)
+        self.assertEqual(
+            probe_timeouts.timeout(dict(ENDPOINT, ip='10.0.1.5')), 1.0)
+        for rtt in [0.001, 0.001, 0.001]:
+            probe_timeouts.observe(neighbour, rtt)
+        self.assertEqual(probe_timeouts.timeout(neighbour), 0.01)
+        for rtt in [2.5, 2.5, 2.5]:
+            probe_timeouts.observe(ENDPOINT, rtt)
+        self.assertEqual(probe_timeouts.timeout(ENDPOINT), 3.0)
+
+    def test_bad_policy(self):
+        '''Test unknown policies and percentiles are refused'''
+        self.assertRaises(exceptions.ConfigurationError,
+                          timeouts.ProbeTimeouts, 'sometimes')
+        self.assertRaises(exceptions.ConfigurationError,
+                          timeouts.ProbeTimeouts, pct=0)
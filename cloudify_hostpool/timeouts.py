@@ -0,0 +1,124 @@
+# #######
+# Copyright (c) 2016 GigaSpaces Technologies Ltd. All rights reserved
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+#    * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#    * See the License for the specific language governing permissions and
+#    * limitations under the License.
+
+'''
+    cloudify_hostpool.timeouts
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+    Probe timeouts of host endpoints, adapted to their connect times
+
+    Under the "adaptive" policy, the connect round trip times (RTTs) of
+    successful probes are recorded per endpoint and per subnet (/24 for
+    IPv4, /64 for IPv6). The timeout of an endpoint is a high percentile
+    of its RTTs (or of its subnet's, until it has enough of its own)
+    times a safety factor, bounded by a floor and a ceiling. Endpoints
+    nothing is known about yet get the fixed timeout.
+
+    RTTs are kept per process (gunicorn worker), for the last `samples`
+    probes of each endpoint and subnet.
+'''
+
+import math
+import threading
+from collections import deque
+
+from netaddr import IPNetwork
+from netaddr.core import AddrFormatError
+
+from . import exceptions
+
+POLICY_FIXED = 'fixed'
+POLICY_ADAPTIVE = 'adaptive'
+POLICIES = [POLICY_FIXED, POLICY_ADAPTIVE]
+
+# Seconds an endpoint has to accept a connection, under the fixed policy
+# or while its RTTs are unknown
+TIMEOUT = 1.0
+PERCENTILE = 99.0
+FACTOR = 3.0
+FLOOR = 0.05
+CEILING = 5.0
+# RTTs kept per endpoint and subnet, and RTTs needed to adapt a timeout
+SAMPLES = 32
+MIN_SAMPLES = 3
+
+
+def subnet(ip):
+    '''Returns the /24 (IPv4) or /64 (IPv6) subnet of an address, in
+    its normal form (or the address itself if it isn't an IP address)'''
+    try:
+        return str(IPNetwork(
+            '{0}/{1}'.format(ip, 64 if ':' in ip else 24)).cidr)
+    except (AddrFormatError, ValueError, TypeError):
+        return ip
+
+
+def percentile(values, pct):
+    '''Nearest-rank percentile of a list of values'''
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[min(len(values), max(1, rank)) - 1]
+
+
+class ProbeTimeouts(object):
+    '''Derives the probe timeout of endpoints from their RTTs'''
+    def __init__(self, policy=POLICY_FIXED, timeout=TIMEOUT,
+                 pct=PERCENTILE, factor=FACTOR, floor=FLOOR,
+                 ceiling=CEILING, samples=SAMPLES):
+        if policy not in POLICIES:
+            raise exceptions.ConfigurationError(
+                'Unknown probe timeout policy "{0}"'.format(policy))
+        if not 0 < pct <= 100:
+            raise exceptions.ConfigurationError(
+                'Probe timeout percentile must be in (0, 100]')
+        self.policy = policy
+        self.default = timeout or TIMEOUT
+        self.pct = pct
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = max(ceiling, floor)
+        self.samples = samples
+        self.rtts = dict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def keys(endpoint):
+        '''RTT keys of an endpoint: its own and its subnet's'''
+        ip = endpoint.get('ip') or ''
+        return ('{0}:{1}'.format(ip, endpoint.get('port')), subnet(ip))
+
+    def observe(self, endpoint, rtt):
+        '''Records the RTT of a successful probe of an endpoint'''
+        if self.policy != POLICY_ADAPTIVE:
+            return
+        with self.lock:
+            for key in self.keys(endpoint):
+                if key not in self.rtts:
+                    self.rtts[key] = deque(maxlen=self.samples)
+                self.rtts[key].append(rtt)
+
+    def timeout(self, endpoint):
+        '''Returns the seconds to wait for an endpoint to connect'''
+        if self.policy != POLICY_ADAPTIVE:
+            return self.default
+        with self.lock:
+            for key in self.keys(endpoint):
+                rtts = self.rtts.get(key)
+                if rtts is not None and len(rtts) >= MIN_SAMPLES:
+                    rtts = list(rtts)
+                    break
+            else:
+                return self.default
+        return min(self.ceiling, max(
+            self.floor, percentile(rtts, self.pct) * self.factor))
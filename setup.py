@@ -34,6 +34,11 @@ setup(
         "requests>=2.7.0,<3.0",
         'filelock==0.2.0',
         'tinydb>=3.15.0,<4.0.0',
-        'six'
-    ]
+        'six',
+        'selectors34; python_version < "3.4"'
+    ],
+    extras_require={
+        'fastjson': ['orjson; python_version >= "3.6"',
+                     'ujson; python_version < "3.6"']
+    }
 )